@@ -79,8 +79,7 @@ class Block:
         self.txns = txns
 
         if _hash is None:
-            self._hash = sha256(f'{self.timestamp}{self.last_hash} \
-                        {self.txns}{self.proof}'.encode()).hexdigest()
+            self._hash = block_hash(self.timestamp, last_hash, txns, proof)
         else:
             self._hash = _hash
 
@@ -121,8 +120,49 @@ def to_txn(txn_dict: dict):
                        txn_dict['sender'],
                        txn_dict['receivers'],
                        txn_dict['outputs'],
-                       txn_dict['proof'],
-                       txn_dict['_hash'])
+                       txn_dict['proof'])
+
+
+def txn_hash(txn) -> str:
+    """Calculates the id of a transaction. The transaction is encoded as a
+    compact json array so the id stays the same after the transaction was sent
+    over the network (where tuples turn into lists)
+
+    Args:
+        txn (Transaction): The transaction. Can also be a list in the order of
+        the Transaction fields
+
+    Returns:
+        str: The transaction id in hexadecimal format
+    """
+    return sha256(json.dumps(list(txn), separators=(',', ':')).encode()).hexdigest()
+
+def block_data(timestamp, last_hash, txns) -> str:
+    """The data the miner searches a proof of work for. The timestamp and the
+    transactions are encoded the same way no matter how the block was
+    received or stored (see txn_hash), so the hash can be computed again from
+    the block's body
+
+    Args:
+        timestamp (Union[str, float]): The time the block was created
+        last_hash (str): The hash of the last block
+        txns (list): The transactions of the block
+
+    Returns:
+        str: The data, without the proof
+    """
+    txns = json.dumps([list(txn) for txn in txns], separators=(',', ':'))
+    return f'{float(timestamp)!r}{last_hash}{txns}'
+
+def block_hash(timestamp, last_hash, txns, proof) -> str:
+    """Calculates the hash of a block the way the miner does (see
+    block_data)
+
+    Returns:
+        str: The hash in hexadecimal format
+    """
+    data = block_data(timestamp, last_hash, txns) + str(proof)
+    return sha256(data.encode()).hexdigest()
 
 def decode_JSON(dict_):
     return Block(dict_["last_hash"], dict_["data"], dict_["pow"],
@@ -132,7 +172,7 @@ def decode_JSON(dict_):
 # A Class inheriting from JSONEcoder to encode the Block class to json dict
 class ClsEncoder(json.JSONEncoder):
     def default(self, o):
-        return o.__dict__
+        return o.json() if hasattr(o, 'json') else o.__dict__
 
 
 # Premade object of the block class
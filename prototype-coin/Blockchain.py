@@ -1,17 +1,41 @@
+import logging
 import os
-from typing import List, Optional
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 
+import storage
 import treenode
-from block import Block, Constants, Transaction
-from treenode import TreeNode, get_end_children, strip_short
+from block import Block, Constants, Transaction, txn_hash
+from compact import is_reward
+from metrics import Registry
+from treenode import TreeNode, get_end_children, longest_path, strip_short
+from txindex import TxIndex
+from validation import check_checkpoints, check_headers, check_pow, check_txns
+from utxo import UTXOSet, parse_field, receivers
+
+log = logging.getLogger(__name__)
+
+MIN_BODIES = 10     # Blocks that always keep their transactions when pruning
+PRUNE_STEP = 100    # Min blocks pruned together, so txns.csv isn't rewritten often
+MAX_REORG = 1000    # Confirmed blocks that can be disconnected by a reorganization
+MAX_SIDE_BLOCKS = 2000  # Blocks of competing branches that are kept
 
 
 class Blockchain:
 
     def __init__(self, chain: Optional[List[Block]]=None,
-                 data_dir: Optional[str]=None):
+                 data_dir: Optional[str]=None,
+                 difficulty: int=4,
+                 durability: int=storage.BATCH,
+                 batch_size: int=100,
+                 prune_blocks: Optional[int]=None,
+                 prune_bytes: Optional[int]=None,
+                 txindex: bool=False,
+                 metrics: Optional[Registry]=None,
+                 checkpoints: Optional[Dict[int, str]]=None,
+                 assume_valid: bool=True):
         """A class that represents the blockchain. It is responsible to manage
         the blockchain.
 
@@ -21,6 +45,37 @@ class Blockchain:
             
             data_dir (Optional[str], optional): The default directory to save the blockchain 
             in.
+
+            difficulty (int, optional): Leading zeros a block hash needs.
+            Defaults to 4.
+
+            durability (int, optional): When confirmed blocks are synced to
+            the disk (see storage.BlockWriter). Defaults to storage.BATCH.
+
+            batch_size (int, optional): Confirmed blocks written to the disk
+            together. Defaults to 100.
+
+            prune_blocks (Optional[int], optional): Pruning mode. Keep the
+            transactions of only this many last blocks. Defaults to None (keep
+            all).
+
+            prune_bytes (Optional[int], optional): Pruning mode. Keep the
+            transactions of the last blocks up to about this many bytes.
+            Defaults to None (keep all).
+
+            txindex (bool, optional): Keep an index of the transactions by id
+            and by address on the disk (see TxIndex). Defaults to False.
+
+            metrics (Optional[Registry], optional): Where to report block and
+            disk times. Defaults to a new Registry.
+
+            checkpoints (Optional[Dict[int, str]], optional): Trusted block
+            hashes by their height. Chains that don't match them are not
+            loaded or downloaded. Defaults to None (no checkpoints).
+
+            assume_valid (bool, optional): Don't check the transactions of
+            blocks up to the last checkpoint, only their headers. Defaults to
+            True.
             
         Attributes:
             chain (list): The blocks with height >= 3 and most likely of the
@@ -32,6 +87,33 @@ class Blockchain:
 
             orphan_blocks: Block that were added to the blockchain but currently
             not related to any block in the blockchain
+
+            writer (storage.BlockWriter): Writes confirmed blocks to the disk
+            in batches, in its own thread
+
+            io (ThreadPoolExecutor): The writer's thread. Run other disk work
+            of the blockchain (load, save) in it to keep it in order with the
+            writes
+
+            utxos (UTXOSet): The unspent outputs of the confirmed chain
+
+            first_body (int): The index of the first block in the chain that
+            has its transactions. Blocks before it were pruned and only have
+            their headers (txns is None)
+
+            txindex (Optional[TxIndex]): The transaction index, if enabled
+
+            listeners (list): Objects that follow the chain, like wallets (see
+            subscribe)
+
+            metrics (Registry): Block add times, orphans and the disk writes
+
+            side (Dict[str, Tuple[Block, int]]): Blocks of branches that fork
+            from the chain and have less work than it, with the cumulative
+            work of their branch. When a branch gets more work than the chain
+            the chain is reorganized to it (see _reorganize)
+
+            checkpoints (Dict[int, str]): Trusted block hashes by their height
         """
     
 
@@ -46,7 +128,7 @@ class Blockchain:
             self.data_dir = data_dir
         
         self.PATH = os.path.join(os.path.dirname(__file__), self.data_dir)
-        print(f'BLOCKCHAIN - blockchain directory is set to: {self.PATH}')
+        log.info('blockchain directory is set to: %s', self.PATH)
         
         # Create directories if they not exist
         os.makedirs(os.path.dirname(self.PATH + '//metadata.csv'),
@@ -54,9 +136,56 @@ class Blockchain:
         os.makedirs(os.path.dirname(self.PATH + '//txns.csv'),
                     exist_ok=True)
 
+        self.difficulty = difficulty
+        self.checkpoints = dict(checkpoints or {})
+        self.assume_valid = assume_valid
+
         # TODO: change default value to an empty treenode
         self.unconfirmed = None
         self.orphaned_blocks = list()
+
+        # Every block needs the same work while the difficulty is fixed
+        self.block_work = 16 ** difficulty
+        self.side: Dict[str, Tuple[Block, int]] = {}
+        self._heights: Dict[str, int] = {}  # Index of every confirmed block
+        self._undo = deque(maxlen=MAX_REORG)    # Spent outputs of the last blocks
+        self._disconnected_txns = []
+
+        self.metrics = Registry() if metrics is None else metrics
+        self._add_time = self.metrics.histogram(
+            'block_add_seconds', 'Seconds to add a block to the blockchain')
+        self._orphans = self.metrics.counter(
+            'blocks_orphaned', 'Blocks that did not continue any known block')
+        self._reorgs = self.metrics.counter(
+            'chain_reorgs', 'Reorganizations of the confirmed chain')
+        self._reorg_depth = self.metrics.histogram(
+            'reorg_depth', 'Confirmed blocks disconnected by a reorganization',
+            buckets=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+        self.metrics.gauge('chain_height', 'Blocks in the confirmed chain',
+                           func=lambda: len(self.chain))
+
+        self.writer = storage.BlockWriter(self.PATH, durability=durability,
+                                          batch_size=batch_size,
+                                          metrics=self.metrics)
+        self.io = self.writer.executor
+
+        self.prune_blocks = prune_blocks
+        self.prune_bytes = prune_bytes
+        self.first_body = 0
+        self.utxo_path = os.path.join(self.PATH, 'utxos.csv')
+
+        self.listeners = []
+
+        self.txindex = None
+        if txindex:
+            self.txindex = TxIndex(os.path.join(self.PATH, 'index'))
+        self._index_written = 0
+
+        self.utxos = UTXOSet()
+        self.body_bytes = 0
+        self._body_sizes = deque()  # Of the blocks from first_body
+        for block in self.chain:
+            self._connect(block)
         
 
 
@@ -64,8 +193,10 @@ class Blockchain:
                   is_confirmed: bool=False,
                   other_chain: Optional[List[Block]]=None, 
                   update_file: bool=True):
-        """Adds the given block to the blockchain. If not related to any block
-        in the blockchain, it is added to the orphaned blocks list
+        """Adds the given block to the blockchain. A block that forks from an
+        earlier block is kept on a side branch, and the chain is reorganized
+        when the branch has more work (see _add_side). If not related to any
+        block in the blockchain, it is added to the orphaned blocks list
 
         Args:
             block (Block): The block to add to the blockchain.
@@ -82,7 +213,14 @@ class Blockchain:
             update_file (bool, optional): Update the blockchain in the disk when
             this block is placed. Defaults to True.
         """
-        
+
+        with self._add_time.time():
+            return self._add_block(block, is_confirmed, other_chain,
+                                   update_file)
+
+    def _add_block(self, block: Block, is_confirmed: bool,
+                   other_chain: Optional[List[Block]], update_file: bool):
+
         chain = self.chain if other_chain is None else other_chain
 
         # If it's already was checked
@@ -90,14 +228,18 @@ class Blockchain:
             
             if chain[-1]._hash == block.last_hash:
                 chain.append(block)
-                print('BLOCKCHAIN - Added block to confirmed chain')
+                log.debug('Added block to confirmed chain')
+
+                if other_chain is None:
+                    self._connect(block)
                 
                 if update_file:
-                    self._update_file(self.last_block())
+                    self._write(self.last_block())
+                    self.prune()
                     
                 return True
             else:
-                print('BLOCKCHAIN - Tried to add block to confirmed chain without matching hash')
+                log.info('Tried to add block to confirmed chain without matching hash')
                 return False
 
         def __insert(block, root, i=0):
@@ -133,22 +275,19 @@ class Blockchain:
         if self.unconfirmed is None:
             if block.last_hash == self.chain[-1]._hash:
                 self.unconfirmed = TreeNode(block)
-                print('BLOCKCHAIN - First block is added to unconfirmed chain')
+                log.debug('First block is added to unconfirmed chain')
+                self._notify_unconfirmed()
                 return True
             else:
-                self.orphaned_blocks.append(block)
-                print('BLOCKCHAIN - Block is added to orphaned blocks')
-                return False
+                return self._add_side(block, update_file)
 
         result = __insert(block, self.unconfirmed)
         if not result:
-            self.orphaned_blocks.append(block)
-            print('BLOCKCHAIN - Block is added to orphaned blocks')
-            return False
+            return self._add_side(block, update_file)
         
         else:
-            print('BLOCKCHAIN - Block is added to unconfirmed chain')
-            
+            log.debug('Block is added to unconfirmed chain')
+
 
         # Remove all short forks
         strip_short(self.unconfirmed, 2)
@@ -159,16 +298,228 @@ class Blockchain:
                 len(self.unconfirmed.children) == 1:
 
             self.chain.append(self.unconfirmed.data)
+            self._connect(self.unconfirmed.data)
             self.unconfirmed = self.unconfirmed.children[0]
             self.unconfirmed.remove_parent()
-            print('BLOCKCHAIN - Block is moved to confirmed chain')
+            log.debug('Block is moved to confirmed chain')
 
             if update_file:
-                self._update_file(self.last_block())
+                self._write(self.last_block())
+                self.prune()
+
+        self._notify_unconfirmed()
         
         return True
 
     
+    def _add_side(self, block: Block, update_file: bool) -> bool:
+        """Adds a block that doesn't continue the unconfirmed blocks. If it
+        continues a confirmed block or a side block it is kept on a side
+        branch, and the chain is reorganized to the branch when it has more
+        work. Otherwise it is an orphan
+        """
+
+        if block._hash in self._heights or block._hash in self.side:
+            return False
+
+        parent = block.last_hash
+
+        if parent in self._heights:
+            work = (self._heights[parent] + 1) * self.block_work
+        elif parent in self.side:
+            work = self.side[parent][1]
+        else:
+            self.orphaned_blocks.append(block)
+            log.debug('Block is added to orphaned blocks')
+            self._orphans.inc()
+            return False
+
+        work += self.block_work
+        self.side[block._hash] = (block, work)
+        log.debug('Block is added to a side branch')
+
+        if work > self.work():
+            self._reorganize(block, update_file)
+
+        self._trim_side()
+        return True
+
+    def work(self) -> int:
+        """Returns the work of the best chain: the confirmed chain and the
+        longest branch of the unconfirmed blocks
+        """
+
+        blocks = len(self.chain)
+        if not self.unconfirmed is None:
+            blocks += len(longest_path(self.unconfirmed))
+
+        return blocks * self.block_work
+
+    def _reorganize(self, tip: Block, update_file: bool):
+        """Switches the chain to the side branch that ends with tip. The
+        confirmed blocks after the fork point are disconnected, and together
+        with the unconfirmed blocks they become side blocks, so they can win
+        back. The branch is then added the usual way, so its last blocks stay
+        unconfirmed. Transactions of the blocks that lost are kept for the
+        memory pool (see take_disconnected_txns)
+
+        Args:
+            tip (Block): The last block of the branch
+            update_file (bool): Update the blockchain on the disk
+        """
+
+        branch = [tip]
+        while not branch[-1].last_hash in self._heights:
+            parent = self.side.get(branch[-1].last_hash)
+            if parent is None:
+                log.warning('Side branch of %s is incomplete, not '
+                            'reorganizing', tip._hash)
+                return
+            branch.append(parent[0])
+        branch.reverse()
+
+        fork = self._heights[branch[0].last_hash]
+        depth = len(self.chain) - 1 - fork
+
+        # Blocks can only be disconnected with their spent outputs and
+        # transactions
+        if depth > len(self._undo) or fork + 1 < self.first_body:
+            log.warning('Branch of %s forks %s blocks deep, too deep to '
+                        'reorganize', tip._hash, depth)
+            return
+
+        log.info('Reorganizing %s confirmed blocks to the branch of %s',
+                 depth, tip._hash)
+
+        lost = []
+        if not self.unconfirmed is None:
+            nodes = [(self.unconfirmed, (len(self.chain) + 1) * self.block_work)]
+            while nodes:
+                node, work = nodes.pop()
+                lost.append(node.data)
+                self.side[node.data._hash] = (node.data, work)
+                nodes += [(child, work + self.block_work)
+                          for child in node.children]
+
+            self.unconfirmed = None
+
+        disconnected = self._disconnect(fork, update_file)
+        for index, block in enumerate(disconnected, fork + 1):
+            self.side[block._hash] = (block, (index + 1) * self.block_work)
+
+        for block in branch:
+            del self.side[block._hash]
+
+        for block in branch:
+            self._add_block(block, False, None, update_file)
+
+        kept = {txn_hash(txn) for block in branch for txn in block.txns}
+        self._disconnected_txns += [txn for block in disconnected + lost
+                                    for txn in block.txns
+                                    if not is_reward(txn) and
+                                    not txn_hash(txn) in kept]
+
+        self._reorgs.inc()
+        self._reorg_depth.observe(depth)
+
+    def _trim_side(self):
+
+        # The oldest side blocks are the least likely to win
+        while len(self.side) > MAX_SIDE_BLOCKS:
+            del self.side[next(iter(self.side))]
+
+    def take_disconnected_txns(self) -> List[Transaction]:
+        """Returns the transactions of the blocks that lost in
+        reorganizations and are not in the new chain, and forgets them. They
+        should go back to the memory pool
+
+        Returns:
+            List[Transaction]: The transactions
+        """
+
+        txns = self._disconnected_txns
+        self._disconnected_txns = []
+        return txns
+
+    def assume_valid_height(self) -> int:
+        """Returns the height up to which the transactions of blocks are not
+        checked, the last checkpoint in assume valid mode
+
+        Returns:
+            int: The height, 0 if all the blocks are checked
+        """
+
+        if not self.assume_valid:
+            return 0
+
+        return max(self.checkpoints, default=0)
+
+    def verify_headers(self, hashes: List[str], last_hashes: List[str],
+                       first_height: int, prev_hash: str) -> int:
+        """Checks the linkage, the proof of work and the checkpoints of
+        headers that continue the block prev_hash (see check_headers)
+
+        Args:
+            hashes (List[str]): The hashes of the blocks, in chain order
+            last_hashes (List[str]): The hashes the blocks continue
+            first_height (int): The height of the first block
+            prev_hash (str): The hash of the block before the first block
+
+        Returns:
+            int: The number of headers from the start that are valid
+        """
+
+        return min(check_headers(hashes, last_hashes, prev_hash,
+                                 self.difficulty),
+                   check_checkpoints(hashes, first_height, self.checkpoints))
+
+    def verify_blocks(self, blocks: List[Block], first_height: int) -> int:
+        """Checks downloaded blocks before they are added. All the headers
+        are checked, the hash of every block with transactions is computed
+        again from them (see check_pow), and the transactions of the blocks
+        above the assume valid height are checked. Blocks without
+        transactions (pruned) have only their header checked
+
+        Args:
+            blocks (List[Block]): The blocks, in chain order
+            first_height (int): The height of the first block. The block
+            before it has to be in the chain
+
+        Returns:
+            int: The number of blocks from the start that are valid
+        """
+
+        if not blocks:
+            return 0
+
+        if not 0 < first_height <= len(self.chain):
+            return 0
+
+        valid = self.verify_headers([block._hash for block in blocks],
+                                    [block.last_hash for block in blocks],
+                                    first_height,
+                                    self.chain[first_height - 1]._hash)
+
+        first_checked = self.assume_valid_height() + 1 - first_height
+        for i in range(valid):
+            if blocks[i].txns is None:
+                continue
+
+            if not check_pow(blocks[i], self.difficulty):
+                log.warning('Block %s is invalid: its hash doesnt match its '
+                            'body', blocks[i]._hash)
+                return i
+
+            if i < first_checked:
+                continue
+
+            error = check_txns(blocks[i])
+            if not error is None:
+                log.warning('Block %s is invalid: %s', blocks[i]._hash, error)
+                return i
+
+        return valid
+
     def add_blocks(self, blocks: List[Block],
                    is_confirmed: bool=False,
                    update_file: bool=True):
@@ -215,7 +566,7 @@ class Blockchain:
             have 1 parameter for this blockchain instance. Defaults to None.
         """
         
-        print('BLOCKCHAIN - Saving to disk')
+        log.info('Saving to disk')
 
         if not func is None:
             return func(self)
@@ -223,6 +574,13 @@ class Blockchain:
         metadata_list = list()
         txns_list = list()
         for block in self.chain:
+
+            # Pruned blocks only have their header
+            if block.txns is None:
+                metadata_list.append([block.timestamp, block.last_hash,
+                                      block.proof, block._hash, -1, 0])
+                continue
+
             metadata_list.append([block.timestamp,
                                     block.last_hash,
                                     block.proof, block._hash,
@@ -235,29 +593,78 @@ class Blockchain:
                                     columns=['Timestamp', 'Last hash', 'POW',
                                             'Hash', 'Line', 'Length'])
 
-        txns_df = pd.DataFrame(txns_list)
+        txns_df = pd.DataFrame(txns_list, columns=Transaction._fields)
+
+        # Write next to the old files and swap them in, so a crash leaves
+        # either the old or the new files. Without the tip file, load checks
+        # that the metadata matches the transactions
+        metadata_path = f'{self.PATH}//metadata.csv'
+        txns_path = f'{self.PATH}//txns.csv'
+        metadata_df.to_csv(f'{metadata_path}.tmp', index=False)
+        txns_df.to_csv(f'{txns_path}.tmp', index=False)
+
+        if os.path.exists(self.writer.tip_path):
+            os.remove(self.writer.tip_path)
+
+        os.replace(f'{txns_path}.tmp', txns_path)
+        os.replace(f'{metadata_path}.tmp', metadata_path)
 
-        metadata_df.to_csv(f'{self.PATH}//metadata.csv', index=False)
-        txns_df.to_csv(f'{self.PATH}//txns.csv', index=False)
+        # The files now have the whole chain, including queued blocks
+        self.writer.reset()
+
+        if self.first_body > 0:
+            self.utxos.save(self.utxo_path, self.last_block()._hash)
+
+        if not self.txindex is None:
+            self.txindex.write(self.txindex.take_pending())
 
 
     def load(self, func=None):
         """Loads the blockchain from metadata and txns. WARNING: overwrites
-        self.chain and clears the unconfirmed blocks
+        self.chain and clears the unconfirmed blocks. All the headers are
+        checked together first (see verify_headers). While the blocks are
+        read, the hash of every block that has its transactions is computed
+        again (see check_pow), and the transactions of the blocks above the
+        assume valid height are checked. Pruned blocks have only their header
+        checked. Loading stops at the first invalid block
 
         Args:
             func (function, optional): The custom function. function needs to
             have 1 parameter for this blockchain instance. Defaults to None.
         """
-        print('BLOCKCHAIN - Loading from disk')
+        log.info('Loading from disk')
         
         if func is None:
 
-            success = False
-            metadata_df = pd.read_csv(f'{self.PATH}//metadata.csv')
-            total_txns_df = pd.read_csv(f'{self.PATH}//txns.csv')
+            self.writer.recover()
+
+            # Timestamps are read exactly, the block hashes depend on them
+            metadata_df = pd.read_csv(f'{self.PATH}//metadata.csv',
+                                      float_precision='round_trip')
+            total_txns_df = pd.read_csv(f'{self.PATH}//txns.csv',
+                                        dtype={'ver': str, 'sender': str})
+
+            # save() writes the genesis block too
+            metadata_df = metadata_df[
+                metadata_df['Hash'] != Constants.GENESIS._hash]
+
+            # The headers are checked before any block is created
+            valid = self.verify_headers(
+                metadata_df['Hash'].values,
+                metadata_df['Last hash'].values,
+                1, Constants.GENESIS._hash)
+
+            if valid < len(metadata_df):
+                log.warning('Stopped loading at block %s, its header is '
+                            'invalid', valid + 1)
+                metadata_df = metadata_df.iloc[:valid]
+
+            # Rows before it were pruned
+            first_row = self.writer.first_row
+            assume_valid_height = self.assume_valid_height()
 
             temp_chain = [Constants.GENESIS]
+            first_body = 0
 
             for i, row in metadata_df.iterrows():
 
@@ -266,24 +673,59 @@ class Blockchain:
                 proof = row['POW']
                 _hash = row['Hash']
 
-                line = row['Line']
+                line = row['Line'] - first_row
                 length = row['Length']
-                txns_df = total_txns_df.iloc[line:line + length + 1]
 
-                txns = []
-                for g, txn_row in txns_df.iterrows():
-                    txns.append(Transaction(txn_row['ver'], txn_row['sender'],
-                                            txn_row['receivers'],
-                                            txn_row['outputs'],
-                                            txn_row['proof']))
+                if line < 0:
+                    txns = None
+                    first_body = len(temp_chain) + 1
+
+                else:
+                    txns_df = total_txns_df.iloc[line:line + length]
+
+                    # The fields are read back as they were sent, so the
+                    # transaction ids stay the same
+                    txns = []
+                    for g, txn_row in txns_df.iterrows():
+                        txns.append(Transaction(txn_row['ver'],
+                                                txn_row['sender'],
+                                                parse_field(txn_row['receivers']),
+                                                parse_field(txn_row['outputs']),
+                                                parse_field(txn_row['proof'])))
 
                 block = Block(last_hash, txns, proof, timestamp, _hash)
-                self.add_block(block, is_confirmed=True, other_chain=temp_chain,
-                               update_file=False)
 
-            # Keep unconfirmed blocks if the hashes match
+                if not txns is None and not check_pow(block, self.difficulty):
+                    log.warning('Stopped loading at block %s, its hash '
+                                'doesnt match its body', len(temp_chain))
+                    break
+
+                if len(temp_chain) > assume_valid_height and not txns is None:
+                    error = check_txns(block)
+                    if not error is None:
+                        log.warning('Stopped loading at block %s: %s',
+                                    len(temp_chain), error)
+                        break
+
+                if not self.add_block(block, is_confirmed=True,
+                                      other_chain=temp_chain,
+                                      update_file=False):
+                    # The rest of the file doesn't continue this chain
+                    log.warning('Stopped loading at block %s', i)
+                    break
+
+            self.chain = temp_chain
+            self.first_body = min(first_body, len(temp_chain))
+            self._load_utxos()
+
+            if not self.txindex is None:
+                self.txindex.load(self.chain)
+                self.txindex.write(self.txindex.take_pending())
+                self._index_written = self.txindex.height
+
+            # Keep unconfirmed blocks only if they continue the loaded chain
             if not self.unconfirmed is None and \
-                    self.last_block(confirmed=True)._hash == self.unconfirmed.data.last_hash:
+                    self.last_block(confirmed=True)._hash != self.unconfirmed.data.last_hash:
                 self.unconfirmed = None
                 
             return True if len(temp_chain) > 1 else False
@@ -291,26 +733,304 @@ class Blockchain:
         else:
             func(self)
 
-    def _update_file(self, block):
+    def _connect(self, block: Block):
+        """Updates the state that follows the confirmed chain with a block
+        that was appended to it
 
-        print('BLOCKCHAIN - Updating blockchain on disk')
-        
-        txns_df = pd.read_csv(f'{self.PATH}//txns.csv')
-        
-        block_metadata_df = pd.DataFrame([block.metadata + 
-                                          (txns_df.shape[0] +
-                                           1, len(block.txns))])
-        
-        block_txns_df = pd.DataFrame(block.txns)
+        Args:
+            block (Block): The block, the last block of the chain
+        """
+
+        index = len(self.chain) - 1
+        self._undo.append(self.utxos.apply_block(index, block))
+        self._heights[block._hash] = index
+
+        if not self.txindex is None:
+            self.txindex.connect_block(index, block)
+
+        if self.listeners:
+            self._notify('block_connected', index, block)
+
+        size = _body_size(block)
+        self._body_sizes.append(size)
+        self.body_bytes += size
+
+    def _disconnect(self, fork: int, update_file: bool) -> List[Block]:
+        """Removes the confirmed blocks after the fork point, last block
+        first, and reverts the state that follows the chain
+
+        Args:
+            fork (int): The index of the last block that stays
+            update_file (bool): Remove the blocks from the disk too
+
+        Returns:
+            List[Block]: The removed blocks, in chain order
+        """
+
+        blocks = self.chain[fork + 1:]
+
+        for index in range(len(self.chain) - 1, fork, -1):
+            block = self.chain.pop()
+            self.utxos.undo_block(index, block, self._undo.pop())
+            del self._heights[block._hash]
+            self.body_bytes -= self._body_sizes.pop()
+
+            if not self.txindex is None:
+                self.txindex.disconnect_block(index, block)
+
+            if self.listeners:
+                self._notify('block_disconnected', index, block)
+
+        if not self.txindex is None:
+            self._index_written = min(self._index_written, self.txindex.height)
+
+        if update_file and blocks:
+            future = self.io.submit(self.writer.rewind, blocks,
+                                    self.chain[fork]._hash)
+            future.add_done_callback(storage._report_error)
+
+        return blocks
+
+    def subscribe(self, listener):
+        """Registers an object that follows the confirmed chain, like a
+        wallet. The listener is first synced with sync(blockchain), then gets
+        called for every change, with only the transactions of its addresses
+        (listener.addresses()):
+
+        - block_connected(index, block, txns) when a block is added to the
+          confirmed chain
+        - block_disconnected(index, block, txns) when the last confirmed block
+          is removed
+        - unconfirmed_changed(blocks) with the best unconfirmed branch, as
+          tuples of (block, txns), whenever the unconfirmed tree changes
+
+        txns is a list of (index in the block, transaction).
+
+        Args:
+            listener: The listener
+        """
+
+        listener.sync(self)
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, event: str, index: int, block: Block):
+
+        touched = _addresses(block)
+
+        for listener in self.listeners:
+            getattr(listener, event)(index, block,
+                                     _filter(block, touched, listener.addresses()))
+
+    def _notify_unconfirmed(self):
+
+        if not self.listeners:
+            return
+
+        if self.unconfirmed is None:
+            branch = []
+        else:
+            branch = [node.data for node in longest_path(self.unconfirmed)]
+
+        touched = [_addresses(block) for block in branch]
+
+        for listener in self.listeners:
+            addrs = listener.addresses()
+            listener.unconfirmed_changed(
+                [(block, _filter(block, t, addrs))
+                 for block, t in zip(branch, touched)])
+
+    def _load_utxos(self):
+        """Sets the unspent outputs of the loaded chain. Starts from the
+        saved set if it belongs to this chain, and applies the blocks after
+        it. A pruned chain can't be applied from the start, so it needs the
+        saved set
+        """
+
+        utxos, tip_hash = UTXOSet.load(self.utxo_path)
+
+        if utxos is None or \
+                not self.first_body <= utxos.height <= len(self.chain) or \
+                self.chain[utxos.height - 1]._hash != tip_hash:
+
+            if self.first_body > 0:
+                log.error('The unspent outputs of the pruned chain are missing, '
+                          'delete the blockchain directory to download it again')
+                utxos = UTXOSet()
+                utxos.height = len(self.chain)
+            else:
+                utxos = UTXOSet()
+
+        # Only blocks that are applied here can be disconnected later
+        self._undo.clear()
+        for i in range(utxos.height, len(self.chain)):
+            self._undo.append(utxos.apply_block(i, self.chain[i]))
+
+        self.utxos = utxos
+        self._heights = {block._hash: i for i, block in enumerate(self.chain)}
+        self.side = {}
+        self._body_sizes = deque(_body_size(block)
+                                 for block in self.chain[self.first_body:])
+        self.body_bytes = sum(self._body_sizes)
+
+    def prune(self, force: bool=False):
+        """Drops the transactions of old confirmed blocks when the node is
+        in pruning mode, keeping their headers. The unspent outputs are saved
+        and the old rows of txns.csv are deleted in the writer's thread
+
+        Args:
+            force (bool, optional): Prune even if only a few blocks can be
+            pruned. Defaults to False.
+        """
+
+        target = self._prune_target()
+
+        if target <= self.first_body or \
+                (target - self.first_body < PRUNE_STEP and not force):
+            return
+
+        for i in range(self.first_body, target):
+            block = self.chain[i]
+            self.chain[i] = Block(block.last_hash, None, block.proof,
+                                  block.timestamp, block._hash)
+            self.body_bytes -= self._body_sizes.popleft()
+
+        self.first_body = target
+        log.info('Pruned the transactions of blocks before %s', target)
 
-        block_metadata_df.to_csv(f'{self.PATH}//metadata.csv',
-                                 mode='a',
-                                 header=not os.path.exists(f'{self.PATH}//metadata.csv'),
-                                 index=False)
-        block_txns_df.to_csv(f'{self.PATH}//txns.csv',
-                             mode='a',
-                             header=not os.path.exists(f'{self.PATH}//txns.csv'),
-                             index=False)
+        future = self.io.submit(self._prune_files, self.utxos.copy(),
+                                self.last_block()._hash,
+                                self.chain[target]._hash)
+        future.add_done_callback(storage._report_error)
+
+    def _prune_files(self, utxos: UTXOSet, tip_hash: str, first_hash: str):
+
+        # Without the transactions, the outputs can't be found again
+        utxos.save(self.utxo_path, tip_hash)
+        self.writer.prune(first_hash)
+
+    def _prune_target(self) -> int:
+        """Finds the first block that should keep its transactions
+
+        Returns:
+            int: The index of the block in the chain
+        """
+
+        target = self.first_body
+
+        if not self.prune_blocks is None:
+            target = max(target, len(self.chain) - self.prune_blocks)
+
+        if not self.prune_bytes is None:
+            excess = self.body_bytes - self.prune_bytes
+            i = 0
+            while excess > 0 and i < len(self._body_sizes):
+                excess -= self._body_sizes[i]
+                i += 1
+
+            target = max(target, self.first_body + i)
+
+        return min(target, len(self.chain) - MIN_BODIES)
+
+    def serveable(self) -> Tuple[int, int]:
+        """Returns the heights of the blocks that still have their
+        transactions and can be sent to other nodes
+
+        Returns:
+            Tuple[int, int]: The first and last height
+        """
+        return self.first_body + 1, self.height()
+
+    def get_txn(self, txid: str) -> Optional[Tuple[Transaction, int, int]]:
+        """Finds a confirmed transaction by its id. Uses the transaction
+        index when it is enabled, otherwise searches the chain from the end
+
+        Args:
+            txid (str): The transaction id (see block.txn_hash)
+
+        Returns:
+            Optional[Tuple[Transaction, int, int]]: The transaction, the index
+            of its block in the chain and its index in the block. The
+            transaction is None if the block was pruned. None if not found
+        """
+
+        if not self.txindex is None:
+            location = self.txindex.find(txid)
+            if location is None:
+                return None
+
+            b, t = location
+            txns = self.chain[b].txns
+            return (None if txns is None else txns[t]), b, t
+
+        for b in range(len(self.chain) - 1, self.first_body - 1, -1):
+            for t, txn in enumerate(self.chain[b].txns):
+                if txn_hash(txn) == txid:
+                    return txn, b, t
+
+        return None
+
+    def get_address(self, addr: str) -> Optional[dict]:
+        """Returns the history of an address from the transaction index
+
+        Args:
+            addr (str): The address
+
+        Returns:
+            Optional[dict]: The ids of the transactions it sent or received
+            ('txids'), the outputs it received ('outpoints') and the unspent
+            ones with their amounts ('unspent'). None if the index isn't
+            enabled
+        """
+
+        if self.txindex is None:
+            return None
+
+        outpoints = self.txindex.outpoints(addr)
+        unspent = [(outpoint, self.utxos.get(outpoint)[1])
+                   for outpoint in outpoints if outpoint in self.utxos]
+
+        return {'txids': self.txindex.txids(addr), 'outpoints': outpoints,
+                'unspent': unspent}
+
+    def _write(self, block):
+        """Queues a confirmed block to be written to the disk
+
+        Args:
+            block (Block): The block
+        """
+        self.writer.append(block)
+
+        # The index is written in batches too. If it's behind after a crash,
+        # load indexes the missing blocks again
+        if not self.txindex is None and \
+                self.txindex.height - self._index_written >= self.writer.batch_size:
+            self._index_written = self.txindex.height
+            future = self.io.submit(self.txindex.write,
+                                    self.txindex.take_pending())
+            future.add_done_callback(storage._report_error)
+
+    def flush(self):
+        """Blocks until all the queued writes are on the disk. Run it in an
+        executor when called from the event loop
+        """
+        self.writer.flush()
+
+    def close(self):
+        """Writes the queued blocks and stops the writer thread
+        """
+
+        self.writer.close()
+
+        # After the blocks, so the saved outputs never get ahead of the files
+        if self.first_body > 0:
+            self.utxos.save(self.utxo_path, self.last_block()._hash)
+
+        if not self.txindex is None:
+            self.txindex.write(self.txindex.take_pending())
 
     def last_block(self, confirmed: bool=True):
         """Return the last block of the blockchain. if confirmed is set to false
@@ -341,9 +1061,12 @@ class Blockchain:
             Block: The block that was found. returns None if not found
         """
 
-        for block in self.chain:
-            if block._hash == _hash:
-                return block
+        index = self._heights.get(_hash)
+        if not index is None:
+            return self.chain[index]
+
+        if _hash in self.side:
+            return self.side[_hash][0]
 
         found, block = treenode.findattr(_hash, '_hash', self.unconfirmed, )
 
@@ -369,3 +1092,35 @@ class Blockchain:
                 return len(self.chain)
         else:
             return len(self.chain)
+
+
+def _body_size(block: Block) -> int:
+    # About the size of the block's rows in txns.csv
+    return 0 if block.txns is None else len(str(block.txns))
+
+
+def _addresses(block: Block) -> dict:
+    """Finds the transactions of every address in a block
+
+    Returns:
+        dict: The indexes of the transactions by address
+    """
+
+    touched = {}
+    for t, txn in enumerate(block.txns):
+        for addr in [txn[1]] + [addr for addr, _ in receivers(txn)]:
+            if not isinstance(addr, str):
+                continue
+
+            indexes = touched.setdefault(addr, [])
+            if not indexes or indexes[-1] != t:
+                indexes.append(t)
+
+    return touched
+
+
+def _filter(block: Block, touched: dict, addrs) -> list:
+    # The transactions of the block that belong to the given addresses
+    indexes = sorted({t for addr, ts in touched.items() if addr in addrs
+                      for t in ts})
+    return [(t, block.txns[t]) for t in indexes]
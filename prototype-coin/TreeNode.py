@@ -210,13 +210,22 @@ def insert(data, root, new_data=None, i=0):
 
 
 def get_end_children(node, i=0):
+    """Returns the leaves of the tree
+
+    Args:
+        node (TreeNode): The root of the tree
+        i (int, optional): Used for recursion. do not use.
+
+    Returns:
+        list: The leaves
+    """
     if not node.children:
         return [node]
 
     elif len(node.children) == 1:
         return get_end_children(node.children[0])
 
-    elif i == len(root.children):
+    elif i == len(node.children):
         return []
 
     else:
@@ -224,6 +233,27 @@ def get_end_children(node, i=0):
             get_end_children(node, i + 1)
 
 
+def longest_path(root):
+    """Returns the nodes on the path from the root to its deepest leaf
+
+    Args:
+        root (TreeNode): The root of the tree
+
+    Returns:
+        list: The nodes, starting with the root
+    """
+
+    leaf = max(get_end_children(root), key=lambda node: node.get_level())
+
+    path = []
+    while leaf is not root:
+        path.append(leaf)
+        leaf = leaf.parent
+    path.append(root)
+
+    return path[::-1]
+
+
 if __name__ == '__main__':
 
     root = TreeNode('noam')
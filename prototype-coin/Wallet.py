@@ -1,6 +1,8 @@
+import csv
 import hashlib
 import hmac
 import json
+import os
 import random
 from binascii import hexlify
 
@@ -8,46 +10,63 @@ import bip32utils
 from mnemonic import Mnemonic
 
 from block import ClsEncoder, Transaction
+from coins import CoinPool
+from keystore import CHANGE, RECEIVE, Keystore
+from utxo import receivers, spent_outpoints
+
+MAX_UNDO = 100  # Blocks the wallet can undo without a rescan
 
 
 class Wallet:
 
-    def __init__(self, mnemonic_words=None):
+    def __init__(self, mnemonic_words=None, state_path=None):
         """Class for handling the hd wallet. Currently uses bip39 standard with
-        only 1 account and no categories.
+        a single account. The keys are kept in a keystore (see Keystore) that
+        derives receive and change addresses when they are needed. The main
+        address (addr) is the first receive address, m/44'/69420'/0'/0/0.
         generates an hd wallet with on the coin's network
 
+        The wallet follows the blockchain when it is subscribed to it (see
+        Blockchain.subscribe). Its outputs and sync height can be saved to
+        state_path, so after a restart only the new blocks are scanned.
+
         Args:
             mnemonic_words (str): mnomic words to make the keys from
-        """
 
-        mnemonic = Mnemonic("english")
+            state_path (str, optional): A csv file to keep the synced outputs
+            in. Defaults to None (not persisted).
+        """
 
         if mnemonic_words is None:
-            mnemonic_words = mnemonic.generate(strength=256)
-
-        seed = mnemonic.to_seed(mnemonic_words)
+            mnemonic_words = Mnemonic("english").generate(strength=256)
 
-        # DO NOT share this key
-        master_key = bip32utils.BIP32Key.fromEntropy(seed)
+        self.words = mnemonic_words
+        self.keystore = Keystore.from_words(mnemonic_words)
 
-        # This is the master key in path m/44'/69420'/0'/0
-        master_coin_key = master_key.ChildKey(
-            44 + bip32utils.BIP32_HARDEN
-        ).ChildKey(
-            69420 + bip32utils.BIP32_HARDEN
-        ).ChildKey(
-            0 + bip32utils.BIP32_HARDEN
-        ).ChildKey(0).ChildKey(0)
+        master_coin_key = self.keystore.key(RECEIVE, 0)
+        self.keystore.mark_used(master_coin_key.Address())
 
-        self.words = mnemonic_words
         self.addr = master_coin_key.Address()
         self.pub_k = hexlify(master_coin_key.PublicKey()).decode()
         # Private key is in wif (Wallet import format)
         self.priv_k = master_coin_key.PrivateKey()
         self.wif = master_coin_key.WalletImportFormat()
 
-        self.utxos = list()
+        # All the coins, and the coins of every address. A transaction has a
+        # single sender, so it spends the coins of one address
+        self.utxos = CoinPool()
+        self.pools = {}
+        self.coin_addrs = {}
+
+        # Blocks of the confirmed chain the outputs were synced with
+        self.sync_height = 0
+        self.sync_hash = None
+        self.pending = 0    # Amount received in the best unconfirmed blocks
+        self._undo = {}     # Outputs every recent block added and spent
+
+        self.state_path = state_path
+        if not state_path is None:
+            self.load_state()
 
     def __repr__(self):
         return f'Wallet({self.words}, {self.addr}, {self.pub_k}, {self.priv_k})'
@@ -55,18 +74,269 @@ class Wallet:
     def __str__(self):
         return json.dumps(self, ensure_ascii=False, indent=4, cls=ClsEncoder)
 
+    def json(self):
+        return {'addr': self.addr, 'pub_k': self.pub_k,
+                'xpub': self.keystore.xpub, 'balance': self.get_balance(),
+                'utxos': list(self.utxos), 'sync_height': self.sync_height}
+
+    def addresses(self):
+        """Returns the addresses of the wallet, including unused addresses up
+        to the gap limit. Checking if an address is in it is O(1)
+
+        Returns:
+            KeysView: The addresses
+        """
+        return self.keystore.addresses()
+
+    def new_address(self, change=False):
+        """Returns a new address to receive coins to
+
+        Args:
+            change (bool, optional): Use the change chain. Defaults to False.
+
+        Returns:
+            str: The address
+        """
+        return self.keystore.new_address(CHANGE if change else RECEIVE)
+
+    def _add_coin(self, outpoint, addr, amount):
+
+        if not self.utxos.add(outpoint, amount):
+            return False
+
+        outpoint = tuple(outpoint)
+        self.coin_addrs[outpoint] = addr
+        self.pools.setdefault(addr, CoinPool()).add(outpoint, amount)
+        self.keystore.mark_used(addr)
+        return True
+
+    def _remove_coin(self, outpoint):
+        """Removes a coin
+
+        Args:
+            outpoint (Outpoint): The coin's outpoint
+
+        Returns:
+            tuple: The coin's address and amount. None if it isn't in the
+            wallet
+        """
+
+        outpoint = tuple(outpoint)
+        amount = self.utxos.remove(outpoint)
+        if amount is None:
+            return None
+
+        addr = self.coin_addrs.pop(outpoint)
+        self.pools[addr].remove(outpoint)
+        return addr, amount
+
+    def _clear_coins(self):
+        self.utxos.clear()
+        self.pools.clear()
+        self.coin_addrs.clear()
+
     def update_utxo(self, blockchain):
         """Get all the unspent transaction token from the blockchain.
         WARNING: might be very slow when the blockchain gets big. It is 
         recommended to use it only once when you reuse a wallet's 
-        private key/mnemonic words
+        private key/mnemonic words. To keep the wallet up to date use 
+        Blockchain.subscribe
 
         Args:
             blockchain (Blockchain): The blockchain to retrieve the utxos from
         """
-        utxo = blockchain.find_txns(self.addr)
 
-    def sign(self, data):
+        self._clear_coins()
+        self._undo.clear()
+
+        # Finding coins on an address derives more addresses (the gap limit),
+        # so search until no new addresses show up
+        checked = set()
+        while len(checked) < len(self.addresses()):
+            addrs = [addr for addr in self.addresses() if not addr in checked]
+            checked.update(addrs)
+
+            if blockchain.txindex is None:
+                # Without a transaction index, search the chain's unspent
+                # outputs
+                addrs = set(addrs)
+                for outpoint, (addr, amount) in blockchain.utxos.utxos.items():
+                    if addr in addrs:
+                        self._add_coin(outpoint, addr, amount)
+                continue
+
+            for addr in addrs:
+                for outpoint, amount in blockchain.get_address(addr)['unspent']:
+                    self._add_coin(outpoint, addr, amount)
+
+        self._synced(blockchain.height(), blockchain.last_block()._hash)
+
+    def set_coins(self, coins, height, block_hash):
+        """Replaces the outputs with outputs that were fetched from a node,
+        for wallets that don't follow a local blockchain (like the gui)
+
+        Args:
+            coins (list): The unspent outputs as (outpoint, addr, amount)
+            height (int): The height of the node's chain
+            block_hash (str): The hash of the node's last block
+        """
+
+        self._clear_coins()
+        self._undo.clear()
+
+        for outpoint, addr, amount in coins:
+            self._add_coin(outpoint, addr, amount)
+
+        self._synced(height, block_hash)
+
+    def sync(self, blockchain):
+        """Brings the outputs up to date with the blockchain. Only the blocks
+        after the sync height are scanned, unless the chain changed under the
+        saved state
+
+        Args:
+            blockchain (Blockchain): The blockchain
+        """
+
+        height = self.sync_height
+
+        if height == 0 or height > blockchain.height() or \
+                blockchain.chain[height - 1]._hash != self.sync_hash or \
+                height < blockchain.first_body:
+            return self.update_utxo(blockchain)
+
+        addrs = self.addresses()
+        for index in range(height, blockchain.height()):
+            block = blockchain.chain[index]
+            txns = [(t, txn) for t, txn in enumerate(block.txns)
+                    if _touches(txn, addrs)]
+            self.block_connected(index, block, txns)
+
+    def block_connected(self, index, block, txns):
+        """Updates the outputs with a block that was added to the confirmed
+        chain. Called by the blockchain
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+            txns (list): The transactions of this wallet's addresses as tuples
+            of (index in the block, transaction)
+        """
+
+        addrs = self.addresses()
+        added = []
+        spent = []
+
+        for t, txn in txns:
+            for outpoint in spent_outpoints(txn):
+                coin = self._remove_coin(outpoint)
+                if not coin is None:
+                    spent.append((outpoint, *coin))
+
+            for o, (addr, amount) in enumerate(receivers(txn)):
+                if addr in addrs and self._add_coin((index, t, o), addr, amount):
+                    added.append((index, t, o))
+
+        self._undo[index] = (added, spent)
+        self._undo.pop(index - MAX_UNDO, None)
+        self._synced(index + 1, block._hash)
+
+    def block_disconnected(self, index, block, txns):
+        """Reverts block_connected when the last confirmed block is removed
+        from the chain in a reorganization. Called by the blockchain
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+            txns (list): The transactions of this wallet's addresses
+        """
+
+        undo = self._undo.pop(index, None)
+
+        if undo is None:
+            # Too old to undo, update_utxo runs on the next sync
+            self._synced(0, None)
+            return
+
+        added, spent = undo
+        for outpoint in added:
+            self._remove_coin(outpoint)
+
+        for outpoint, addr, amount in spent:
+            self._add_coin(outpoint, addr, amount)
+
+        self._synced(index, block.last_hash)
+
+    def unconfirmed_changed(self, blocks):
+        """Updates the pending amount from the best branch of unconfirmed
+        blocks. Computed again on every change, so forks of the unconfirmed
+        blocks never leave wrong amounts. Called by the blockchain
+
+        Args:
+            blocks (list): Tuples of (block, transactions of this wallet)
+        """
+
+        addrs = self.addresses()
+        self.pending = sum(amount for block, txns in blocks
+                           for t, txn in txns
+                           for addr, amount in receivers(txn)
+                           if addr in addrs and txn[1] not in addrs)
+
+    def _synced(self, height, block_hash):
+        self.sync_height = height
+        self.sync_hash = block_hash
+
+    def save_state(self):
+        """Writes the outputs and the sync height to state_path. The file is
+        replaced atomically
+        """
+
+        if self.state_path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        temp_path = f'{self.state_path}.tmp'
+
+        with open(temp_path, 'w', newline='') as f:
+            f.write(f'{self.sync_height},{self.sync_hash},'
+                    f'{self.keystore.used[RECEIVE]},{self.keystore.used[CHANGE]}\n')
+            writer = csv.writer(f)
+            writer.writerow(['block', 'txn', 'output', 'addr', 'amount'])
+            writer.writerows((*outpoint, self.coin_addrs[outpoint], amount)
+                             for outpoint, amount in self.utxos.coins.items())
+
+        os.replace(temp_path, self.state_path)
+
+    def load_state(self) -> bool:
+        """Reads the outputs and the sync height from state_path
+
+        Returns:
+            bool: True if the state was found
+        """
+
+        try:
+            with open(self.state_path, newline='') as f:
+                height, block_hash, *used = f.readline().strip().split(',')
+                coins = [((int(row['block']), int(row['txn']),
+                           int(row['output'])), row['addr'], int(row['amount']))
+                         for row in csv.DictReader(f)]
+
+        except (FileNotFoundError, KeyError, ValueError):
+            return False
+
+        # Derive the addresses that were used before
+        for chain, i in zip((RECEIVE, CHANGE), used):
+            if int(i) >= 0:
+                self.keystore.mark_used(self.keystore.address(chain, int(i)))
+
+        self._clear_coins()
+        for outpoint, addr, amount in coins:
+            self._add_coin(outpoint, addr, amount)
+
+        self._synced(int(height), block_hash)
+        return True
+
+    def sign(self, data, addr=None):
         """Sign the given data using the wallet's private key. meant to be an
         internal function
 
@@ -74,15 +344,21 @@ class Wallet:
         Args:
             data (str): the data to be signed
 
+            addr (str, optional): Sign with the key of this address. Defaults
+            to the main address.
+
         Returns:
             string: the signature of the given data in hexadecimal format
         """
-        return hmac.new(self.priv_k, data.encode(), hashlib.sha256).hexdigest()
 
-    def send(self, fee, *recv_addrs):
+        priv_k = self.priv_k if addr is None else \
+            self.keystore.key_of(addr).PrivateKey()
+        return sign_data(priv_k, data)
+
+    def send(self, fee, *recv_addrs, sender=None):
         """Creates a new transaction to send other nodes. If the outputs are
-        bigger than the value to be send, the change is sent back to the wallet
-        as a new output
+        bigger than the value to be send, the change is sent to a new change
+        address of the wallet as a new output
 
         Args:
             fee (int): the amount of coins to leave as a fee
@@ -90,9 +366,12 @@ class Wallet:
             *recv_addrs (tuple): tuples containing addresses to send to with 
             the amount specified
 
+            sender (str, optional): The address to spend the coins of.
+            Defaults to the address with the smallest balance that is enough.
+
         Raises:
             NotEnoughFundsError: This means the user tried to send more funds 
-            than he has in his wallet
+            than he has in his wallet, or in a single address
 
         Returns:
             namedtuple(Transaction): The newly created transaction
@@ -101,45 +380,112 @@ class Wallet:
         if isinstance(recv_addrs[0], list):
             recv_addrs = tuple(recv_addrs[0])
 
+        draft = self.draft(fee, recv_addrs, sender)
+
+        return draft.finish(self.sign(draft.data, draft.sender),
+                            self.public_key(draft.sender))
+
+    def draft(self, fee, recv_addrs, sender=None):
+        """Chooses the coins of a transaction and removes them from the
+        wallet, so they are reserved for it. The transaction still needs to be
+        signed (see Draft). Used by send and by batches of payouts
+
+        Args:
+            fee (int): the amount of coins to leave as a fee
+
+            recv_addrs (tuple): tuples containing addresses to send to with
+            the amount specified
+
+            sender (str, optional): The address to spend the coins of.
+            Defaults to the address with the smallest balance that is enough.
+
+        Raises:
+            NotEnoughFundsError: No address has enough coins
+
+        Returns:
+            Draft: The unsigned transaction
+        """
+
+        recv_addrs = tuple(tuple(addr) for addr in recv_addrs)
+
         # Check if user has enough balance
         total = 0
         for addr in recv_addrs:
             total += addr[1]
 
-        if total > self.get_balance():
+        if sender is None:
+            sender = self._choose_sender(total + fee)
+
+        pool = self.pools.get(sender)
+        coins = None if pool is None else pool.select(total + fee)
+        if coins is None:
             raise NotEnoughFundsError
 
         ver = '0.1'
 
-        # TODO: Create better algorithm for choosing the right utxos
+        # Create a list of outputs that will be used
         outputs = []
         output_val = 0
+        for amount, outpoint in coins:
+            self._remove_coin(outpoint)
+            outputs.append(outpoint)
+            output_val += amount
 
-        utxos_temp = self.utxos.copy()
-        for utxo in utxos_temp:
-
-            output_val += utxo[-1]
-            # Create a list of outputs that will be used
-            outputs.append((utxo[:-1]))
-            self.utxos.pop(0)
-
-            if output_val > total + fee:
-                # Add the remainder as a new output
-                recv_addrs += ((self.addr, output_val - total - fee), )
-                break
-            elif output_val == total + fee:
-                break
+        if output_val > total + fee:
+            # Add the remainder as a new output
+            recv_addrs += ((self.new_address(change=True),
+                            output_val - total - fee), )
 
         if fee > 0:
             recv_addrs += (('FEES', fee), )
 
-        # To keep transaction signature consistent, we add fees even if its 0
-        signature = self.sign(f"{ver}{self.addr}{recv_addrs}{outputs}")
-        proof = (self.pub_k, signature)
+        return Draft(ver, sender, recv_addrs, outputs,
+                     [(outpoint, sender, amount) for amount, outpoint in coins])
 
-        txn = Transaction(ver, self.addr, recv_addrs, outputs, proof)
+    def release(self, draft):
+        """Gives the coins of a draft back to the wallet, when its transaction
+        won't be sent
 
-        return txn
+        Args:
+            draft (Draft): The draft
+        """
+
+        for outpoint, addr, amount in draft.coins:
+            self._add_coin(outpoint, addr, amount)
+
+    def public_key(self, addr=None):
+        """Returns the public key of an address in hexadecimal format
+
+        Args:
+            addr (str, optional): The address. Defaults to the main address.
+
+        Returns:
+            str: The public key
+        """
+
+        if addr is None or addr == self.addr:
+            return self.pub_k
+
+        return hexlify(self.keystore.key_of(addr).PublicKey()).decode()
+
+    def _choose_sender(self, target):
+        """Chooses the address to pay from: the one with the smallest balance
+        that is enough, to leave big balances for big payments
+
+        Args:
+            target (int): The amount to pay, including the fee
+
+        Returns:
+            str: The address. The main address if no address has enough
+        """
+
+        senders = [addr for addr, pool in self.pools.items()
+                   if pool.balance >= target]
+
+        if not senders:
+            return self.addr
+
+        return min(senders, key=lambda addr: self.pools[addr].balance)
 
     def debug_send(self, fee, *recv_addrs):
         """same as send but for debugging purposes. Generates Transactions with
@@ -168,42 +514,102 @@ class Wallet:
 
         return txn
 
-    def debug_generate_outputs(self, amount, outputs):
+    def debug_generate_outputs(self, amount, outputs, addr=None):
         """Generates fake outputs. do not use in a real wallet. Created for
         debugging purposes
 
         Args:
             amount (int): total amount of money
             outputs (int): number of outputs to divide to
+            addr (str, optional): The address of the outputs. Defaults to the
+            main address.
         """
 
+        if addr is None:
+            addr = self.addr
+
+        def random_outpoint():
+            # Outpoints are unique, so pick again if it's taken
+            while True:
+                outpoint = (random.randint(0, 100), random.randint(0, 100),
+                            random.randint(0, 100))
+                if not outpoint in self.utxos:
+                    return outpoint
+
         # Remainder
         if not amount % outputs == 0:
-            block = random.randint(0, 100)
-            txn_id = random.randint(0, 100)
-            output_id = random.randint(0, 100)
-            self.utxos.append((block, txn_id, output_id, amount % outputs))
+            self._add_coin(random_outpoint(), addr, amount % outputs)
             amount -= amount % outputs
             outputs -= 1
 
         for _ in range(outputs):
-            block = random.randint(0, 100)
-            txn_id = random.randint(0, 100)
-            output_id = random.randint(0, 100)
-            self.utxos.append(
-                (block, txn_id, output_id, int(amount / outputs)))
+            self._add_coin(random_outpoint(), addr, int(amount / outputs))
 
     def get_balance(self):
-        """Sums all the Unspent transaction token to check the wallet's balance
+        """Returns the wallet's balance, the sum of its unspent transaction
+        outputs. Kept up to date by the coin pool
 
         Returns:
             int: The account balance
         """
+        return self.utxos.balance
+
+
+class Draft:
+
+    def __init__(self, ver, sender, receivers, outputs, coins):
+        """A transaction whose coins were chosen and reserved, but that isn't
+        signed yet
+
+        Args:
+            ver (str): The transaction version
+            sender (str): The address that pays
+            receivers (tuple): The receivers, with the change and the fee
+            outputs (list): The outpoints it spends
+            coins (list): The spent coins as (outpoint, address, amount), to
+            give them back if the transaction is dropped
+        """
+
+        self.ver = ver
+        self.sender = sender
+        self.receivers = receivers
+        self.outputs = outputs
+        self.coins = coins
+
+        # To keep transaction signature consistent, we add fees even if its 0
+        self.data = f"{ver}{sender}{receivers}{outputs}"
+
+    def finish(self, signature, pub_k):
+        """Creates the signed transaction
+
+        Args:
+            signature (str): The signature of data
+            pub_k (str): The sender's public key
+
+        Returns:
+            Transaction: The transaction
+        """
+        return Transaction(self.ver, self.sender, self.receivers, self.outputs,
+                           (pub_k, signature))
+
+
+def sign_data(priv_k, data):
+    """Signs data with a private key. Wallet.sign and the payout signing
+    processes both sign with it
+
+    Args:
+        priv_k (bytes): The private key
+
+        data (str): The data to be signed
+
+    Returns:
+        string: The signature in hexadecimal format
+    """
+    return hmac.new(priv_k, data.encode(), hashlib.sha256).hexdigest()
+
 
-        bal = 0
-        for txn in self.utxos:
-            bal += txn[3]
-        return bal
+def _touches(txn, addrs) -> bool:
+    return txn[1] in addrs or any(addr in addrs for addr, _ in receivers(txn))
 
 
 class NotEnoughFundsError(Exception):
@@ -0,0 +1,204 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utxo import Outpoint
+
+Coin = Tuple[int, Outpoint]     # (amount, outpoint)
+
+MAX_BNB_CANDIDATES = 200    # The largest coins below the target that BnB tries
+MAX_BNB_TRIES = 100000      # Branches BnB visits before giving up
+
+
+class CoinPool:
+
+    def __init__(self):
+        """The unspent outputs of a wallet, kept sorted by amount with a
+        running balance, so coins can be selected without scanning all of
+        them.
+
+        Attributes:
+            coins (Dict[Outpoint, int]): The amount of every outpoint
+
+            balance (int): The sum of all the amounts
+        """
+
+        self.coins: Dict[Outpoint, int] = {}
+        self.balance = 0
+        self._sorted: List[Coin] = []
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __contains__(self, outpoint: Outpoint):
+        return outpoint in self.coins
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, int]]:
+        # In the old (block, txn, output, amount) format
+        for amount, outpoint in self._sorted:
+            yield (*outpoint, amount)
+
+    def json(self):
+        return list(self)
+
+    def add(self, outpoint: Outpoint, amount: int) -> bool:
+        """Adds an unspent output
+
+        Args:
+            outpoint (Outpoint): The output
+            amount (int): Its amount
+
+        Returns:
+            bool: False if the output was already in the pool
+        """
+
+        outpoint = tuple(outpoint)
+        if outpoint in self.coins:
+            return False
+
+        self.coins[outpoint] = amount
+        self.balance += amount
+        insort(self._sorted, (amount, outpoint))
+        return True
+
+    def remove(self, outpoint: Outpoint) -> Optional[int]:
+        """Removes an output, usually because it was spent
+
+        Args:
+            outpoint (Outpoint): The output
+
+        Returns:
+            Optional[int]: Its amount. None if it wasn't in the pool
+        """
+
+        outpoint = tuple(outpoint)
+        amount = self.coins.pop(outpoint, None)
+        if amount is None:
+            return None
+
+        self.balance -= amount
+        del self._sorted[bisect_left(self._sorted, (amount, outpoint))]
+        return amount
+
+    def clear(self):
+        self.coins.clear()
+        self._sorted.clear()
+        self.balance = 0
+
+    def select(self, target: int, tolerance: int = 0) -> Optional[List[Coin]]:
+        """Chooses coins that add up to at least the target. In order of
+        preference:
+
+        1. A single coin between target and target + tolerance
+        2. The fewest coins that add up to between target and
+           target + tolerance (branch and bound), so there's no change
+        3. The smallest single coin above the target
+        4. The largest coins until the target is reached, with the smallest
+           possible last coin
+
+        Args:
+            target (int): The amount to pay, including the fee
+            tolerance (int, optional): Extra amount that may be spent instead
+            of creating change. Defaults to 0.
+
+        Returns:
+            Optional[List[Coin]]: The coins as (amount, outpoint). None if the
+            balance isn't enough
+        """
+
+        if target <= 0:
+            return []
+
+        if target > self.balance:
+            return None
+
+        # The smallest coin that covers the target
+        i = bisect_left(self._sorted, (target, ))
+        if i < len(self._sorted) and self._sorted[i][0] <= target + tolerance:
+            return [self._sorted[i]]
+
+        selected = self._branch_and_bound(i, target, tolerance)
+        if not selected is None:
+            return selected
+
+        if i < len(self._sorted):
+            return [self._sorted[i]]
+
+        # Largest first, for the fewest inputs. The last coin is swapped for
+        # the smallest coin that still reaches the target, for less change
+        selected = []
+        total = 0
+        for coin in reversed(self._sorted):
+            if total + coin[0] >= target:
+                j = bisect_left(self._sorted, (target - total, ))
+                selected.append(self._sorted[j])
+                return selected
+
+            selected.append(coin)
+            total += coin[0]
+
+        return None
+
+    def _branch_and_bound(self, end: int, target: int,
+                          tolerance: int) -> Optional[List[Coin]]:
+        """Searches the largest coins below the target for the fewest coins
+        that add up to between target and target + tolerance
+
+        Args:
+            end (int): The index of the first coin that isn't below the target
+            target (int): The target
+            tolerance (int): The tolerance
+
+        Returns:
+            Optional[List[Coin]]: The coins, None if not found
+        """
+
+        candidates = self._sorted[max(0, end - MAX_BNB_CANDIDATES):end][::-1]
+        amounts = [amount for amount, _ in candidates]
+
+        # rest[i] is the sum of the amounts from i, to cut hopeless branches
+        rest = [0] * (len(amounts) + 1)
+        for i in range(len(amounts) - 1, -1, -1):
+            rest[i] = rest[i + 1] + amounts[i]
+
+        if rest[0] < target:
+            return None
+
+        best = None
+        selected = []
+        tries = 0
+
+        def search(i, total):
+            nonlocal best, tries
+
+            tries += 1
+            if tries > MAX_BNB_TRIES:
+                return
+
+            if total >= target:
+                if best is None or len(selected) < len(best):
+                    best = selected.copy()
+                return
+
+            # Can't reach the target, or can't beat the best with fewer coins
+            if i == len(amounts) or total + rest[i] < target or \
+                    (not best is None and len(selected) + 1 >= len(best)):
+                return
+
+            if total + amounts[i] <= target + tolerance:
+                selected.append(i)
+                search(i + 1, total + amounts[i])
+                selected.pop()
+
+            # Skipping a coin also skips the coins with the same amount,
+            # they would only give the same sums again
+            j = i + 1
+            while j < len(amounts) and amounts[j] == amounts[i]:
+                j += 1
+            search(j, total)
+
+        search(0, 0)
+
+        if best is None:
+            return None
+
+        return [candidates[i] for i in best]
@@ -0,0 +1,147 @@
+from collections import namedtuple
+from hashlib import sha256
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from block import Block, Transaction, txn_hash
+
+SHORT_ID_LENGTH = 12    # In hex characters (6 bytes)
+
+CompactBlock = namedtuple('CompactBlock', ['timestamp', 'last_hash', 'proof',
+                                           'block_hash', 'short_ids',
+                                           'prefilled'])
+"""Compact block namedtuple. Used to announce a block without sending all of its
+transactions. The receiver rebuilds the block from the transactions in its own
+memory pool and only asks for the transactions it doesn't have.
+
+Args:
+    timestamp, last_hash, proof, block_hash: Same as in BlockMetadata
+
+    short_ids (list): A short id for every transaction in the block, in order
+
+    prefilled (dict): Transactions that are sent in full, by their index in the
+    block. The block reward is always prefilled since no one else has it.
+"""
+
+
+def short_id(txid: str, salt: str) -> str:
+    """Calculates the short id of a transaction. The id is salted with the
+    block hash so collisions can't be made in advance for every block
+
+    Args:
+        txid (str): The transaction id (see block.txn_hash)
+        salt (str): The hash of the block the transaction is in
+
+    Returns:
+        str: The short id
+    """
+    return sha256(f'{salt}{txid}'.encode()).hexdigest()[:SHORT_ID_LENGTH]
+
+
+def is_reward(txn) -> bool:
+    return txn[1] == 'mine'
+
+
+def to_compact(block: Block) -> CompactBlock:
+    """Creates a compact block from a full block
+
+    Args:
+        block (Block): The block
+
+    Returns:
+        CompactBlock: The compact block
+    """
+
+    short_ids = []
+    prefilled = {}
+    for i, txn in enumerate(block.txns):
+        short_ids.append(short_id(txn_hash(txn), block._hash))
+
+        if is_reward(txn):
+            prefilled[i] = list(txn)
+
+    return CompactBlock(block.timestamp, block.last_hash, block.proof,
+                        block._hash, short_ids, prefilled)
+
+
+def to_json(cmpct: CompactBlock) -> dict:
+    cmpct_dict = cmpct._asdict()
+    # Json keys must be strings
+    cmpct_dict['prefilled'] = {str(i): txn for i, txn in cmpct.prefilled.items()}
+    return cmpct_dict
+
+
+def from_json(cmpct_dict: dict) -> CompactBlock:
+    prefilled = {int(i): txn for i, txn in cmpct_dict['prefilled'].items()}
+    return CompactBlock(cmpct_dict['timestamp'],
+                        cmpct_dict['last_hash'],
+                        cmpct_dict['proof'],
+                        cmpct_dict['block_hash'],
+                        cmpct_dict['short_ids'],
+                        prefilled)
+
+
+def reconstruct(cmpct: CompactBlock,
+                txns: Iterable[Transaction]) -> Tuple[List[Optional[Transaction]], List[int]]:
+    """Rebuilds the transactions of a compact block from known transactions
+
+    Args:
+        cmpct (CompactBlock): The compact block
+        txns (Iterable[Transaction]): The known transactions, usually the
+        memory pool and recently received transactions
+
+    Returns:
+        Tuple[List[Optional[Transaction]], List[int]]: The transactions of the
+        block with None in place of the missing ones, and the indexes of the
+        missing transactions
+    """
+
+    wanted = set(cmpct.short_ids)
+    known: Dict[str, Transaction] = {}
+    for txn in txns:
+        sid = short_id(txn_hash(txn), cmpct.block_hash)
+        if sid in wanted:
+            known[sid] = txn
+
+    block_txns = []
+    missing = []
+    for i, sid in enumerate(cmpct.short_ids):
+        txn = cmpct.prefilled.get(i)
+
+        if txn is None:
+            txn = known.get(sid)
+
+        if txn is None:
+            missing.append(i)
+
+        block_txns.append(txn)
+
+    return block_txns, missing
+
+
+def fill(cmpct: CompactBlock, block_txns: List[Optional[Transaction]],
+         fetched: Dict[int, Transaction]) -> Optional[Block]:
+    """Fills the missing transactions and creates the block. The fetched
+    transactions are checked against the short ids of the compact block
+
+    Args:
+        cmpct (CompactBlock): The compact block
+        block_txns (List[Optional[Transaction]]): The result of reconstruct
+        fetched (Dict[int, Transaction]): The missing transactions by index
+
+    Returns:
+        Optional[Block]: The block, or None if a transaction is still missing
+        or doesn't match its short id
+    """
+
+    txns = list(block_txns)
+    for i, txn in fetched.items():
+        if not 0 <= i < len(txns) or \
+                short_id(txn_hash(txn), cmpct.block_hash) != cmpct.short_ids[i]:
+            return None
+        txns[i] = txn
+
+    if None in txns:
+        return None
+
+    return Block(cmpct.last_hash, txns, cmpct.proof,
+                 timestamp=cmpct.timestamp, _hash=cmpct.block_hash)
@@ -1,13 +1,289 @@
+import asyncio
+import logging
 import tkinter as tk
 from tkinter import messagebox
 from turtle import tilt
 
-from wallet import Wallet
+from block import txn_hash
+from wallet import NotEnoughFundsError, Wallet
 from threading import Thread
+from networking.connection import PeerConnection
 import mnemonic
-import websocket
+import websockets
 import pyperclip
-import json
+
+
+log = logging.getLogger(__name__)
+
+class Backend(Thread):
+
+    REFRESH = 5         # Seconds between balance updates
+    RETRY = 3           # Seconds between connection attempts
+    TIMEOUT = 5         # Seconds to wait for a response of the node
+    EXPIRE = 60         # Updates a sent transaction may stay unconfirmed
+
+    # Addresses asked for in a single get_address request, the most the node
+    # answers (see Node.MAX_ADDRESSES)
+    ADDRESS_BATCH = 50
+
+    def __init__(self, app, port=11111):
+        """Does the wallet's work for the gui in a thread of its own, so the
+        window never freezes. The thread runs an event loop that keeps a
+        single connection to the node, sends the queued transactions on it
+        and updates the balance and the confirmations of the sent
+        transactions. The wallet is only used in this thread, and results are
+        given to the window through after() callbacks, since tkinter should
+        only be used from its own thread.
+
+        The node must run with a transaction index (see Node) for the
+        balance to be found.
+
+        Args:
+            app (App): The window
+            port (int, optional): The port of the node. Defaults to 11111.
+
+        Attributes:
+            sent (Dict[str, Tuple[Draft, int, int]]): The drafts of the sent
+            transactions by their id, with their confirmations and the
+            updates they went unconfirmed. Their coins stay reserved until
+            they are confirmed, or given back after EXPIRE updates, when the
+            node has dropped the transaction
+        """
+
+        super().__init__(daemon=True)
+
+        self.app = app
+        self.uri = f'ws://localhost:{port}'
+
+        self.wallet = None
+        self.sent = {}
+
+        self.loop = asyncio.new_event_loop()
+        self._conn = None
+        self._sends = None      # Queue of (address, amount), made in the loop
+        self._refresh = None    # Set to update the balance before REFRESH
+        self._warned = False    # The node's missing index was shown already
+
+    # Called from the window's thread
+
+    def load_wallet(self, words):
+        self._call(self._load_wallet(words))
+
+    def send(self, address, amount, fee=0):
+        self.loop.call_soon_threadsafe(self._sends.put_nowait,
+                                       (address, amount, fee))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _ui(self, func, *args):
+        """Runs func in the window's thread"""
+        self.app.after(0, func, *args)
+
+    # Runs in the backend's thread
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+
+        self._sends = asyncio.Queue()
+        self._refresh = asyncio.Event()
+
+        self.loop.create_task(self._send_loop())
+        self.loop.create_task(self._refresh_loop())
+        self.loop.run_forever()
+
+    async def _load_wallet(self, words):
+
+        # Deriving the keys takes a while, and it shouldn't block the sends
+        # and updates of a wallet that is already loaded
+        wallet = await self.loop.run_in_executor(None, Wallet, words)
+
+        self.wallet = wallet
+        self.sent.clear()
+        self._ui(self.app.wallet_loaded, wallet.addr)
+        self._refresh.set()
+
+    async def _connection(self):
+        """Returns the connection to the node, connecting again if it was
+        closed
+
+        Returns:
+            PeerConnection: The connection. None if the node can't be reached
+        """
+
+        if not self._conn is None and self._conn.is_open:
+            return self._conn
+
+        try:
+            websocket = await websockets.connect(self.uri)
+        except OSError:
+            self._conn = None
+            self._ui(self.app.set_connected, False)
+            return
+
+        self._conn = PeerConnection(websocket, connected=False)
+        self._ui(self.app.set_connected, True)
+        return self._conn
+
+    async def _request(self, command, **params):
+        """Sends a get request to the node
+
+        Returns:
+            dict: The data of the response. None if the node didn't answer or
+            returned an error
+        """
+
+        conn = await self._connection()
+        if conn is None:
+            return
+
+        response = await conn.request({'type': 'get',
+                                       'data': {'command': command, **params}},
+                                      timeout=self.TIMEOUT)
+
+        if not isinstance(response, dict) or response.get('type') != 'okay':
+            return
+
+        return response['data']
+
+    async def _send_loop(self):
+
+        # The loops run as tasks nobody awaits, so an error would stop them
+        # without a word
+        while True:
+            address, amount, fee = await self._sends.get()
+
+            try:
+                await self._send(address, amount, fee)
+            except Exception:
+                log.exception('Failed to send a transaction')
+                self._ui(self.app.show_error, 'Failed to send the transaction.')
+
+    async def _send(self, address, amount, fee):
+
+        if self.wallet is None:
+            self._ui(self.app.show_error, 'Wallet is not set up.')
+            return
+
+        try:
+            draft = self.wallet.draft(fee, ((address, amount), ))
+        except NotEnoughFundsError:
+            self._ui(self.app.show_error, 'Not enough funds.')
+            return
+
+        txn = draft.finish(self.wallet.sign(draft.data, draft.sender),
+                           self.wallet.public_key(draft.sender))
+
+        self.sent[txn_hash(txn)] = (draft, 0, 0)
+
+        conn = await self._connection()
+        if conn is None:
+            self._ui(self.app.show_error, 'Not connected to the node. The '
+                     'transaction will be sent when it connects.')
+
+        while conn is None:
+            await asyncio.sleep(self.RETRY)
+            conn = await self._connection()
+
+        await conn.send({'type': 'post',
+                         'data': {'command': 'post_txn',
+                                  'txn': dict(txn._asdict())}})
+        self._refresh.set()
+
+    async def _refresh_loop(self):
+
+        while True:
+            try:
+                await asyncio.wait_for(self._refresh.wait(), self.REFRESH)
+            except asyncio.TimeoutError:
+                pass
+
+            self._refresh.clear()
+
+            try:
+                if self.wallet is None:
+                    await self._connection()
+                    continue
+
+                await self._update(self.wallet)
+            except Exception:
+                log.exception('Failed to update the wallet')
+
+    async def _update(self, wallet):
+        """Fetches the unspent outputs of the wallet's addresses and the
+        confirmations of the sent transactions, and shows them
+
+        Args:
+            wallet (Wallet): The wallet
+        """
+
+        response = await self._request('get_height')
+        if response is None:
+            return
+
+        height = response['height']
+        response = await self._request('get_hash', height=height)
+        block_hash = None if response is None else response['hash']
+
+        for txid, (draft, confirmations, updates) in list(self.sent.items()):
+            response = await self._request('get_txn', txid=txid)
+            if not response is None:
+                self.sent[txid] = (draft, height - response['height'] + 1, 0)
+            elif updates + 1 < self.EXPIRE:
+                self.sent[txid] = (draft, 0, updates + 1)
+            elif wallet is self.wallet:
+                # The node dropped it (a conflict, a restart), so its coins
+                # can be spent again
+                del self.sent[txid]
+                wallet.release(draft)
+                self._ui(self.app.show_error, f'Transaction {txid[:8]} was '
+                         'not confirmed. Its coins can be spent again.')
+
+        # Coins on an address derive more addresses (the gap limit), so
+        # search until no new addresses show up
+        coins = []
+        checked = set()
+        while len(checked) < len(wallet.addresses()):
+            addrs = [addr for addr in wallet.addresses() if not addr in checked]
+            checked.update(addrs)
+
+            for i in range(0, len(addrs), self.ADDRESS_BATCH):
+                response = await self._request('get_address',
+                                               addrs=addrs[i:i + self.ADDRESS_BATCH])
+                if response is None:
+                    if not self._warned:
+                        self._warned = True
+                        self._ui(self.app.show_error, 'The node did not return '
+                                 'the addresses. Does it have a transaction index?')
+                    return
+
+                for addr, history in response['addresses'].items():
+                    for outpoint, amount in history['unspent']:
+                        coins.append((tuple(outpoint), addr, amount))
+                        wallet.keystore.mark_used(addr)
+
+        self._warned = False
+
+        # The wallet might have been replaced while the requests ran
+        if not wallet is self.wallet:
+            return
+
+        # The coins of transactions that aren't confirmed yet are still
+        # unspent in the chain, but they can't be used again
+        reserved = {tuple(outpoint) for txid, (draft, confirmations, _)
+                    in self.sent.items() if confirmations == 0
+                    for outpoint in draft.outputs}
+        coins = [coin for coin in coins if not coin[0] in reserved]
+
+        wallet.set_coins(coins, height, block_hash)
+
+        confirmations = {txid: confirmations for txid, (_, confirmations, _)
+                         in self.sent.items()}
+        self._ui(self.app.set_balance, wallet.get_balance(), height,
+                 confirmations)
 
 
 class App(tk.Tk):
@@ -15,10 +291,12 @@ class App(tk.Tk):
     def __init__(self, port=11111) -> None:
         super().__init__()
         
-        self.wallet = None
+        self.address = None
         self.port = port
+        self.backend = Backend(self, port)
+        self.connected = False
         
-        self.geometry("450x100")
+        self.geometry("450x125")
         self.title("Digital Wallet")
         self.main_frm = tk.Frame()
         
@@ -33,6 +311,7 @@ class App(tk.Tk):
         self.info_frm = tk.Frame(self)
         self.address_lbl = tk.Label(self.info_frm, text="Address: None")
         self.copy_btn = tk.Button(self.info_frm, text="Copy address", command=lambda: pyperclip.copy(self.address_lbl['text'][9:]))
+        self.status_lbl = tk.Label(self, text="Balance: - | Not connected")
     
         self.top_frm = tk.Frame(self.main_frm)
         self.bottom_frm = tk.Frame(self.main_frm)
@@ -63,11 +342,14 @@ class App(tk.Tk):
         self.copy_btn.pack(side=tk.LEFT, padx=(5, 0), anchor="w")
         
         self.info_frm.pack(side=tk.TOP, padx=10, pady=5, anchor="w")
-        self.main_frm.pack(side=tk.TOP, padx=20, pady=(0, 20))
+        self.main_frm.pack(side=tk.TOP, padx=20, pady=(0, 5))
+        self.status_lbl.pack(side=tk.TOP, padx=10, pady=(0, 10), anchor="w")
     
     def run(self):
         
         self.pack_all()
+        self.backend.start()
+        self.protocol("WM_DELETE_WINDOW", self.close)
         
         def setup():
             try:
@@ -78,8 +360,8 @@ class App(tk.Tk):
                         self.open_mnemonic_window()
                         self.grab_release
                     
-                    self.wallet = Wallet(words)
-                    self.address_lbl.config(text=f"Address: {self.wallet.addr}")
+                    else:
+                        self.load_wallet(words)
             except FileNotFoundError:
                 self.grab_set
                 self.open_mnemonic_window()
@@ -102,25 +384,57 @@ class App(tk.Tk):
         
         if answer == 'yes':
             
-            if self.wallet is None:
+            if self.address is None:
                 messagebox.showerror(title='Error', message="Wallet is not set up.")
                 return
             
+            try:
+                amount = int(amount)
+            except ValueError:
+                messagebox.showerror(title='Error', message="The amount must be a whole number")
+                return
+            
             self.amount_ent.delete(0, 'end')
             self.to_ent.delete(0, 'end')
             
-            txn = self.wallet.debug_send(0, (address, int(amount)))
-            print('Transaction generated. Sending to node...')
+            # Signed and sent by the backend, the window doesn't wait for it
+            self.backend.send(address, amount)
             
-            try:
-                backend = websocket.create_connection(f"ws://localhost:{self.port}")
-                backend.send(json.dumps({'type': 'post', 'data': 
-                    {'command': 'post_txn', 'txn': dict(txn._asdict())}}))
-                backend.close()
-            except ConnectionRefusedError:
-                print('Connection refused. Did not send the transaction')
-
+    def load_wallet(self, words):
+        self.address = None
+        self.address_lbl.config(text="Address: Loading...")
+        self.backend.load_wallet(words)
+    
+    # Called by the backend through after()
+    
+    def wallet_loaded(self, address):
+        self.address = address
+        self.address_lbl.config(text=f"Address: {address}")
+    
+    def set_connected(self, connected):
+        if connected == self.connected:
+            return
+        
+        self.connected = connected
+        self.status_lbl.config(text="Balance: -" if connected else "Balance: - | Not connected")
+        
+    def set_balance(self, balance, height, confirmations):
+        
+        unconfirmed = sum(1 for n in confirmations.values() if n == 0)
+        text = f"Balance: {balance} | Height: {height}"
+        if unconfirmed:
+            text += f" | {unconfirmed} unconfirmed"
+        
+        self.status_lbl.config(text=text)
+    
+    def show_error(self, message):
+        messagebox.showerror(title='Error', message=message)
+    
+    def close(self):
+        self.backend.stop()
+        self.destroy()
             
+
     def open_mnemonic_window(self):
         
         mnemonic_window = MnemonicWindow(self)
@@ -128,8 +442,7 @@ class App(tk.Tk):
         def get_menmonic():
             words = mnemonic_window.words_txt.get(1.0, "end")
             if not len(mnemonic_window.words_txt.get("1.0", "end-1c")) == 0:
-                self.wallet = Wallet(words)
-                self.address_lbl.config(text=f"Address: {self.wallet.addr}")
+                self.load_wallet(words)
             mnemonic_window.destroy()
           
         mnemonic_window.protocol("WM_DELETE_WINDOW", get_menmonic)
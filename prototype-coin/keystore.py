@@ -0,0 +1,184 @@
+import hashlib
+from typing import Dict, List, Tuple
+
+import bip32utils
+from mnemonic import Mnemonic
+
+COIN_TYPE = 69420
+RECEIVE = 0
+CHANGE = 1
+GAP_LIMIT = 20  # Unused addresses watched after the last used one
+
+# Derived account keys by the hash of their mnemonic words. Deriving them
+# runs 2048 rounds of PBKDF2, so it's done once per process
+_accounts: Dict[str, str] = {}
+
+
+class Keystore:
+
+    def __init__(self, account_xkey: str, gap_limit: int = GAP_LIMIT):
+        """The keys of a single wallet account, m/44'/69420'/0'. Addresses
+        are derived lazily on the receive (m/44'/69420'/0'/0/i) and change
+        (m/44'/69420'/0'/1/i) chains, and every derived address is kept in a
+        map for O(1) ownership checks. gap_limit addresses after the last used
+        one are derived in advance, so payments to them are recognized.
+
+        Args:
+            account_xkey (str): The extended private key of the account
+            gap_limit (int, optional): Unused addresses to watch on every
+            chain. Defaults to GAP_LIMIT.
+
+        Attributes:
+            index (Dict[str, Tuple[int, int]]): The chain and index of every
+            derived address
+
+            used (Dict[int, int]): The last used index of every chain, -1 if
+            none was used
+        """
+
+        self.account = bip32utils.BIP32Key.fromExtendedKey(account_xkey)
+        self.gap_limit = gap_limit
+
+        self._chains = {RECEIVE: self.account.ChildKey(RECEIVE),
+                        CHANGE: self.account.ChildKey(CHANGE)}
+        self._keys: Dict[Tuple[int, int], bip32utils.BIP32Key] = {}
+
+        self.index: Dict[str, Tuple[int, int]] = {}
+        self.used = {RECEIVE: -1, CHANGE: -1}
+
+        for chain in self._chains:
+            self._fill(chain)
+
+    @classmethod
+    def from_words(cls, words: str, gap_limit: int = GAP_LIMIT) -> 'Keystore':
+        """Creates the keystore of the mnemonic words. The account key is
+        cached, so only the first keystore of the same words pays for the
+        seed derivation
+
+        Args:
+            words (str): The bip39 mnemonic words
+            gap_limit (int, optional): See Keystore. Defaults to GAP_LIMIT.
+
+        Returns:
+            Keystore: The keystore
+        """
+
+        key = hashlib.sha256(words.encode()).hexdigest()
+        xkey = _accounts.get(key)
+
+        if xkey is None:
+            seed = Mnemonic('english').to_seed(words)
+
+            # DO NOT share this key
+            master_key = bip32utils.BIP32Key.fromEntropy(seed)
+            account = master_key.ChildKey(
+                44 + bip32utils.BIP32_HARDEN
+            ).ChildKey(
+                COIN_TYPE + bip32utils.BIP32_HARDEN
+            ).ChildKey(
+                0 + bip32utils.BIP32_HARDEN
+            )
+
+            xkey = _accounts[key] = account.ExtendedKey(private=True)
+
+        return cls(xkey, gap_limit)
+
+    @property
+    def xpub(self) -> str:
+        return self.account.ExtendedKey(private=False)
+
+    @property
+    def xpriv(self) -> str:
+        return self.account.ExtendedKey(private=True)
+
+    def __contains__(self, addr: str):
+        return addr in self.index
+
+    def addresses(self):
+        """Returns the derived addresses. The view grows when new addresses
+        are derived
+
+        Returns:
+            KeysView: The addresses
+        """
+        return self.index.keys()
+
+    def key(self, chain: int, i: int) -> bip32utils.BIP32Key:
+        """Returns the key of an address, deriving it if needed
+
+        Args:
+            chain (int): RECEIVE or CHANGE
+            i (int): The index of the address on the chain
+
+        Returns:
+            BIP32Key: The key
+        """
+
+        key = self._keys.get((chain, i))
+
+        if key is None:
+            key = self._keys[(chain, i)] = self._chains[chain].ChildKey(i)
+            self.index[key.Address()] = (chain, i)
+
+        return key
+
+    def key_of(self, addr: str) -> bip32utils.BIP32Key:
+        """Returns the key of a derived address
+
+        Args:
+            addr (str): The address
+
+        Raises:
+            KeyError: The address isn't of this keystore
+
+        Returns:
+            BIP32Key: The key
+        """
+        return self._keys[self.index[addr]]
+
+    def address(self, chain: int, i: int) -> str:
+        return self.key(chain, i).Address()
+
+    def new_address(self, chain: int = RECEIVE) -> str:
+        """Returns the first unused address of a chain and marks it as used
+
+        Args:
+            chain (int, optional): RECEIVE or CHANGE. Defaults to RECEIVE.
+
+        Returns:
+            str: The address
+        """
+
+        addr = self.address(chain, self.used[chain] + 1)
+        self.mark_used(addr)
+        return addr
+
+    def mark_used(self, addr: str) -> bool:
+        """Records that an address was used, and derives the addresses after
+        it up to the gap limit
+
+        Args:
+            addr (str): The address
+
+        Returns:
+            bool: False if the address isn't of this keystore
+        """
+
+        location = self.index.get(addr)
+        if location is None:
+            return False
+
+        chain, i = location
+        if i > self.used[chain]:
+            self.used[chain] = i
+            self._fill(chain)
+
+        return True
+
+    def _fill(self, chain: int):
+        for i in range(self.used[chain] + 1, self.used[chain] + 1 + self.gap_limit):
+            self.key(chain, i)
+
+    def used_addresses(self) -> List[str]:
+        return [self.address(chain, i) for chain in self._chains
+                for i in range(self.used[chain] + 1)]
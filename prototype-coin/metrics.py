@@ -0,0 +1,312 @@
+import asyncio
+import bisect
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Default buckets for durations in seconds
+SECONDS_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, value: float = 0):
+        """A value that only goes up, like the number of received messages
+
+        Args:
+            value (float, optional): The start value, for counters that are
+            kept elsewhere and only read by a collector. Defaults to 0.
+        """
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+
+    type = 'gauge'
+
+    def __init__(self, func: Optional[Callable[[], float]] = None):
+        """A value that goes up and down, like the size of the memory pool
+
+        Args:
+            func (Optional[Callable[[], float]], optional): Reads the value
+            when the metrics are collected, so the hot path doesn't need to
+            update it. Defaults to None (set the value with set).
+        """
+
+        self.func = func
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self.func() if not self.func is None else self.value
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, buckets: List[float] = SECONDS_BUCKETS):
+        """A simple fixed bucket histogram. Every observed value is counted in
+        the first bucket that is bigger or equal to it. Values bigger than the
+        last bucket are counted in an overflow bucket.
+
+        Args:
+            buckets (List[float], optional): The upper bounds of the buckets,
+            sorted. Defaults to SECONDS_BUCKETS.
+        """
+
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        """Counts a new value in the histogram
+
+        Args:
+            value (float): The value
+        """
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def time(self) -> 'Timer':
+        """Returns a context manager that observes the seconds its block took
+        """
+        return Timer(self)
+
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0
+
+    def snapshot(self) -> dict:
+        """Returns the histogram in a json friendly format
+
+        Returns:
+            dict: The buckets with their counts, the number of observations and
+            their sum
+        """
+
+        labels = [str(b) for b in self.buckets] + ['inf']
+        return {'buckets': dict(zip(labels, self.counts)),
+                'count': self.total,
+                'sum': self.sum}
+
+
+class Timer:
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+
+    def __init__(self):
+        """The metrics of a node. Metrics are created on first use by their
+        name and labels, and the same object is returned after that, so hot
+        paths can keep a reference instead of looking it up every time.
+
+        Metrics that only exist at collection time, like the bytes of every
+        connected peer, come from collectors. The metrics of other registries
+        (like the blockchain's) are collected with include.
+        """
+
+        self.metrics: Dict[Tuple[str, Labels], object] = {}
+        self.help: Dict[str, str] = {}
+        self.collectors: List[Callable[[], Iterator[tuple]]] = []
+        self.registries: List['Registry'] = []
+
+    def _get(self, cls, name: str, help: str, labels: dict, *args):
+
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+
+        if metric is None:
+            metric = self.metrics[key] = cls(*args)
+            if help:
+                self.help[name] = help
+
+        return metric
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = '',
+              func: Optional[Callable[[], float]] = None, **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels, func)
+
+    def histogram(self, name: str, help: str = '',
+                  buckets: List[float] = SECONDS_BUCKETS, **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def add(self, name: str, metric, help: str = '', **labels):
+        """Registers a metric that was made elsewhere, like the histograms of
+        the relay queues
+        """
+
+        self.metrics[(name, tuple(sorted(labels.items())))] = metric
+        if help:
+            self.help[name] = help
+
+    def collector(self, func: Callable[[], Iterator[tuple]]):
+        """Adds a function that yields metrics when they are collected, as
+        tuples of (name, labels dict, metric)
+        """
+        self.collectors.append(func)
+
+    def include(self, registry: 'Registry'):
+        if not registry is self and not registry in self.registries:
+            self.registries.append(registry)
+
+    def collect(self) -> Iterator[tuple]:
+        """Yields all the metrics as tuples of (name, labels, metric)"""
+
+        for (name, labels), metric in list(self.metrics.items()):
+            yield name, labels, metric
+
+        for func in self.collectors:
+            for name, labels, metric in func():
+                yield name, tuple(sorted(labels.items())), metric
+
+        for registry in self.registries:
+            yield from registry.collect()
+
+    def _helps(self) -> Dict[str, str]:
+
+        helps = {}
+        for registry in self.registries:
+            helps.update(registry._helps())
+        helps.update(self.help)
+
+        return helps
+
+    def snapshot(self) -> dict:
+        """Returns the metrics in a json friendly format: a list of
+        {'labels', 'value'} for every metric name
+        """
+
+        snapshot = {}
+        for name, labels, metric in self.collect():
+            snapshot.setdefault(name, []).append(
+                {'labels': dict(labels), 'value': metric.snapshot()})
+
+        return snapshot
+
+    def text(self) -> str:
+        """Returns the metrics in the prometheus text format"""
+
+        groups = {}
+        for name, labels, metric in self.collect():
+            groups.setdefault(name, []).append((labels, metric))
+
+        helps = self._helps()
+        lines = []
+        for name, metrics in groups.items():
+            if name in helps:
+                lines.append(f'# HELP {name} {helps[name]}')
+            lines.append(f'# TYPE {name} {metrics[0][1].type}')
+
+            for labels, metric in metrics:
+                if isinstance(metric, Histogram):
+                    lines += _histogram_lines(name, labels, metric)
+                else:
+                    lines.append(f'{name}{_labels(labels)} {metric.snapshot()}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+
+    def __init__(self, registry: Registry, port: int, host: str = '127.0.0.1'):
+        """Serves the metrics in the prometheus text format over http, for
+        local tools. Every request gets the metrics, whatever its path is.
+
+        Args:
+            registry (Registry): The metrics
+            port (int): The port
+            host (str, optional): The interface. Defaults to localhost only.
+        """
+
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host,
+                                                  self.port)
+
+    async def close(self):
+        if not self._server is None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+
+        try:
+            # Only the request line and the headers are read, the request
+            # itself doesn't matter
+            while (await reader.readline()).strip():
+                pass
+
+            body = self.registry.text().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() +
+                         b'\r\n\r\n' + body)
+            await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        finally:
+            writer.close()
+
+
+def _labels(labels: Labels, extra: str = '') -> str:
+
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _histogram_lines(name: str, labels: Labels, histogram: Histogram) -> List[str]:
+
+    lines = []
+    total = 0
+    for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+        total += count
+        le = f'le="{bound}"'
+        lines.append(f'{name}_bucket{_labels(labels, le)} {total}')
+
+    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+    lines.append(f'{name}_count{_labels(labels)} {histogram.total}')
+    return lines
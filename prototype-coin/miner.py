@@ -1,25 +1,40 @@
 import asyncio
 import hashlib
+import logging
 import multiprocessing as mp
 import time
 from concurrent.futures import ProcessPoolExecutor
-from typing import Callable, Any
+from typing import Any, Callable, List, Optional
 
-from block import Block, Transaction
+from block import Block, Transaction, block_data, txn_hash
 import treenode as tree
 from blockchain import Blockchain
 from wallet import Wallet
 
+log = logging.getLogger(__name__)
+
 
 class Miner:
-    def __init__(self, miner_addr: str, max_txns: int = 100):
+    def __init__(self, miner_addr: str, max_txns: int = 100,
+                 processes: Optional[int] = None):
 
         self.max_txns = max_txns    # Max transaction to insert to each block
         self.mempool = []   # Memory pool. holds pending transactions
 
         self.miner_addr = miner_addr
 
+        # Number of processes searching for the hash
+        self.processes = mp.cpu_count() if processes is None else processes
+
         self.stop = asyncio.Event() # Stops mining when set
+        self.restart = asyncio.Event()  # Starts a new block when set
+
+        self.hashes = 0     # Hashes tried in finished rounds
+        self.mining_time = 0
+
+        self._pool = None
+        self._manager = None
+        self._found = None
 
     def add_txn(self, txn: Transaction):
         """Adds a transaction to the memory pool. will not add duplicate 
@@ -34,7 +49,27 @@ class Miner:
         if not txn in self.mempool:
             self.mempool.append(txn)
 
-    def _find_hash(self, data: str, difficulty: int, offset: int, found_event: mp.Event):
+    def restore_txns(self, txns: List[Transaction]):
+        """Puts transactions of blocks that lost a reorganization back at the
+        front of the memory pool, since they were already waiting the longest
+
+        Args:
+            txns (List[Transaction]): The transactions
+        """
+
+        pending = {txn_hash(txn) for txn in self.mempool}
+        self.mempool[:0] = [txn for txn in txns
+                            if not txn_hash(txn) in pending]
+
+    def new_block(self):
+        """Tells the miner a new block was added to the blockchain, so the
+        current block is dropped and a new one is mined on the new tip
+        """
+        self.restart.set()
+
+    @staticmethod
+    def _find_hash(data: str, difficulty: int, offset: int, found_event: mp.Event,
+                   skip: Optional[int] = None):
         
         """Finds the hash for a block with given difficulty. Should be used in a
         multiprocessing pool.
@@ -46,41 +81,159 @@ class Miner:
             
             offset (int): Used when multiple processes are mining. Every
             process should have a different offeset. Offsets for each process
-            should look like this when n is the number of cores the cpu have:
+            should look like this when n is the number of processes:
             0,1,2,...,n-1.
              
             found_event (multiproccessing.Event): Pass to tell the other cores
             to stop whenever one of them has found the hash
 
+            skip (int, optional): The number of processes. Defaults to the
+            number of cores.
+
         Returns:
-            Tuple[str, str]: Returns the hash it found and the proof
+            Tuple[str, str, int]: Returns the hash it found, the proof and the
+            number of hashes this process tried. None if another process found
+            the hash first
         """
 
         # print(f'PID {mp.current_process().pid}: Searching for hash')
 
-        skip = mp.cpu_count()
+        if skip is None:
+            skip = mp.cpu_count()
         data = str(data)
         proof = 0 + offset
+        diff_string = '0' * difficulty
 
         while True:
 
-            if found_event.is_set():
+            # Checking the event is a call to the manager process, so don't
+            # do it for every hash
+            if (proof - offset) % (skip * 1024) == 0 and found_event.is_set():
                 # print(f'PID {mp.current_process().pid}: Cancelled')
                 return
 
             data_hash = hashlib.sha256(
                 (data + str(proof)).encode()).hexdigest()
 
-            diff_string = '0' * difficulty
             if data_hash.startswith(diff_string):
-                return data_hash, str(proof)
+                return data_hash, str(proof), (proof - offset) // skip + 1
             else:
                 proof += skip
-        # TODO: Start mining a new block if a new block is received
+
+    async def start(self):
+        """Starts the mining processes. Called by mine() if it wasn't called
+        before. The processes are kept between blocks, so starting a new block
+        doesn't pay for starting processes.
+        """
+
+        if self._pool is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+
+        self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        # Starting the manager starts a process, so keep it off the event loop
+        self._manager = await loop.run_in_executor(None, mp.Manager)
+        self._found = await loop.run_in_executor(None, self._manager.Event)
+
+    async def close(self):
+        """Stops mining and the mining processes
+        """
+
+        self.stop.set()
+
+        if self._pool is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        pool, manager = self._pool, self._manager
+        self._pool = self._manager = self._found = None
+
+        pool.shutdown(wait=False, cancel_futures=True)
+        await loop.run_in_executor(None, manager.shutdown)
+
+    def hash_rate(self) -> float:
+        """Returns the average hashes per second of the finished blocks
+
+        Returns:
+            float: The hash rate
+        """
+        return self.hashes / self.mining_time if self.mining_time else 0
+
+    def _template(self, blockchain: Blockchain):
+
+        txns = self.mempool[:self.max_txns]
+        del self.mempool[:self.max_txns]
+
+        # Add Block reward
+        txns.append(Transaction('0.1', 'mine', [self.miner_addr, 10],
+                                None, None))
+
+        if blockchain.unconfirmed is None:
+            last_hash = blockchain.chain[-1]._hash
+        else:
+            potential_blocks = tree.get_end_children(
+                blockchain.unconfirmed)
+            last_hash = max(potential_blocks,
+                            key=lambda x: x.get_level()).data._hash
+
+        timestamp = str(time.time())
+
+        return timestamp, last_hash, txns
+
+    async def _search(self, data: str, difficulty: int):
+        """Searches for the hash in all the mining processes until one of them
+        finds it, or until mining is stopped or restarted.
+
+        Returns:
+            Tuple[str, str]: The hash and the proof. None if interrupted
+        """
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._found.clear)
+
+        workers = [loop.run_in_executor(self._pool, Miner._find_hash,
+                                        data,
+                                        difficulty,
+                                        i,
+                                        self._found,
+                                        self.processes)
+                   for i in range(self.processes)]
+        interrupts = [asyncio.create_task(self.stop.wait()),
+                      asyncio.create_task(self.restart.wait())]
+
+        start = time.monotonic()
+        try:
+            await asyncio.wait(workers + interrupts,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for interrupt in interrupts:
+                interrupt.cancel()
+
+            # Tell the other processes to stop, and wait for them so they are
+            # free for the next block
+            await loop.run_in_executor(None, self._found.set)
+            results = await asyncio.gather(*workers, return_exceptions=True)
+
+        found = None
+        for result in results:
+            if isinstance(result, (FileNotFoundError, EOFError, BrokenPipeError)):
+                log.error('%s', result)
+
+            elif isinstance(result, tuple):
+                self.hashes += result[2]
+                if found is None:
+                    found = result[:2]
+
+        if found is not None:
+            self.mining_time += time.monotonic() - start
+
+        return found
 
     async def mine(self, blockchain: Blockchain, handler: Callable[[Block], Any]):
         """Starts mining blocks and calls handler(block) whenever a new block is
-        mined. To stop mining, set self.stop.
+        mined. To stop mining, set self.stop or call close(). The hash search
+        runs in other processes, so the event loop is free while mining.
 
         Args:
             blockchain (Blockchain): The blockchain to work on mining. 
@@ -92,78 +245,36 @@ class Miner:
         # Don't mine if theres no address to mine to
         if self.miner_addr is None:
             return
-        
-        loop = asyncio.get_running_loop()
-
-        while True:
-            if self.stop.is_set():
-
-                print('MINER - Stopped mining')
-                handler.cancel()
-                return
-            
-            txns = []
-            for _ in range(self.max_txns):
-                try:
-                    txns.append(self.mempool.pop(0))
 
-                except IndexError:
-                    break   # No transactions left in mempool
+        await self.start()
 
-            # Add Block reward
-            txns.append(Transaction('0.1', 'mine', [self.miner_addr, 10],
-                                    None, None))
+        while not self.stop.is_set():
 
-            if blockchain.unconfirmed.data is None:
-                last_hash = blockchain.chain[-1]._hash
-            else:
-                potential_blocks = tree.get_end_children(
-                    blockchain.unconfirmed)
-                last_hash = max(potential_blocks,
-                                key=lambda x: x.get_level()).data._hash
-
-            timestamp = str(time.time())
+            self.restart.clear()
+            timestamp, last_hash, txns = self._template(blockchain)
 
             difficulty = blockchain.difficulty
-            block_data = f'{timestamp}{last_hash}{txns}'
-
-            # Run all proccesses in the computer to find hash
-            with ProcessPoolExecutor() as pool, mp.Manager() as manager:
-
-                finished = manager.Event()
-
-                workers = [loop.run_in_executor(pool, self._find_hash,
-                                                block_data,
-                                                difficulty,
-                                                i,
-                                                finished)
-                           for i in range(mp.cpu_count())]
-
-                done, pending = await asyncio.wait(workers,
-                                                   return_when=
-                                                   asyncio.FIRST_COMPLETED)
-
-                for worker in workers:
-                    if worker in done:
-                        try:
-                            block_hash, proof = worker.result()
+            data = block_data(timestamp, last_hash, txns)
 
-                        except (FileNotFoundError, EOFError, BrokenPipeError) as e:
-                            print(f'ERROR - {e}')
+            found = await self._search(data, difficulty)
 
-                        finished.set()
+            if found is None:
+                # Put the transactions back for the next block, without the
+                # block reward
+                self.mempool[:0] = txns[:-1]
+                continue
 
-                        block = Block(last_hash=last_hash,
-                                           txns=txns,
-                                           proof=proof,
-                                           timestamp=timestamp,
-                                           _hash=block_hash)
+            block_hash, proof = found
+            block = Block(last_hash=last_hash,
+                          txns=txns,
+                          proof=proof,
+                          timestamp=timestamp,
+                          _hash=block_hash)
 
-                        print(f'MINER - Block created with hash {block_hash}')
-                        await handler(block)
+            log.info('Block created with hash %s', block_hash)
+            await handler(block)
 
-                    if worker in pending:
-                        worker.cancel()
+        log.info('Stopped mining')
                         
 
 async def main():
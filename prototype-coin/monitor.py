@@ -0,0 +1,58 @@
+import asyncio
+from typing import Optional
+
+from metrics import Histogram
+
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5]
+
+
+class LoopMonitor:
+
+    def __init__(self, interval: float = 0.1):
+        """Measures the lag of the event loop: how much later than expected a
+        sleeping task wakes up. A high lag means something is blocking the
+        loop, and every network message waits for it.
+
+        Args:
+            interval (float, optional): Seconds between measurements.
+            Defaults to 0.1.
+
+        Attributes:
+            lag (Histogram): The measured lags in seconds
+
+            last (float): The last measured lag
+
+            max (float): The highest measured lag
+        """
+
+        self.interval = interval
+        self.lag = Histogram(LAG_BUCKETS)
+        self.last = 0.0
+        self.max = 0.0
+
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+
+            self.last = max(0.0, loop.time() - expected)
+            self.max = max(self.max, self.last)
+            self.lag.observe(self.last)
+
+    def snapshot(self) -> dict:
+        return {'last': self.last, 'max': self.max, 'mean': self.lag.mean(),
+                'histogram': self.lag.snapshot()}
@@ -0,0 +1,295 @@
+import csv
+import logging
+import os
+import random
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from .registry import Addr, canonical_addr
+
+log = logging.getLogger(__name__)
+
+FIELDS = ['host', 'port', 'last_seen', 'last_attempt', 'attempts',
+          'successes', 'failures']
+
+# Addresses shared with a peer, and accepted from a peer, at a time
+MAX_SHARED = 50
+
+
+class AddressInfo:
+
+    def __init__(self, addr: Addr, last_seen: float = 0, last_attempt: float = 0,
+                 attempts: int = 0, successes: int = 0, failures: int = 0,
+                 source: Optional[Addr] = None):
+        """What the address book knows about a single address
+
+        Args:
+            addr (Addr): The canonical address
+            last_seen (float, optional): Unix time we last heard of this peer
+            (connected to it or got it from another peer). Defaults to 0.
+            last_attempt (float, optional): Unix time of the last connection
+            attempt. Defaults to 0.
+            attempts (int, optional): Connection attempts. Defaults to 0.
+            successes (int, optional): Successful connections. Defaults to 0.
+            failures (int, optional): Failed connections in a row. Defaults
+            to 0.
+            source (Optional[Addr], optional): The peer that shared this
+            address. Not saved. Defaults to None.
+        """
+
+        self.addr = addr
+        self.last_seen = last_seen
+        self.last_attempt = last_attempt
+        self.attempts = attempts
+        self.successes = successes
+        self.failures = failures
+        self.source = source
+
+    def __repr__(self):
+        return f'AddressInfo({self.addr}, successes={self.successes}, \
+failures={self.failures})'
+
+    def chance(self, now: float) -> float:
+        """The relative chance this address is picked for a new connection.
+        Addresses that worked before are preferred, every failure in a row
+        halves the chance and addresses we just tried are skipped.
+
+        Args:
+            now (float): The current unix time
+
+        Returns:
+            float: The chance, 0 if the address shouldn't be tried now
+        """
+
+        # Wait longer after every failure, up to an hour
+        if now - self.last_attempt < min(3600, 10 * 2 ** self.failures) and \
+                self.failures:
+            return 0
+
+        chance = 1 + self.successes
+        chance *= 0.5 ** min(self.failures, 8)
+
+        # Prefer peers we heard of in the last day
+        if now - self.last_seen > 24 * 3600:
+            chance *= 0.2
+
+        return chance
+
+
+class AddressBook:
+
+    def __init__(self, path: Optional[str] = None, max_size: int = 1000):
+        """Keeps the addresses of peers we know, with statistics about
+        connecting to them. Used to choose new outbound peers and to bootstrap
+        without depending on a single known peer.
+
+        Args:
+            path (Optional[str], optional): A csv file to persist the address
+            book to. Defaults to None (not persisted).
+            max_size (int, optional): Max addresses to keep. Defaults to 1000.
+
+        Attributes:
+            addrs (Dict[Addr, AddressInfo]): The known addresses
+            max_per_source (int): Max addresses a single peer can add, so it
+            can't fill the address book with addresses of its choice
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.max_per_source = max(1, max_size // 8)
+        self.addrs: Dict[Addr, AddressInfo] = {}
+        self._sources = Counter()
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __contains__(self, addr: Addr):
+        return addr in self.addrs
+
+    def add(self, addr, seen: bool = True,
+            source: Optional[Addr] = None) -> bool:
+        """Adds an address, usually learnt from another peer
+
+        Args:
+            addr: The address (see canonical_addr)
+            seen (bool, optional): Update the last seen time. Defaults to True.
+            source (Optional[Addr], optional): The peer that shared the
+            address. Such addresses are limited to max_per_source, and they
+            don't update addresses we already know, since a peer can claim it
+            saw anything. Defaults to None.
+
+        Returns:
+            bool: True if the address is new
+        """
+
+        try:
+            addr = canonical_addr(addr)
+        except (ValueError, TypeError, IndexError):
+            return False
+
+        info = self.addrs.get(addr)
+        is_new = info is None
+
+        if not source is None and \
+                (not is_new or self._sources[source] >= self.max_per_source):
+            return False
+
+        if is_new:
+            if len(self.addrs) >= self.max_size:
+                self._evict()
+            info = self.addrs[addr] = AddressInfo(addr, source=source)
+            if not source is None:
+                self._sources[source] += 1
+
+        if seen:
+            info.last_seen = time.time()
+
+        return is_new
+
+    def attempt(self, addr: Addr):
+        info = self._get(addr)
+        info.attempts += 1
+        info.last_attempt = time.time()
+
+    def good(self, addr: Addr):
+        """Records a successful connection
+
+        Args:
+            addr (Addr): The canonical address
+        """
+
+        info = self._get(addr)
+        info.successes += 1
+        info.failures = 0
+        info.last_seen = time.time()
+
+    def failed(self, addr: Addr):
+        self._get(addr).failures += 1
+
+    def select(self, n: int, exclude: Iterable[Addr] = ()) -> List[Addr]:
+        """Chooses addresses for new connections, randomly weighted by their
+        chance (see AddressInfo.chance)
+
+        Args:
+            n (int): Max addresses to choose
+            exclude (Iterable[Addr], optional): Addresses to skip, like the
+            ones we are connected to. Defaults to ().
+
+        Returns:
+            List[Addr]: The chosen addresses
+        """
+
+        exclude = set(exclude)
+        now = time.time()
+
+        candidates = []
+        weights = []
+        for addr, info in self.addrs.items():
+            chance = info.chance(now)
+            if chance > 0 and not addr in exclude:
+                candidates.append(addr)
+                weights.append(chance)
+
+        chosen = []
+        while candidates and len(chosen) < n:
+            i = random.choices(range(len(candidates)), weights=weights)[0]
+            chosen.append(candidates.pop(i))
+            weights.pop(i)
+
+        return chosen
+
+    def recent(self, n: int = MAX_SHARED) -> List[Addr]:
+        """Returns the addresses we heard of most recently that didn't fail
+        last time. Used to share addresses with other peers
+
+        Args:
+            n (int, optional): Max addresses to return. Defaults to 50.
+
+        Returns:
+            List[Addr]: The addresses
+        """
+
+        infos = [info for info in self.addrs.values() if info.failures == 0]
+        infos.sort(key=lambda info: info.last_seen, reverse=True)
+        return [info.addr for info in infos[:n]]
+
+    def _get(self, addr: Addr) -> AddressInfo:
+
+        info = self.addrs.get(addr)
+        if info is None:
+            self.add(addr, seen=False)
+            info = self.addrs[addr]
+
+        return info
+
+    @staticmethod
+    def _badness(info: AddressInfo):
+
+        # The address that failed the most goes first, then the ones we never
+        # connected to (any peer can make those up), then the oldest
+        return info.failures, -info.successes, -info.last_seen
+
+    def _evict(self):
+
+        worst = max(self.addrs.values(), key=self._badness)
+        self._remove(worst)
+
+    def _remove(self, info: AddressInfo):
+
+        del self.addrs[info.addr]
+        if not info.source is None:
+            self._sources[info.source] -= 1
+
+    def save(self):
+        """Writes the address book to its file. The file is replaced
+        atomically so a crash never leaves half of it
+        """
+
+        if self.path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+
+        with open(temp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            for info in self.addrs.values():
+                writer.writerow([info.addr[0], info.addr[1], info.last_seen,
+                                 info.last_attempt, info.attempts,
+                                 info.successes, info.failures])
+
+        os.replace(temp_path, self.path)
+
+    def load(self) -> bool:
+        """Reads the address book from its file
+
+        Returns:
+            bool: True if the file was found
+        """
+
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    addr = canonical_addr((row['host'], int(row['port'])))
+                    self.addrs[addr] = AddressInfo(addr,
+                                                   float(row['last_seen']),
+                                                   float(row['last_attempt']),
+                                                   int(row['attempts']),
+                                                   int(row['successes']),
+                                                   int(row['failures']))
+                except (KeyError, ValueError, TypeError):
+                    continue
+
+        # The file might come from a larger address book
+        if len(self.addrs) > self.max_size:
+            infos = sorted(self.addrs.values(), key=self._badness)
+            for info in infos[self.max_size:]:
+                self._remove(info)
+
+        log.info('Loaded %s addresses from %s', len(self.addrs), self.path)
+        return True
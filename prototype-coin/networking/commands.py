@@ -0,0 +1,85 @@
+from collections import namedtuple
+from typing import Callable, Dict, Optional
+
+Command = namedtuple('Command', ['webname', 'server', 'client', 'validate'])
+"""A web command of a peer class. server and client are the names of the
+methods that handle it (None if the class has no such method), so instances
+can replace them, and validate checks the parameters of a received command
+(None if it has no parameters to check).
+"""
+
+Schema = Dict[str, object]
+
+
+def compile_schema(schema: Optional[Schema]) -> Optional[Callable[[dict], Optional[str]]]:
+    """Turns a parameter schema into a validation function. A schema maps
+    every parameter to its type, or a tuple of types. A parameter is required
+    unless None is one of its types.
+
+    Example:
+        {'txid': str, 'height': (int, None)}
+
+    Args:
+        schema (Optional[Schema]): The schema
+
+    Returns:
+        Optional[Callable[[dict], Optional[str]]]: A function that returns an
+        error message for invalid parameters and None for valid ones, or None
+        if there is nothing to check
+    """
+
+    if not schema:
+        return None
+
+    checks = []
+    for name, types in schema.items():
+        if not isinstance(types, tuple):
+            types = (types, )
+
+        required = not None in types
+        types = tuple(type(None) if t is None else t for t in types)
+        checks.append((name, types, required))
+
+    def validate(params: dict) -> Optional[str]:
+        for name, types, required in checks:
+            value = params.get(name)
+
+            if value is None and required:
+                return f'missing parameter {name}'
+
+            if not isinstance(value, types):
+                return f'invalid parameter {name}'
+
+        return None
+
+    return validate
+
+
+def collect_commands(cls) -> Dict[str, Command]:
+    """Finds the methods of a class that were marked by the server and client
+    decorators, including the inherited ones. Runs once for every class, when
+    it is created
+
+    Returns:
+        Dict[str, Command]: The commands by their web names
+    """
+
+    found = {}  # webname -> [server, client, validate]
+
+    # Base classes first, so subclasses override their commands
+    for klass in reversed(cls.__mro__):
+        for name, attribute in vars(klass).items():
+            webname = getattr(attribute, 'webname', None)
+            if webname is None:
+                continue
+
+            ref = found.setdefault(webname, [None, None, None])
+
+            if getattr(attribute, 'server', False):
+                ref[0] = name
+                ref[2] = attribute.validate
+
+            if getattr(attribute, 'client', False):
+                ref[1] = name
+
+    return {webname: Command(webname, *ref) for webname, ref in found.items()}
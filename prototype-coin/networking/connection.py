@@ -1,10 +1,18 @@
 import asyncio
 import functools
 import json
+import logging
+import time
 
 import websockets
 from websockets.exceptions import *
 
+from . import wire
+from .scoring import PeerScore
+
+log = logging.getLogger(__name__)
+
+
 class PeerConnection():
     
     def __init__(self, websocket, connected=True):
@@ -20,11 +28,31 @@ class PeerConnection():
         self.websocket = websocket
         self.str_addr = f'{websocket.remote_address[0]}:{websocket.remote_address[1]}'
         self.addr = websocket.remote_address
+
+        # The address the peer accepts connections on. For inbound connections
+        # it is only known after the peer sent hello
+        self.listen_addr = None if connected else (self.addr[0], self.addr[1])
+
+        # Wire features both sides agreed on (see wire.FEATURES)
+        self.features = frozenset()
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        # Request and behaviour statistics, see request()
+        self.score = PeerScore()
+
+        self._last_id = 0
+        self._request_lock = asyncio.Lock()
+
+        # Set once the peer answered with a request id. After that answers
+        # without one are not taken as answers
+        self._peer_ids = False
         
         if connected:
-            print(f'INFO {self.str_addr} - Connected')
+            log.info('%s - Connected', self.str_addr)
         else:
-            print(f'INFO - Connnected to peer {self.str_addr}')
+            log.info('Connnected to peer %s', self.str_addr)
         
     async def listener(self, handler=None):
         """A listener that listens to all incoming data from this connection
@@ -40,6 +68,8 @@ class PeerConnection():
         try:
             async for message in self.websocket:
                 
+                self.bytes_received += len(message)
+
                 if handler is None:
                     print(message)
                 else:
@@ -52,32 +82,109 @@ class PeerConnection():
         
         
         finally:
-            print(f'INFO - Disconnected from {self.str_addr}')
+            log.info('Disconnected from %s', self.str_addr)
                     
     
+    def encode(self, data):
+        """Encodes a message in the format this connection agreed on
+
+        Args:
+            data (any): The message
+
+        Returns:
+            Union[str, bytes]: The encoded message, ready to be sent raw
+        """
+        return wire.encode(data, self.features)
+
     async def send(self, data, raw=False):
         """Sends a message to the other end of this connection.
 
         Args:
             data (any): The data to send
-            raw (bool, optional): Whether to keep the data raw or format it in
-            json. Defaults to False.
+            raw (bool, optional): Whether to send the data as is or encode it
+            in the connection's format (json or binary). Defaults to False.
         """
         
         if not raw:
-            data = json.dumps(data)
+            data = self.encode(data)
 
         # print(f'INFO {self.str_addr} - Sending data')
         try:
             await self.websocket.send(data)
+            self.bytes_sent += len(data)
         
         except ConnectionClosedError:
             await self.close()
     
-    async def recv(self, raw=False, timeout=2):
+    async def request(self, data: dict, timeout: float = 3):
+        """Sends a request and waits for its response. The request is tagged
+        with an id so late responses to earlier requests that timed out are
+        skipped instead of being returned as the answer. Once the peer sent
+        ids back, messages without an id are skipped too. Only one request
+        runs on a connection at a time. The result is recorded in score.
+
+        Args:
+            data (dict): The packed request (see Peer.pack)
+            timeout (float, optional): Seconds to wait for the response.
+            Defaults to 3.
+
+        Returns:
+            any: The response. None if the peer didn't answer in time
+        """
+
+        async with self._request_lock:
+            self._last_id += 1
+            request_id = self._last_id
+
+            message = dict(data)
+            message['data'] = {**data['data'], 'id': request_id}
+
+            received = self.bytes_received
+            start = time.monotonic()
+            deadline = start + timeout
+
+            await self.send(message)
+
+            while True:
+                remaining = deadline - time.monotonic()
+                response = None
+
+                if remaining > 0:
+                    response = await self.recv(timeout=remaining,
+                                               close_on_timeout=False)
+
+                if response is None:
+                    self.score.failure()
+                    return
+
+                # Peers that don't support ids don't send them back
+                if isinstance(response, dict):
+                    if 'id' in response:
+                        self._peer_ids = True
+                        if response['id'] != request_id:
+                            continue
+
+                    elif self._peer_ids:
+                        continue
+
+                if isinstance(response, dict) and response.get('type') == 'error':
+                    self.score.failure()
+                else:
+                    self.score.success(time.monotonic() - start,
+                                       self.bytes_received - received)
+                return response
+
+    async def recv(self, raw=False, timeout=2, close_on_timeout=True):
         """Recieves data from the other end of this connection. Used to block an
         asynchronous function until a reply is recieved.
 
+        Args:
+            raw (bool, optional): Return the data without decoding it.
+            Defaults to False.
+            timeout (int, optional): Seconds to wait. Defaults to 2.
+            close_on_timeout (bool, optional): Close the connection if nothing
+            was received in time. Defaults to True.
+
         Returns:
             any: The data
         """
@@ -85,20 +192,31 @@ class PeerConnection():
         try:
             
             response = await asyncio.wait_for(self.websocket.recv(), timeout=timeout)
-            return json.loads(response) if not raw else response
+            self.bytes_received += len(response)
+            return wire.decode(response) if not raw else response
+
+        except wire.DecodeError as e:
+            log.error('%s - %s', self.str_addr, e)
+            return
+
         except ConnectionClosedError:
             await self.close()
             return
 
         except asyncio.TimeoutError:
-            await self.close()
+            if close_on_timeout:
+                await self.close()
             return
     
+    @property
+    def is_open(self) -> bool:
+        return self.websocket.open
+
     async def close(self):
         """Closes this connection.
         """
         
-        print(f'INFO {self.str_addr} - disconnecting')
+        log.info('%s - disconnecting', self.str_addr)
         await self.websocket.close()
     
     @functools.cached_property
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from typing import Any, Coroutine, Dict, Hashable
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        """A token bucket. Tokens are added at a constant rate up to the
+        capacity, and every request takes tokens according to its cost.
+
+        Args:
+            rate (float): Tokens added every second
+            capacity (float): Max tokens in the bucket. Also the biggest burst
+            of requests that is allowed
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def take(self, cost: float = 1) -> bool:
+        """Takes tokens from the bucket if there are enough
+
+        Args:
+            cost (float, optional): The number of tokens. Defaults to 1.
+
+        Returns:
+            bool: True if the tokens were taken
+        """
+
+        self._refill()
+
+        if self.tokens < cost:
+            return False
+
+        self.tokens -= cost
+        return True
+
+    def reserve(self, cost: float = 1) -> float:
+        """Takes tokens from the bucket even if there are not enough, and
+        returns how long the caller should wait until they would have been
+        there. Used to slow a peer down instead of refusing it
+
+        Args:
+            cost (float, optional): The number of tokens. Defaults to 1.
+
+        Returns:
+            float: Seconds to wait, 0 if there were enough tokens
+        """
+
+        self._refill()
+
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+
+        self.tokens -= cost
+        return -self.tokens / self.rate
+
+    def _refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float = 50, capacity: float = 100):
+        """Keeps a token bucket for every peer
+
+        Args:
+            rate (float, optional): Tokens every peer gets per second.
+            Defaults to 50.
+            capacity (float, optional): The bucket size of every peer.
+            Defaults to 100.
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+
+    def allow(self, peer: Hashable, cost: float = 1) -> bool:
+        """Checks if a peer may run a request with the given cost
+
+        Args:
+            peer (Hashable): The peer, usually its connection
+            cost (float, optional): The cost of the request. Defaults to 1.
+
+        Returns:
+            bool: True if the request is allowed
+        """
+
+        return self._bucket(peer).take(cost)
+
+    def reserve(self, peer: Hashable, cost: float = 1) -> float:
+        """Charges a peer for a request and returns how long to wait before
+        running it (see TokenBucket.reserve)
+
+        Args:
+            peer (Hashable): The peer, usually its connection
+            cost (float, optional): The cost of the request. Defaults to 1.
+
+        Returns:
+            float: Seconds to wait, 0 if the request may run now
+        """
+        return self._bucket(peer).reserve(cost)
+
+    def _bucket(self, peer: Hashable) -> TokenBucket:
+
+        bucket = self.buckets.get(peer)
+
+        if bucket is None:
+            bucket = self.buckets[peer] = TokenBucket(self.rate, self.capacity)
+
+        return bucket
+
+    def forget(self, peer: Hashable):
+        self.buckets.pop(peer, None)
+
+
+class WorkerPool:
+
+    def __init__(self, workers: int = 8, max_pending: int = 256):
+        """Runs coroutines as tasks on the event loop, with at most `workers`
+        of them running at the same time. Instead of queueing without limit,
+        submit refuses new work when max_pending coroutines are waiting or
+        running. put waits for room instead, to push back on the caller.
+
+        Args:
+            workers (int, optional): Max coroutines running at the same time.
+            Defaults to 8.
+            max_pending (int, optional): Max coroutines in the pool, running
+            or waiting. Defaults to 256.
+        """
+
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.shed = 0   # Number of coroutines that were refused
+
+        self._sem = asyncio.Semaphore(workers)
+        self._room = asyncio.Event()
+        self._room.set()
+        self._tasks = set()
+
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> bool:
+        """Schedules a coroutine to run in the pool
+
+        Args:
+            coro (Coroutine): The coroutine
+
+        Returns:
+            bool: False if the pool is full and the coroutine was dropped
+        """
+
+        if self.full():
+            coro.close()
+            self.shed += 1
+            return False
+
+        self.pending += 1
+        task = asyncio.create_task(self._run(coro))
+
+        # Keep a reference so the task isn't garbage collected while running
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return True
+
+    async def put(self, coro: Coroutine[Any, Any, Any]):
+        """Schedules a coroutine to run in the pool, waiting until there is
+        room for it
+
+        Args:
+            coro (Coroutine): The coroutine
+        """
+
+        while self.full():
+            self._room.clear()
+            await self._room.wait()
+
+        self.submit(coro)
+
+    async def _run(self, coro):
+
+        try:
+            async with self._sem:
+                await coro
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            log.exception('Command failed')
+
+        finally:
+            self.pending -= 1
+            self._room.set()
+
+    def cancel(self):
+        for task in list(self._tasks):
+            task.cancel()
@@ -1,25 +1,38 @@
 import asyncio
-import copy
 import functools
-import json
-from json.decoder import JSONDecodeError
+import logging
+import time
+from collections import deque
 
 import websockets
 from websockets.exceptions import *
-from typing import Optional, Union, Tuple, Any, Dict
+from typing import Optional, Union, Tuple, Any, Dict, Callable, Hashable, Iterable, List
 
+from metrics import Counter, Registry
+from profiler import Profiler
+
+from . import wire
+from .addrman import AddressBook
+from .commands import Command, Schema, collect_commands, compile_schema
 from .connection import PeerConnection
+from .limiter import RateLimiter, WorkerPool
+from .registry import PeerRegistry, canonical_addr, to_uri
+from .relay import RelayQueue, RelayStats
+from .scoring import BAN_SCORE
+
+log = logging.getLogger(__name__)
 
 PORT = 11111
 IP = 'localhost'
 URI = f'ws://{IP}:{PORT}'
 
 
-#TODO: rework
-def server(func=None, *, webname: Optional[str] = None):
+def server(func=None, *, webname: Optional[str] = None,
+           params: Optional[Schema] = None):
     """A Server decorator. marks the decorated function as a web function,
     which lets the peer class register it as a valid server function for the
-    handler
+    handler. The function itself is returned, the peer class finds it when
+    the class is created (see Peer.COMMANDS).
 
     Args:
         webname (str, optional): The name the command will be called when passed
@@ -27,11 +40,17 @@ def server(func=None, *, webname: Optional[str] = None):
         is recommended in this case to add undercore ('_') before the name of
         the function as it will automatically sign it as the same command as the
         client equivalent. If no name is given, it will use the function's name.
+
+        params (Optional[Schema], optional): The types of the parameters (see
+        commands.compile_schema). Commands with invalid parameters are
+        answered with Peer.ERROR and don't reach the function. Defaults to
+        None (not checked).
     """
     if func is None:
-        return functools.partial(server, type=type, webname=webname)
+        return functools.partial(server, webname=webname, params=params)
 
     func.server = True
+    func.validate = compile_schema(params)
 
     if webname is None:
         if func.__name__.startswith('_'):
@@ -41,33 +60,25 @@ def server(func=None, *, webname: Optional[str] = None):
     else:
         func.webname = webname
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
-
-    return wrapper
+    return func
 
 
 def client(func=None, *, webname: Optional[str] = None):
     """A Client decorator. marks the decorated function as a web function,
     which lets the peer class register it as a valid client function for the
-    handler. If no custom webname is giver 
+    handler. If no custom webname is giver, it will use the function's name.
 
     Args:
         webname (str, optional): The name the command will be called when passed
         over the web.
     """
     if func is None:
-        return functools.partial(server, type=type, webname=webname)
+        return functools.partial(client, webname=webname)
 
     func.client = True
     func.webname = webname if webname else func.__name__
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        return func(*args, **kwargs)
-
-    return wrapper
+    return func
 
 
 class Peer:
@@ -81,9 +92,35 @@ class Peer:
     POST = 6  # Post something
     ERROR = 7  # Sent whenever a get reqest has failed
 
+    # How many rate limit tokens each command takes. Commands that are not
+    # listed take 1 token
+    COMMAND_COSTS = {'hello': 1}
+
+    # Commands that carry a relayed batch (see relay). A peer sends one about
+    # every relay_interval seconds however many items it has, so they cost
+    # RELAY_SHARE of the rate limit per batch at that pace instead of a
+    # fixed cost
+    BATCHED_COMMANDS: Tuple[str, ...] = ()
+    RELAY_SHARE = 0.25
+
+    # The web commands of the class by their web names. Built once for every
+    # class when it is created, see __init_subclass__
+    COMMANDS: Dict[str, Command] = {}
+
     def __init__(self, port: int = 11111,
                  max_outbound: int = -1,
-                 max_inbound: int = -1) -> None:
+                 max_inbound: int = -1,
+                 relay_interval: float = 0.1,
+                 relay_max_items: int = 500,
+                 features: Tuple[str, ...] = wire.FEATURES,
+                 heartbeat_interval: float = 20,
+                 workers: int = 8,
+                 max_pending: int = 256,
+                 rate_limit: float = 50,
+                 rate_burst: float = 100,
+                 target_outbound: int = 8,
+                 addrbook_path: Optional[str] = None,
+                 profiler: Optional[Profiler] = None) -> None:
         """The peer class. Implements a peer that can send and listen to data.
         Uses PeerConnection to handle connections. Data that is sent and 
         received is in a dictionary in JSON format.
@@ -99,11 +136,60 @@ class Peer:
             connected to. These are server connections that we can send requests
             to.
 
-            commands (dict): The web commands.
-
             max_outbound (int, optional): . Defaults to -1.
             max_inbound (int, optional): _description_. Defaults to -1.
 
+            relay_interval (float, optional): Max seconds a relayed item waits
+            before its batch is sent. Defaults to 0.1.
+
+            relay_max_items (int, optional): Max items in a relayed batch.
+            Defaults to 500.
+
+            relays (Dict[PeerConnection, RelayQueue]): The relay queue of each
+            outbound connection.
+
+            relay_stats (RelayStats): Batch size and latency histograms of all
+            the relay queues.
+
+            metrics (Registry): Counters and histograms of the peer, like the
+            received messages and the time every command takes.
+
+            features (Tuple[str, ...], optional): The wire features (binary
+            frames, compression) we offer to peers. Defaults to wire.FEATURES.
+
+            heartbeat_interval (float, optional): Seconds between heartbeats
+            of the outbound connections. Defaults to 20.
+
+            registry (PeerRegistry): The outbound connections by their
+            canonical address. Used to reuse connections and reconnect.
+
+            workers (int, optional): Max commands that are handled at the same
+            time. Defaults to 8.
+
+            max_pending (int, optional): Max commands waiting to be handled.
+            When reached, new commands are answered with Peer.ERROR. Defaults
+            to 256.
+
+            rate_limit (float, optional): Command cost (see COMMAND_COSTS) every
+            inbound connection may spend per second. Connections that spend
+            more are read slower, their commands are not dropped. Defaults to
+            50.
+
+            rate_burst (float, optional): Max command cost an inbound
+            connection can spend at once. Defaults to 100.
+
+            target_outbound (int, optional): Outbound connections to keep
+            open, filled from the address book. Limited by max_outbound.
+            Defaults to 8.
+
+            addrbook_path (Optional[str], optional): Csv file to persist the
+            address book to. Defaults to None (not persisted).
+
+            addrman (AddressBook): The addresses of known peers
+
+            profiler (Optional[Profiler], optional): Times every command and
+            the message handler when set. Defaults to None (not profiled).
+
             stop(asyncio.Event): Closes node when set
 
 
@@ -117,45 +203,66 @@ class Peer:
         self.max_outbound = max_outbound
         self.max_inbound = max_inbound
 
-        self.commands = {}
-        self._assign_commands()
+        self.relay_interval = relay_interval
+        self.relay_max_items = relay_max_items
+        self.relays = {}
+        self.relay_stats = RelayStats()
 
-        self.stop = asyncio.Event()
+        self.metrics = Registry()
+        self.metrics.add('relay_batch_size', self.relay_stats.batch_size,
+                         'Items in every relayed batch')
+        self.metrics.add('relay_latency_seconds', self.relay_stats.latency,
+                         'Seconds an item waited in a relay queue')
+        self.metrics.collector(self._peer_metrics)
+
+        self._messages = self.metrics.counter(
+            'messages_received', 'Messages received from all peers')
+        self._bytes = self.metrics.counter(
+            'bytes_received', 'Bytes received from all peers')
+        self._rate_limited = self.metrics.counter(
+            'commands_rate_limited', 'Commands delayed by the rate limiter')
+        self._dropped = self.metrics.counter(
+            'commands_dropped', 'Commands dropped because the workers were busy')
+
+        self.features = frozenset(features)
+
+        self.registry = PeerRegistry(heartbeat_interval=heartbeat_interval)
+
+        self.workers = WorkerPool(workers=workers, max_pending=max_pending)
+        self.limiter = RateLimiter(rate=rate_limit, capacity=rate_burst)
 
-    def _assign_commands(self):
+        # Peers relay with the same interval by default
+        self.command_costs = dict(self.COMMAND_COSTS)
+        for name in self.BATCHED_COMMANDS:
+            self.command_costs[name] = rate_limit * relay_interval * Peer.RELAY_SHARE
 
-        methods = []
-        this = type(self)
-        # attribute is a string representing the attribute name
-        for attribute in dir(this):
-            # Get the attribute value
-            attribute_value = getattr(this, attribute)
-            # Check that it is callable
-            if callable(attribute_value):
-                # Filter all dunder (__ prefix) methods
-                if attribute.startswith('__') == False:
-                    methods.append(attribute)
+        self.target_outbound = target_outbound
+        self.addrman = AddressBook(addrbook_path)
 
-        for method in methods:
-            try:
+        # The commands are replaced by timed versions only when profiling,
+        # so they cost nothing extra otherwise
+        self.profiler = profiler
+        if not profiler is None:
+            self._profile_commands()
 
-                method = getattr(self, method)
-                ref = self.commands.get(method.webname)
+        self.stop = asyncio.Event()
 
-                if ref is None:
-                    ref = [None, None]
+    def __init_subclass__(cls, **kwargs):
 
-                if hasattr(method, 'server'):
-                    ref[0] = method
+        super().__init_subclass__(**kwargs)
+        cls.COMMANDS = collect_commands(cls)
 
-                if hasattr(method, 'client'):
-                    ref[1] = method
+    def _profile_commands(self):
 
-                self.commands[method.webname] = ref
+        # Commands are called by their names, so the timed versions are used
+        for command in self.COMMANDS.values():
+            for kind, name in (('server', command.server),
+                               ('client', command.client)):
+                if not name is None:
+                    setattr(self, name, self.profiler.wrap(
+                        getattr(self, name), f'{kind}.{command.webname}'))
 
-            # Doesn't have an attribute of network command
-            except AttributeError:
-                pass
+        self.profiler.instrument(self, ['_handler'], 'peer')
 
     async def start(self, *args):
         """Starts the node. Set self.stop to stop the node.
@@ -164,12 +271,92 @@ class Peer:
             port (int): Which port to open the node in
         """
 
+        self.addrman.load()
+
         async with websockets.serve(self._init_connection, IP, self.port) as server:
             asyncio.create_task(self._init_node(server, *args))
+            maintainer = asyncio.create_task(self._maintain())
             await self.stop.wait()
 
+            maintainer.cancel()
+            self.workers.cancel()
             await self.disconnect(Peer.ALL)
 
+        await self._close_node()
+        self.addrman.save()
+
+    def shutdown(self):
+        """Stops the node. start() returns after all the connections are
+        closed
+        """
+        self.stop.set()
+
+    async def _close_node(self):
+        """The method which runs after the server is closed. override to
+        release resources
+        """
+        pass
+
+    async def _maintain(self):
+        """Keeps the outbound connections alive. Every heartbeat interval,
+        pings the outbound peers, drops the ones that don't answer and
+        reconnects to persistent peers whose backoff has passed.
+        """
+
+        while True:
+            await asyncio.sleep(self.registry.heartbeat_interval)
+
+            conns = list(self.outbound)
+            alive = await asyncio.gather(*[self.registry.heartbeat(conn)
+                                           for conn in conns])
+
+            for conn, is_alive in zip(conns, alive):
+                if not is_alive:
+                    log.warning('%s - No heartbeat, disconnecting', conn.str_addr)
+                    self.registry.failed(conn.listen_addr)
+                    await self.disconnect(conn)
+
+            await self._rotate()
+
+            for addr in self.registry.missing():
+                await self.connect(addr)
+
+            if len(self.outbound) < self.outbound_target():
+                await self._discover()
+                await self.fill_outbound()
+
+            self.addrman.save()
+
+    def outbound_target(self) -> int:
+        if self.max_outbound == -1:
+            return self.target_outbound
+
+        return min(self.target_outbound, self.max_outbound)
+
+    async def fill_outbound(self):
+        """Connects to peers from the address book until there are
+        target_outbound outbound connections
+        """
+
+        missing = self.outbound_target() - len(self.outbound)
+        if missing <= 0:
+            return
+
+        exclude = set(self.registry.conns)
+        exclude.add(canonical_addr((IP, self.port)))
+
+        for addr in self.addrman.select(missing, exclude=exclude):
+            if not self.registry.can_retry(addr):
+                continue
+
+            await self.connect(addr)
+
+    async def _discover(self):
+        """Learns new peer addresses. Called when there are not enough
+        outbound connections. override to ask peers for addresses
+        """
+        pass
+
     async def _init_node(self, server, *args):
         """The method which runs after the server is up. override to add more
         functionality
@@ -177,14 +364,14 @@ class Peer:
         Args:
             server (websocket.WebSocketServer): The server instance
         """
-        print(
-            f'Server started successfully. listening on ws://{IP}:{self.port}')
+        log.info('Server started successfully. listening on ws://%s:%s',
+                 IP, self.port)
 
     def find_conn(self, ip: int, port: int) -> PeerConnection:
 
         addr = (ip, port)
 
-        conn = next((conn for conn in self.outbound if conn.addr == addr), None)
+        conn = self.registry.get(canonical_addr(addr))
 
         if conn is None:
             conn = next((conn for conn in self.inbound if conn.addr == addr),
@@ -198,10 +385,28 @@ class Peer:
         """
 
         conn = PeerConnection(websocket)
+
+        if not self.max_inbound == -1 and len(self.inbound) >= self.max_inbound:
+            # Make room by evicting the worst behaving peer, if any misbehaved
+            worst = max(self.inbound, key=lambda c: c.score.misbehaviour,
+                        default=None)
+
+            if worst is None or worst.score.misbehaviour == 0:
+                log.warning('%s - Too many inbound connections, refusing',
+                            conn.str_addr)
+                await conn.close()
+                return
+
+            log.info('%s - Evicted to make room for %s',
+                     worst.str_addr, conn.str_addr)
+            await self.disconnect(worst)
+
         self.inbound.add(conn)
         # TODO: make sure the connection is working and valid before adding it
         await conn.listener(handler=self._handler)
-        self.inbound.remove(conn)
+        # Might have been removed already by disconnect
+        self.inbound.discard(conn)
+        self.limiter.forget(conn)
 
     async def _handler(self, data: Any, connection: PeerConnection):
         """The default handler function for each message for each connection.
@@ -214,91 +419,335 @@ class Peer:
             data from
         """
 
-        print(f'INFO {connection.str_addr} - Received new message {data}')
+        log.debug('%s - Received new message (%s bytes)',
+                  connection.str_addr, len(data))
+
+        self._messages.inc()
+        self._bytes.inc(len(data))
+
+        datatype = request_id = None
 
         try:
-            data = json.loads(data)
+            data = wire.decode(data)
 
             datatype, body = data['type'], data['data']
 
             # Check if got error
             if datatype == 'error':
-                print(
-                    f'WARNING {connection.str_addr} - Received error: {body["message"]}')
+                log.warning('%s - Received error: %s',
+                            connection.str_addr, body["message"])
                 return
 
-            command_name = body['command']
-
-            body_temp = copy.deepcopy(body)
-            del body_temp['command']
-            command_params = body_temp
-            command = self.commands[command_name][0]
-
-        except JSONDecodeError:
-            print(f'{connection.str_addr}: ERROR - not in json format')
-            await connection.send(self.pack(Peer.ERROR,
-                                  {'message': 'not in json format'}))
+            # The body was just decoded and belongs only to this message, so
+            # the command name can be removed from it without copying
+            command_name = body.pop('command')
+            request_id = body.pop('id', None)
+            command_params = body
+            command = self.COMMANDS[command_name]
+
+            if command.server is None:
+                raise KeyError(command_name)
+
+        except wire.DecodeError as e:
+            log.error('%s - %s', connection.str_addr, e)
+            await self._reply_error(connection, 'not in a valid format',
+                                    datatype, request_id)
+            await self.misbehaving(connection, 10, 'invalid message')
             return
 
         except KeyError as e:
-            print(f'{connection.str_addr}: ERROR - wrong format')
-            await connection.send(self.pack(Peer.ERROR,
-                                  {'message': 'wrong format'}))
+            log.error('%s - wrong format', connection.str_addr)
+            await self._reply_error(connection, 'wrong format', datatype,
+                                    request_id)
+            await self.misbehaving(connection, 5, 'wrong format')
             return
 
-        except TypeError as e:
+        except (TypeError, AttributeError) as e:
 
             if data is None:
-                print(f'{connection.str_addr}: INFO - got empty message')
+                log.info('%s - got empty message', connection.str_addr)
+
+            log.error('%s - %s', connection.str_addr, e)
+            await self._reply_error(connection, 'data must be a dictionary',
+                                    datatype, request_id)
+            await self.misbehaving(connection, 10, 'invalid message')
+            return
+
+        if not command.validate is None:
+            error = command.validate(command_params)
+
+            if not error is None:
+                log.warning('%s - %s for %s', connection.str_addr, error,
+                            command_name)
+                await self._reply_error(connection, error, datatype,
+                                        request_id)
+                await self.misbehaving(connection, 5, 'invalid parameters')
+                return
 
-            print(f'{connection.str_addr}: ERROR - {e}')
-            await connection.send(self.pack(Peer.ERROR,
-                                  {'message': 'data must be a dictionary'}))
+        # Peers over their rate are read slower instead of being refused. The
+        # listener waits for the handler, so their next messages wait too
+        cost = self.command_costs.get(command_name, 1)
+        delay = self.limiter.reserve(connection, cost)
+        if delay > 0:
+            log.debug('%s - Rate limited %s for %.3f seconds',
+                      connection.str_addr, command_name, delay)
+            self._rate_limited.inc()
+            await asyncio.sleep(delay)
+
+        # Run the command in the worker pool so a slow command doesn't stall
+        # the next messages of this connection
+        coro = self._run_command(getattr(self, command.server), datatype,
+                                 command_params, connection, request_id)
+        # A full pool is an overload of the whole node, not of this peer.
+        # Waiting for room would stall the listeners of every peer, so the
+        # command is shed and answered with an error instead
+        if not self.workers.submit(coro):
+            log.warning('%s - Overloaded, dropped %s',
+                        connection.str_addr, command_name)
+            self._dropped.inc()
+            await self._reply_error(connection, 'overloaded', datatype,
+                                    request_id)
+
+    async def _run_command(self, command, datatype: str, params: dict,
+                           connection: PeerConnection, request_id=None):
+
+        response = None
+        start = time.perf_counter()
 
         if datatype == 'get':
-            response = await command(command_params)
+            response = await command(params)
         if datatype == 'post':
-            response = await command(connection, command_params)
+            response = await command(connection, params)
+
+        elapsed = time.perf_counter() - start
+        self.metrics.histogram('command_seconds', 'Seconds to handle a command',
+                               command=command.webname).observe(elapsed)
+
+        # Posts without an id don't wait for an answer
+        if response is None or request_id is None and datatype != 'get':
+            return
+
+        # Lets the requester match the response to its request
+        if not request_id is None:
+            response['id'] = request_id
+
+        await connection.send(response)
+
+    async def _reply_error(self, connection: PeerConnection, message: str,
+                           datatype: Optional[str], request_id=None):
+        """Answers a message with Peer.ERROR, tagged with the id of the
+        request. Posts without an id are fire and forget, so they get no
+        answer that could be taken for the answer of a later request
+        """
+
+        if request_id is None and datatype != 'get':
+            return
+
+        error = self.pack(Peer.ERROR, {'message': message})
+        if not request_id is None:
+            error['id'] = request_id
+
+        await connection.send(error)
 
-        if not response is None:
-            await connection.send(response)
+    def _peer_metrics(self):
+        """Yields the bytes sent to and received from every connected peer,
+        collected only when the metrics are read
+        """
+
+        for direction, conns in (('inbound', self.inbound),
+                                 ('outbound', self.outbound)):
+            for conn in list(conns):
+                labels = {'peer': conn.str_addr, 'direction': direction}
+                yield 'peer_bytes_sent', labels, Counter(conn.bytes_sent)
+                yield 'peer_bytes_received', labels, Counter(conn.bytes_received)
 
-    async def connect(self, addr: Union[str, Tuple[str, int]]):
+    async def connect(self, addr: Union[str, Tuple[str, int]],
+                      persistent: bool = False):
         """Connects to a peer
 
         Args:
             addr (Union[str, Tuple[str, int]): The address of the peer we want to connect
             to. can be either a uri or a tuple containing the ip and the port
+
+            persistent (bool, optional): Reconnect to this peer whenever the
+            connection drops. Defaults to False.
+
+        Returns:
+            PeerConnection: The new connection. None if we are already
+            connected to this peer (use acquire to get the existing connection)
+            or if the connection failed
         """
 
-        if isinstance(addr, tuple):
-            uri = f'ws://{addr[0]}:{addr[1]}'
-        else:
-            uri = addr
+        try:
+            addr = canonical_addr(addr)
+        except ValueError as e:
+            log.error('%s', e)
+            return
+
+        if persistent:
+            self.registry.persistent.add(addr)
 
         # Check if this connection already exits
-        for node in self.outbound:
-            node_uri = f'ws://{node.addr[0]}:{node.addr[1]}'
-            if node_uri == uri.replace("localhost", "127.0.0.1"):
-                print(f'ERROR - already conncted to {node.str_addr}')
+        existing = self.registry.get(addr)
+        if not existing is None:
+            log.error('already conncted to %s', existing.str_addr)
+            return
+
+        if not self.max_outbound == -1 and len(self.outbound) >= self.max_outbound:
+            # Replace the worst peer only if it should be replaced anyway
+            worst = self.best_peers()[-1] if self.outbound else None
+
+            if worst is None or not worst.score.should_rotate():
+                log.error('Too many outbound connections, not connecting to %s',
+                          addr)
                 return
 
+            log.info('%s - Replaced by %s', worst.str_addr, addr)
+            await self.disconnect(worst)
+
+        uri = to_uri(addr)
+        self.addrman.attempt(addr)
+
         try:
             client = await websockets.connect(uri)
 
-        except ConnectionRefusedError:
-            print(f'ERROR - {uri} refused connection ')
+        except OSError:
+            log.error('%s refused connection', uri)
+            self.registry.failed(addr)
+            self.addrman.failed(addr)
             return
 
         except InvalidURI:
-            print(f'ERROR - "{uri}" is not a valid uri')
+            log.error('"%s" is not a valid uri', uri)
             return
 
         conn = PeerConnection(client, connected=False)
+        conn.listen_addr = addr
         self.outbound.add(conn)
+        self.registry.add(addr, conn)
+        self.addrman.good(addr)
+
+        await self.hello(conn)
+
+        return conn
+
+    async def acquire(self, addr: Union[str, Tuple[str, int]]) -> Optional[PeerConnection]:
+        """Returns an open outbound connection to a peer. Reuses the pooled
+        connection when there is one, so requests don't pay for a new
+        handshake. Doesn't retry peers that failed recently.
+
+        Args:
+            addr (Union[str, Tuple[str, int]): The address of the peer
+
+        Returns:
+            Optional[PeerConnection]: The connection, None if we couldn't
+            connect
+        """
+
+        try:
+            addr = canonical_addr(addr)
+        except ValueError as e:
+            log.error('%s', e)
+            return
+
+        conn = self.registry.get(addr)
+
+        if conn is None and self.registry.can_retry(addr):
+            conn = await self.connect(addr)
 
         return conn
 
+    def best_peers(self, n: Optional[int] = None,
+                   conns: Optional[Iterable[PeerConnection]] = None) -> List[PeerConnection]:
+        """Returns the peers sorted from best to worst by their score (see
+        PeerScore.cost)
+
+        Args:
+            n (Optional[int], optional): Return only the n best peers. Defaults
+            to all of them.
+            conns (Optional[Iterable[PeerConnection]], optional): The peers to
+            choose from. Defaults to the outbound peers.
+
+        Returns:
+            List[PeerConnection]: The peers
+        """
+
+        conns = sorted(self.outbound if conns is None else conns,
+                       key=lambda conn: conn.score.cost())
+        return conns if n is None else conns[:n]
+
+    async def misbehaving(self, conn: PeerConnection, points: int, reason: str):
+        """Adds misbehaviour points to a peer. Peers that reach BAN_SCORE are
+        disconnected and not reconnected for a while
+
+        Args:
+            conn (PeerConnection): The peer
+            points (int): The points to add
+            reason (str): What the peer did
+        """
+
+        conn.score.punish(points)
+        log.warning('%s - Misbehaving (%s), score %s/%s',
+                    conn.str_addr, reason, conn.score.misbehaviour, BAN_SCORE)
+
+        if conn.score.banned:
+            log.warning('%s - Banned', conn.str_addr)
+
+            if not conn.listen_addr is None:
+                self.registry.ban(conn.listen_addr)
+
+            await self.disconnect(conn)
+
+    async def _rotate(self):
+        """Disconnects outbound peers that are too slow, unreliable or
+        misbehaving. Persistent peers are reconnected later with backoff, the
+        rest are replaced by other peers.
+        """
+
+        for conn in list(self.outbound):
+            if conn.score.should_rotate():
+                log.info('%s - Rotating out peer %s', conn.str_addr, conn.score)
+                self.registry.failed(conn.listen_addr)
+                await self.disconnect(conn)
+
+    async def hello(self, conn: PeerConnection):
+        """Agrees with a peer on the wire features of a connection. Peers that
+        don't know this command answer with an error and the connection stays
+        in plain json.
+
+        Args:
+            conn (PeerConnection): The outbound connection
+        """
+
+        response = await conn.request(self.pack(Peer.POST,
+                                                {'command': 'hello',
+                                                 'features': sorted(self.features),
+                                                 'port': self.port}))
+
+        try:
+            conn.features = self.features & frozenset(response['data']['features'])
+        except (KeyError, TypeError):
+            return
+
+        if conn.features:
+            log.info('%s - Using wire features %s',
+                     conn.str_addr, sorted(conn.features))
+
+    @server(params={'features': (list, None), 'port': (int, None)})
+    async def _hello(self, conn: PeerConnection, params: dict):
+
+        # Remember where the peer accepts connections so we can send it
+        # requests through a pooled outbound connection
+        port = params.get('port')
+        if isinstance(port, int):
+            conn.listen_addr = canonical_addr((conn.addr[0], port))
+
+        # The answer may already use the new features since connections
+        # can always receive both json and binary frames
+        conn.features = self.features & frozenset(params.get('features', ()))
+
+        return self.pack(Peer.OKAY, {'features': sorted(conn.features)})
+
     async def disconnect(self, peer_conn: Union[PeerConnection, int]):
         """Disconnect from a peer
 
@@ -314,24 +763,30 @@ class Peer:
         if isinstance(peer_conn, int):
             match peer_conn:
                 case Peer.ALL:
-                    for conn in self.inbound:
+                    # Closing a connection removes it from its set, so close
+                    # copies of the sets
+                    for conn in list(self.inbound):
                         await conn.close()
 
                     self.inbound = set()
 
-                    for conn in self.outbound:
+                    for conn in list(self.outbound):
+                        self.registry.remove(conn)
+                        await self._close_relay(conn)
                         await conn.close()
 
                     self.outbound = set()
 
                 case Peer.OUTBOUND:
-                    for conn in self.outbound:
+                    for conn in list(self.outbound):
+                        self.registry.remove(conn)
+                        await self._close_relay(conn)
                         await conn.close()
 
                     self.outbound = set()
 
                 case Peer.INBOUND:
-                    for conn in self.inbound:
+                    for conn in list(self.inbound):
                         await conn.close()
 
                     self.inbound = set()
@@ -345,6 +800,8 @@ class Peer:
 
             elif peer_conn in self.outbound:
                 self.outbound.remove(peer_conn)
+                self.registry.remove(peer_conn)
+                await self._close_relay(peer_conn)
                 await peer_conn.close()
 
             else:
@@ -352,6 +809,114 @@ class Peer:
 
         return True
 
+    async def fanout(self, data: Any,
+                     conns: Optional[Iterable[PeerConnection]] = None,
+                     k: Optional[int] = None,
+                     key: Optional[Callable[[Any], Hashable]] = None,
+                     timeout: float = 3,
+                     hedge_after: Optional[float] = None) -> List[Tuple[PeerConnection, Any]]:
+        """Sends a request to many peers and returns as soon as enough of them
+        answered. Peers are asked in order of their score, best first.
+
+        Args:
+            data (Any): The packed request
+
+            conns (Optional[Iterable[PeerConnection]], optional): The peers to
+            ask. Defaults to all the outbound peers.
+
+            k (Optional[int], optional): How many answers are enough. Defaults
+            to all the peers.
+
+            key (Optional[Callable[[Any], Hashable]], optional): When given,
+            answers are grouped by key(answer) and the function returns once k
+            answers agree (a quorum). Answers that key can't read are ignored.
+            Defaults to None.
+
+            timeout (float, optional): Max seconds to wait for the answers.
+            Defaults to 3.
+
+            hedge_after (Optional[float], optional): When given, only the k
+            fastest peers are asked first. Another peer is asked whenever no
+            answer arrived for hedge_after seconds or a peer failed. Defaults
+            to asking all peers at once.
+
+        Returns:
+            List[Tuple[PeerConnection, Any]]: The answers with their peers. If
+            there was no quorum in time, the biggest group of agreeing answers
+            (or all the answers when key is None)
+        """
+
+        conns = self.best_peers(conns=conns)
+
+        if k is None or k > len(conns):
+            k = len(conns)
+
+        waiting = deque(conns)
+        tasks = {}
+
+        def launch(n):
+            for _ in range(min(n, len(waiting))):
+                conn = waiting.popleft()
+                task = asyncio.create_task(conn.request(data, timeout=timeout))
+                tasks[task] = conn
+
+        launch(len(conns) if hedge_after is None else k)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        results = []
+        groups = {}
+
+        try:
+            while tasks:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+
+                wait = remaining
+                if not hedge_after is None and waiting:
+                    wait = min(remaining, hedge_after)
+
+                done, _ = await asyncio.wait(tasks, timeout=wait,
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                # Nothing arrived in time, ask one more peer
+                if not done:
+                    launch(1)
+                    continue
+
+                for task in done:
+                    conn = tasks.pop(task)
+                    response = task.result()
+
+                    if response is None:
+                        launch(1)
+                        continue
+
+                    if key is None:
+                        results.append((conn, response))
+                        if len(results) >= k:
+                            return results
+                        continue
+
+                    try:
+                        group = groups.setdefault(key(response), [])
+                    except (KeyError, TypeError, IndexError):
+                        continue
+
+                    group.append((conn, response))
+                    if len(group) >= k:
+                        return group
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if key is None:
+            return results
+
+        return max(groups.values(), key=len, default=[])
+
     async def recvall(self, return_when: Optional[str] = None, timeout: int = 3):
         """receives from all connections and blocks the the function untill
         received
@@ -408,10 +973,75 @@ class Peer:
             json. Defaults to False.
         """
 
-        coros = [peer.send(data, raw) for peer in self.outbound]
+        # Encode the message once for every wire format instead of once for
+        # every peer
+        encoded = {}
+        coros = []
+        for peer in self.outbound:
+            if not raw:
+                frame = encoded.get(peer.features)
+                if frame is None:
+                    frame = encoded[peer.features] = peer.encode(data)
+            else:
+                frame = data
+
+            coros.append(peer.send(frame, raw=True))
+
         # coros += [peer.send(data, raw) for peer in self.inbound]
         await asyncio.gather(*coros)
 
+    def relay(self, item: Any):
+        """Queues an item to be relayed to all outbound peers. Items are sent
+        in batches by _flush_relay. Use broadcast for urgent messages such as
+        blocks, which should not wait for a batch.
+
+        Args:
+            item (Any): The item to relay
+        """
+
+        for conn in self.outbound:
+            self.relay_queue(conn).put(item)
+
+    def relay_queue(self, conn: PeerConnection) -> RelayQueue:
+        """Returns the relay queue of a connection, creates it if needed
+
+        Args:
+            conn (PeerConnection): The connection
+
+        Returns:
+            RelayQueue: The queue
+        """
+
+        queue = self.relays.get(conn)
+
+        if queue is None:
+            queue = RelayQueue(conn, self._flush_relay,
+                               interval=self.relay_interval,
+                               max_items=self.relay_max_items,
+                               stats=self.relay_stats)
+            self.relays[conn] = queue
+
+        return queue
+
+    async def _flush_relay(self, conn: PeerConnection, items: list):
+        """Sends a batch of relayed items to a connection. By default every
+        item is sent on its own, override to send the batch in one message
+
+        Args:
+            conn (PeerConnection): The connection
+            items (list): The batch
+        """
+
+        for item in items:
+            await conn.send(item)
+
+    async def _close_relay(self, conn: PeerConnection):
+
+        queue = self.relays.pop(conn, None)
+
+        if queue is not None:
+            await queue.close()
+
     def connections(self) -> int:
         """Returns the number on online connections
 
@@ -427,7 +1057,7 @@ class Peer:
         Args:
             data (dict): the data
         """
-        print(f'No command is found. message: {data}')
+        log.info('No command is found. message: %s', data)
 
     def pack(self, datatype: int, data: Any) -> dict:
         """Packs the data to be ready to send over the network.
@@ -456,6 +1086,10 @@ class Peer:
                 return {'type': 'error', 'data': data}
 
 
+# __init_subclass__ only runs for subclasses
+Peer.COMMANDS = collect_commands(Peer)
+
+
 async def main():
 
     peer = Peer()
@@ -0,0 +1,185 @@
+import asyncio
+import ipaddress
+import random
+import time
+from typing import Dict, Optional, Set, Tuple, Union
+from urllib.parse import urlsplit
+
+from websockets.exceptions import ConnectionClosed
+
+from .connection import PeerConnection
+
+Addr = Tuple[str, int]
+
+
+def canonical_addr(addr: Union[str, Tuple[str, int]]) -> Addr:
+    """Converts an address to the form used as a key in the registry, so the
+    same peer always has the same key no matter how its address was written.
+
+    Args:
+        addr (Union[str, Tuple[str, int]]): A uri (ws://ip:port) or a tuple
+        containing the ip and the port
+
+    Raises:
+        ValueError: The address is not valid
+
+    Returns:
+        Tuple[str, int]: The ip and the port
+    """
+
+    if isinstance(addr, str):
+        split = urlsplit(addr)
+        host, port = split.hostname, split.port
+        if host is None or port is None:
+            raise ValueError(f'"{addr}" is not a valid uri')
+    else:
+        host, port = addr[0], addr[1]
+
+    host = host.lower()
+    if host == 'localhost':
+        host = '127.0.0.1'
+
+    try:
+        host = str(ipaddress.ip_address(host))
+    except ValueError:
+        pass    # A host name
+
+    return host, int(port)
+
+
+def to_uri(addr: Addr) -> str:
+    host = f'[{addr[0]}]' if ':' in addr[0] else addr[0]
+    return f'ws://{host}:{addr[1]}'
+
+
+class PeerRegistry:
+
+    def __init__(self, heartbeat_interval: float = 20,
+                 heartbeat_timeout: float = 10,
+                 backoff_min: float = 1,
+                 backoff_max: float = 300):
+        """Keeps the outbound connections by their canonical address so they
+        can be found and reused instead of opening a new connection for every
+        request. Tracks failed addresses so they are retried with exponential
+        backoff.
+
+        Args:
+            heartbeat_interval (float, optional): Seconds between heartbeats.
+            Defaults to 20.
+
+            heartbeat_timeout (float, optional): Seconds to wait for a pong
+            before the connection is considered dead. Defaults to 10.
+
+            backoff_min (float, optional): Seconds to wait before the first
+            retry. Doubles with every failure. Defaults to 1.
+
+            backoff_max (float, optional): Max seconds between retries.
+            Defaults to 300.
+
+        Attributes:
+            conns (Dict[Addr, PeerConnection]): The pooled connections
+
+            persistent (Set[Addr]): Addresses we want to stay connected to.
+            They are reconnected when their connection drops.
+        """
+
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self.conns: Dict[Addr, PeerConnection] = {}
+        self.persistent: Set[Addr] = set()
+
+        self.failures: Dict[Addr, int] = {}
+        self.retry_at: Dict[Addr, float] = {}
+
+    def __contains__(self, addr: Addr):
+        return self.get(addr) is not None
+
+    def __len__(self):
+        return len(self.conns)
+
+    def get(self, addr: Addr) -> Optional[PeerConnection]:
+        """Returns the open connection to an address
+
+        Args:
+            addr (Addr): The canonical address
+
+        Returns:
+            Optional[PeerConnection]: The connection, None if there is no open
+            connection
+        """
+
+        conn = self.conns.get(addr)
+
+        if conn is not None and not conn.is_open:
+            del self.conns[addr]
+            return None
+
+        return conn
+
+    def add(self, addr: Addr, conn: PeerConnection):
+        self.conns[addr] = conn
+        self.failures.pop(addr, None)
+        self.retry_at.pop(addr, None)
+
+    def remove(self, conn: PeerConnection):
+
+        addr = conn.listen_addr
+        if self.conns.get(addr) is conn:
+            del self.conns[addr]
+
+    def failed(self, addr: Addr):
+        """Records a failed connection attempt and sets when to retry it
+
+        Args:
+            addr (Addr): The canonical address
+        """
+
+        failures = self.failures.get(addr, 0) + 1
+        self.failures[addr] = failures
+
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (failures - 1))
+        # Add jitter so peers that dropped together don't retry together
+        self.retry_at[addr] = time.monotonic() + delay * random.uniform(0.5, 1)
+
+    def ban(self, addr: Addr, duration: float = 3600):
+        """Prevents reconnecting to an address for a while
+
+        Args:
+            addr (Addr): The canonical address
+            duration (float, optional): Seconds to wait. Defaults to an hour.
+        """
+        self.retry_at[addr] = time.monotonic() + duration
+
+    def can_retry(self, addr: Addr) -> bool:
+        return time.monotonic() >= self.retry_at.get(addr, 0)
+
+    def missing(self):
+        """Returns the persistent addresses without a connection that can be
+        retried now
+
+        Returns:
+            List[Addr]: The addresses
+        """
+        return [addr for addr in self.persistent
+                if self.get(addr) is None and self.can_retry(addr)]
+
+    async def heartbeat(self, conn: PeerConnection) -> bool:
+        """Pings a connection
+
+        Args:
+            conn (PeerConnection): The connection
+
+        Returns:
+            bool: True if the peer answered in time
+        """
+
+        try:
+            pong = await conn.websocket.ping()
+            await asyncio.wait_for(pong, timeout=self.heartbeat_timeout)
+            return True
+
+        except (ConnectionClosed, asyncio.TimeoutError, RuntimeError):
+            return False
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+from metrics import Histogram
+
+from .connection import PeerConnection
+
+log = logging.getLogger(__name__)
+
+class RelayStats:
+
+    BATCH_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+
+    def __init__(self):
+        """Statistics shared by all the relay queues of a peer.
+
+        Attributes:
+            batch_size (Histogram): Number of items in every flushed batch
+
+            latency (Histogram): Seconds an item waited in the queue before it
+            was sent
+        """
+
+        self.batch_size = Histogram(RelayStats.BATCH_BUCKETS)
+        self.latency = Histogram(RelayStats.LATENCY_BUCKETS)
+
+    def snapshot(self) -> dict:
+        return {'batch_size': self.batch_size.snapshot(),
+                'latency': self.latency.snapshot()}
+
+
+class RelayQueue:
+
+    def __init__(self, conn: PeerConnection,
+                 handler: Callable[[PeerConnection, List[Any]], Awaitable],
+                 interval: float = 0.1,
+                 max_items: int = 500,
+                 stats: Optional[RelayStats] = None):
+        """A relay queue of a single connection. Announcements are accumulated
+        and sent together as one batch every interval seconds, or as soon as
+        max_items are waiting, whichever comes first. Only low priority
+        announcements (transactions) should go through the queue, blocks are
+        sent directly so they never wait behind a batch. The flushing task
+        only runs while there are items in the queue.
+
+        Args:
+            conn (PeerConnection): The connection to relay to
+
+            handler (Callable[[PeerConnection, List[Any]], Awaitable]): Sends
+            a batch of items to the connection. Called with the connection and
+            the list of items.
+
+            interval (float, optional): Max seconds an item waits in the queue.
+            Defaults to 0.1.
+
+            max_items (int, optional): Flushes the queue when it reaches this
+            size. Defaults to 500.
+
+            stats (Optional[RelayStats], optional): Where to report batch sizes
+            and latencies. Defaults to a new RelayStats.
+        """
+
+        self.conn = conn
+        self.handler = handler
+        self.interval = interval
+        self.max_items = max_items
+        self.stats = RelayStats() if stats is None else stats
+
+        self.items = []     # Tuples of (enqueue time, item)
+        self._full = asyncio.Event()
+        self._task = None
+
+    def put(self, item: Any):
+        """Adds an item to the queue. Starts the flushing task if it is not
+        running yet.
+
+        Args:
+            item (Any): The item to relay
+        """
+
+        self.items.append((time.monotonic(), item))
+
+        if len(self.items) >= self.max_items:
+            self._full.set()
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self.items)
+
+    async def _run(self):
+
+        try:
+            # An empty queue stops the task, put starts a new one
+            while self.items:
+                try:
+                    await asyncio.wait_for(self._full.wait(),
+                                           timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                await self.flush()
+
+        finally:
+            # close may have replaced the task already
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    async def flush(self):
+        """Sends all the waiting items as batches of up to max_items. A
+        batch that fails to send is dropped, so one bad batch doesn't stop
+        the queue
+        """
+
+        self._full.clear()
+
+        while self.items:
+            batch = self.items[:self.max_items]
+            del self.items[:self.max_items]
+
+            now = time.monotonic()
+            for enqueued, _ in batch:
+                self.stats.latency.observe(now - enqueued)
+            self.stats.batch_size.observe(len(batch))
+
+            try:
+                await self.handler(self.conn, [item for _, item in batch])
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                log.exception('%s - Failed to relay %s items',
+                              self.conn.str_addr, len(batch))
+
+    async def close(self, flush: bool = False):
+        """Stops the flushing task.
+
+        Args:
+            flush (bool, optional): Send the waiting items before closing.
+            Defaults to False.
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if flush:
+            await self.flush()
+        else:
+            self.items = []
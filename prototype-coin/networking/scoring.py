@@ -0,0 +1,105 @@
+from typing import Optional
+
+ALPHA = 0.2             # Weight of the newest sample in the moving averages
+DEFAULT_RTT = 0.5       # Assumed round trip time of peers we didn't measure
+BAN_SCORE = 100         # Misbehaviour points before a peer is disconnected
+
+# Peers are rotated out when they are worse than these
+MAX_RTT = 2
+MAX_ERROR_RATE = 0.5
+MIN_REQUESTS = 5        # Requests needed before the error rate is trusted
+
+
+class PeerScore:
+
+    def __init__(self):
+        """Rolling statistics about a peer, used to choose the best peers for
+        requests and to find peers that should be replaced.
+
+        Attributes:
+            rtt (Optional[float]): Moving average of the round trip time in
+            seconds. None until the first answer
+
+            throughput (Optional[float]): Moving average of the response bytes
+            per second
+
+            error_rate (float): Moving average of failed requests (timeouts
+            and error responses), between 0 and 1
+
+            misbehaviour (int): Points for invalid messages and data. The peer
+            is banned when it reaches BAN_SCORE
+
+            requests (int): Number of requests that were sent to this peer
+        """
+
+        self.rtt: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.error_rate = 0.0
+        self.misbehaviour = 0
+        self.requests = 0
+
+    def __repr__(self):
+        return f'PeerScore(rtt={self.rtt}, throughput={self.throughput}, \
+error_rate={self.error_rate:.2f}, misbehaviour={self.misbehaviour})'
+
+    def success(self, rtt: float, size: int = 0):
+        """Records an answered request
+
+        Args:
+            rtt (float): Seconds until the answer arrived
+            size (int, optional): Size of the answer in bytes. Defaults to 0.
+        """
+
+        self.requests += 1
+        self.rtt = _average(self.rtt, rtt)
+        self.error_rate = _average(self.error_rate, 0)
+
+        if rtt > 0:
+            self.throughput = _average(self.throughput, size / rtt)
+
+    def failure(self):
+        """Records a request that timed out or was answered with an error
+        """
+
+        self.requests += 1
+        self.error_rate = _average(self.error_rate, 1)
+
+    def punish(self, points: int):
+        self.misbehaviour += points
+
+    @property
+    def banned(self) -> bool:
+        return self.misbehaviour >= BAN_SCORE
+
+    def cost(self) -> float:
+        """The expected cost of sending a request to this peer, lower is
+        better. It is the round trip time, inflated by the error rate and the
+        misbehaviour points
+
+        Returns:
+            float: The cost
+        """
+
+        rtt = DEFAULT_RTT if self.rtt is None else self.rtt
+        return rtt * (1 + 4 * self.error_rate) * (1 + self.misbehaviour / 10)
+
+    def should_rotate(self) -> bool:
+        """Checks if the peer is slow, unreliable or misbehaving enough to be
+        replaced by another peer
+
+        Returns:
+            bool: True if the peer should be replaced
+        """
+
+        if self.banned:
+            return True
+
+        if self.requests < MIN_REQUESTS:
+            return False
+
+        return self.error_rate > MAX_ERROR_RATE or \
+            (self.rtt is not None and self.rtt > MAX_RTT)
+
+
+def _average(old: Optional[float], new: float) -> float:
+    return new if old is None else old + ALPHA * (new - old)
@@ -0,0 +1,118 @@
+import json
+import struct
+import zlib
+from typing import Any, Iterable, Union
+
+MAGIC = b'PC'
+VERSION = 1
+
+HEADER = struct.Struct('>2sBBI')   # Magic, version, flags, payload length
+COMPRESSED = 0b1    # Flag: the payload is compressed with zlib
+
+BINARY = 'binary'   # Feature: send messages in binary frames
+ZLIB = 'zlib'       # Feature: compress big binary frames
+FEATURES = (BINARY, ZLIB)
+
+COMPRESS_MIN = 1024             # Smallest payload that is worth compressing
+MAX_SIZE = 32 * 1024 * 1024     # Biggest payload we agree to decode
+
+
+class DecodeError(ValueError):
+
+    def __init__(self, message="Message is not in a valid format"):
+        super().__init__(message)
+
+
+def dumps(data: Any) -> bytes:
+    """Encodes data in the canonical encoding. The same encoding is used to
+    calculate transaction ids (see block.txn_hash): compact json without
+    whitespace. Blocks and transactions are encoded as they are sent in json
+    messages, so both formats carry the same data.
+
+    Args:
+        data (Any): The data
+
+    Returns:
+        bytes: The encoded data
+    """
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def encode(data: Any, features: Iterable[str] = ()) -> Union[str, bytes]:
+    """Encodes a message for a connection with the given features. Without the
+    binary feature the message is plain json text, so peers that don't know
+    this format can still read it.
+
+    Args:
+        data (Any): The message
+        features (Iterable[str], optional): The negotiated features of the
+        connection. Defaults to no features.
+
+    Returns:
+        Union[str, bytes]: The frame to send
+    """
+
+    if not BINARY in features:
+        return json.dumps(data)
+
+    payload = dumps(data)
+    flags = 0
+
+    if ZLIB in features and len(payload) >= COMPRESS_MIN:
+        compressed = zlib.compress(payload)
+
+        # Small or random payloads might not shrink
+        if len(compressed) < len(payload):
+            flags |= COMPRESSED
+            return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + compressed
+
+    return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + payload
+
+
+def decode(frame: Union[str, bytes]) -> Any:
+    """Decodes a message. Text frames are read as json and binary frames as
+    this module's format, so connections can receive both at any time.
+
+    Args:
+        frame (Union[str, bytes]): The received frame
+
+    Raises:
+        DecodeError: The frame is not a valid message
+
+    Returns:
+        Any: The message
+    """
+
+    if isinstance(frame, str):
+        try:
+            return json.loads(frame)
+        except json.JSONDecodeError as e:
+            raise DecodeError(f'not in json format: {e}')
+
+    if len(frame) < HEADER.size:
+        raise DecodeError('frame is too short')
+
+    magic, version, flags, length = HEADER.unpack_from(frame)
+
+    if magic != MAGIC or version != VERSION:
+        raise DecodeError('unknown frame header')
+
+    if length > MAX_SIZE:
+        raise DecodeError('frame is too big')
+
+    payload = memoryview(frame)[HEADER.size:]
+
+    if flags & COMPRESSED:
+        try:
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, length)
+        except zlib.error as e:
+            raise DecodeError(f'invalid compressed payload: {e}')
+
+    if len(payload) != length:
+        raise DecodeError('payload length does not match header')
+
+    try:
+        return json.loads(bytes(payload))
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise DecodeError(f'invalid payload: {e}')
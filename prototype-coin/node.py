@@ -1,16 +1,56 @@
 import asyncio
-from typing import Optional
+import logging
+import os
+from collections import deque
+from typing import Dict, Optional
 
 import block as blk
+import compact
 from blockchain import Blockchain
+from metrics import MetricsServer
 from miner import Miner
+from monitor import LoopMonitor
 from networking import Peer, client, server
+from networking.addrman import MAX_SHARED
+from networking.peer import PORT
+from profiler import Profiler
+from validation import check_pow
 from wallet import Wallet
 
+log = logging.getLogger(__name__)
+
+LOCAL_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+
 class Node(Peer):
 
     ALL = 0
     SINGLE = 1
+    BEST = 2
+
+    BEST_TRIES = 3      # Peers to try in Node.BEST requests
+    HEDGE_AFTER = 0.5   # Seconds before asking another peer in sync queries
+    MAX_HELD = 100      # Block announcements kept until the blockchain is synced
+    MAX_ADDRESSES = 50  # Addresses in a single get_address request
+
+    # Methods that are timed when profiling
+    PROFILED_BLOCKCHAIN = ['add_block', 'add_blocks', 'get_block', 'get_txn',
+                           'get_address', 'save', 'load', 'prune', 'flush']
+    PROFILED_STORAGE = ['_write_batch', 'recover', 'prune']
+
+    COMMAND_COSTS = {**Peer.COMMAND_COSTS,
+                     'get_blocks': 20,
+                     'get_nodes': 2,
+                     'get_block': 2,
+                     'get_block_txns': 2,
+                     'post_block': 2,
+                     'post_cmpct_block': 2,
+                     'get_txn': 1,
+                     'get_address': 5,
+                     'get_metrics': 5,
+                     'profile': 5}
+
+    BATCHED_COMMANDS = ('post_txns', )
 
     #TODO: choose port number for all nodes
     def __init__(self, port: Optional[int]=11111,
@@ -18,108 +58,355 @@ class Node(Peer):
                  max_inbound: int=-1,
                  blockchain: Optional[Blockchain]=None,
                  blockchain_dir: Optional[str]=None,
-                 miner: Optional[Miner]=None):
+                 miner: Optional[Miner]=None,
+                 relay_interval: float=0.1,
+                 relay_max_items: int=500,
+                 target_outbound: int=8,
+                 addrbook_path: Optional[str]=None,
+                 txindex: bool=False,
+                 checkpoints: Optional[Dict[int, str]]=None,
+                 metrics_port: Optional[int]=None,
+                 profiler: Optional[Profiler]=None):
         
         super().__init__(port=port,
                          max_outbound=max_outbound,
-                         max_inbound=max_inbound)
+                         max_inbound=max_inbound,
+                         relay_interval=relay_interval,
+                         relay_max_items=relay_max_items,
+                         target_outbound=target_outbound,
+                         addrbook_path=addrbook_path,
+                         profiler=profiler)
 
         if blockchain is None:
-            self.blockchain = Blockchain(data_dir=blockchain_dir)
+            self.blockchain = Blockchain(data_dir=blockchain_dir,
+                                         txindex=txindex,
+                                         checkpoints=checkpoints)
         else:
             self.blockchain = blockchain
 
+        # Keep the known peers next to the blockchain by default
+        if addrbook_path is None:
+            self.addrman.path = os.path.join(self.blockchain.PATH, 'peers.csv')
+
         self.miner = miner
+        self._mining = None     # The mining task
+
+        self.loop_monitor = LoopMonitor()
+        self.wallets = []
+
+        self.metrics.include(self.blockchain.metrics)
+        self.metrics.add('loop_lag_seconds', self.loop_monitor.lag,
+                         'How much later than expected the event loop woke up')
+        self.metrics.gauge('mempool_txns', 'Transactions waiting to be mined',
+                           func=self._mempool_size)
+        self.metrics.gauge('hash_rate', 'Hashes per second of the miner',
+                           func=self._hash_rate)
+
+        if not profiler is None:
+            profiler.instrument(self.blockchain, Node.PROFILED_BLOCKCHAIN,
+                                'blockchain')
+            profiler.instrument(self.blockchain.writer, Node.PROFILED_STORAGE,
+                                'storage')
+            self.metrics.include(profiler.metrics)
+
+        # Serves the metrics to local tools when a port is set
+        self.metrics_server = None
+        if not metrics_port is None:
+            self.metrics_server = MetricsServer(self.metrics, metrics_port)
 
         # Stuff received from the network
         self.recent_txns = []
         self.recent_blocks = []
 
+        # The blockchain is loaded or downloaded in its io thread after the
+        # connections are open, blocks that arrive before that wait for it
+        self.synced = asyncio.Event()
+        self._held = deque(maxlen=Node.MAX_HELD)
+
     async def _init_node(self, server, *addrs):
-        # TODO: Check last few hashed and get the most trustworthy nodes
         # TODO: Split block requests to disperse network pressure
         
         await super()._init_node(server)
-        
-        # Connect to as much connections as possible
-        # self.scan_network()
+        self.loop_monitor.start()
+
+        if not self.metrics_server is None:
+            await self.metrics_server.start()
+
+        if not self.profiler is None:
+            self.profiler.start()
         
         for addr in addrs:
-            await self.connect(addr)
+            await self.connect(addr, persistent=True)
+
+        # Connect to known peers from previous runs, then ask them for more
+        await self.fill_outbound()
+        await self._discover()
+        await self.fill_outbound()
         
-        print('INFO - Loading the blockchain from disk...')
+        log.info('Loading the blockchain from disk...')
         
+        loop = asyncio.get_running_loop()
+
         try:
-            result = self.blockchain.load()
+            result = await loop.run_in_executor(self.blockchain.io,
+                                                self.blockchain.load)
             
             # If not new blocks were added, download the blockchain
             if not result:
                 raise FileNotFoundError
             
         except FileNotFoundError:
-            print('WARNING - No blockchain is found at the set location. Downloading blockchain from the web')
+            log.warning('No blockchain is found at the set location. Downloading blockchain from the web')
             
             try:
+                # Every peer is asked, a slow peer may be the one with the
+                # tallest chain. Ties go to the best scored peer
                 heights = await self.get_height()
-                max_peer = max(heights, key=lambda x: x[1])[0]
+                max_peer = max(heights,
+                               key=lambda x: (x[1], -x[0].score.cost()))[0]
                 response = await self.get_blocks(mode=Node.SINGLE, conn=max_peer)
                 blocks = response[0][1]
-                self.blockchain.add_blocks(blocks, update_file=False)
 
-            except ValueError as e:
-                print('WARNING - Not connected to any nodes')
-            
-        # Create the blockchain on disk after the blocks were downloaded
-        self.blockchain.save()
+                if blocks and blocks[0]._hash == blk.Constants.GENESIS._hash:
+                    blocks = blocks[1:]
+
+                # Checking and adding the blocks recomputes every hash, so
+                # it runs in the io thread like load and save. Announced
+                # blocks are held until it is done (see _hold)
+                valid = await loop.run_in_executor(
+                    self.blockchain.io, self.blockchain.verify_blocks, blocks, 1)
+                if valid < len(blocks):
+                    log.warning('%s - Sent an invalid block at height %s',
+                                max_peer.str_addr, valid + 1)
+                    await self.misbehaving(max_peer, 50, 'invalid blocks')
+
+                await loop.run_in_executor(
+                    self.blockchain.io,
+                    lambda: self.blockchain.add_blocks(blocks[:valid],
+                                                       update_file=False))
+
+            except (ValueError, IndexError, TypeError) as e:
+                log.warning('Not connected to any nodes')
+
+            # Create the blockchain on disk after the blocks were downloaded
+            await loop.run_in_executor(self.blockchain.io, self.blockchain.save)
+
+        self.synced.set()
+        await self._release_held()
+
         # Run the miner module if added to the node
-        if not self.miner is None:
-            await self.miner.mine(blockchain=self.blockchain, handler=self.handle_block)
+        self.start_mining()
+
+    def start_mining(self):
+        """Starts mining in the background, if the node has a miner. The
+        hashes are searched in the miner's processes so the node keeps
+        answering peers while mining.
+        """
+
+        if self.miner is None or not self._mining is None:
+            return
+
+        self.miner.stop.clear()
+        self._mining = asyncio.create_task(
+            self.miner.mine(blockchain=self.blockchain, handler=self.handle_block))
+
+    async def stop_mining(self):
+        """Stops mining and waits for the miner to finish
+        """
+
+        if self._mining is None:
+            return
+
+        await self.miner.close()
+        await self._mining
+        self._mining = None
+
+    def _mempool_size(self):
+        # Nodes without a miner keep the received transactions only for
+        # rebuilding compact blocks
+        if self.miner is None:
+            return len(self.recent_txns)
+
+        return len(self.miner.mempool)
+
+    def _hash_rate(self):
+        return 0 if self.miner is None else self.miner.hash_rate()
+
+    async def _close_node(self):
+
+        await self.stop_mining()
+        self.loop_monitor.stop()
+
+        if not self.metrics_server is None:
+            await self.metrics_server.close()
+
+        if not self.profiler is None:
+            self.profiler.stop()
+
+        # Write the queued blocks before exiting
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.blockchain.close)
+
+        for wallet in self.wallets:
+            await loop.run_in_executor(None, wallet.save_state)
+
+    def register_wallet(self, wallet: Wallet):
+        """Keeps a wallet's outputs up to date with the blockchain. The
+        wallet is synced from its saved height, then updated with every block
+        that changes the chain. Its state is saved when the node stops
+
+        Args:
+            wallet (Wallet): The wallet
+        """
+
+        self.blockchain.subscribe(wallet)
+        self.wallets.append(wallet)
 
     async def handle_block(self, block):
         """ Process newly mined blocks. This method is invoked whenever a block
         is mined.
         """
         self.blockchain.add_block(block, update_file=True)
+        self._restore_txns()
         await self.post_block(block)
+
+    def _block_received(self, block):
+        """Adds a block received from a peer and restarts mining on top of it
+        """
+
+        self.blockchain.add_block(block, update_file=True)
+        self._restore_txns()
+
+        if not self.miner is None:
+            self.miner.new_block()
+
+    def _restore_txns(self):
+        """Returns the transactions of blocks that lost a reorganization to
+        the memory pool
+        """
+
+        txns = self.blockchain.take_disconnected_txns()
+        if not txns:
+            return
+
+        log.info('Returning %s transactions to the memory pool', len(txns))
+
+        if not self.miner is None:
+            self.miner.restore_txns(txns)
+        else:
+            self.recent_txns += [txn for txn in txns
+                                 if not txn in self.recent_txns]
                 
 
-    async def request(self, data, mode=None, conn=None):
+    def _hold(self, handler, conn, params) -> bool:
+        """Keeps a block announcement that arrived before the blockchain was
+        synced, so the handler doesn't change the blockchain while it is
+        loaded or saved in the io thread
+
+        Returns:
+            bool: True if the announcement was kept, to be handled later
+        """
+
+        if self.synced.is_set():
+            return False
+
+        log.debug('%s - Holding a block until the blockchain is synced',
+                  conn.str_addr)
+        self._held.append((handler, conn, params))
+        return True
+
+    async def _release_held(self):
+        """Handles the block announcements that arrived before the
+        blockchain was synced, in the order they arrived
+        """
+
+        held = list(self._held)
+        self._held.clear()
+
+        for handler, conn, params in held:
+            await self.workers.put(handler(conn, params))
+
+    async def request(self, data, mode=None, conn=None, k=None, key=None,
+                      hedge_after=None):
+        """Sends a get request and returns the responses
+
+        Args:
+            data (dict): The request
+            mode (int, optional): Node.ALL asks all the outbound peers (see
+            Peer.fanout), Node.SINGLE asks only conn and Node.BEST asks the
+            best scored peer, moving to the next one if it doesn't answer.
+            Defaults to Node.ALL
+            conn (PeerConnection, optional): The peer for Node.SINGLE
+            k, key, hedge_after (optional): Passed to Peer.fanout when mode is
+            Node.ALL. By default waits for all the peers.
+
+        Raises:
+            TypeError: mode is Node.SINGLE and conn is None
+
+        Returns:
+            list: Tuples of the peer and its response. Peers that didn't
+            answer in time are not included
+        """
 
         if mode is None:
             mode = Node.ALL
 
         match mode:
             case Node.ALL:
-                await self.broadcast(self.pack(Node.GET, data))
-                results = await self.recvall(asyncio.ALL_COMPLETED)
-                if results is None:
-                    return []
+                results = await self.fanout(self.pack(Node.GET, data), k=k,
+                                            key=key, hedge_after=hedge_after)
 
             case Node.SINGLE:
                 if conn is None:
                     raise TypeError(
                         "request() 'conn' argument is required when mode=Node.SINGLE")
-                await conn.send(self.pack(Node.GET, data))
-                results = [(conn, await conn.recv())]
+                response = await conn.request(self.pack(Node.GET, data))
+                results = [] if response is None else [(conn, response)]
+
+            case Node.BEST:
+                results = []
+                for peer in self.best_peers(Node.BEST_TRIES):
+                    response = await peer.request(self.pack(Node.GET, data))
+
+                    if not response is None and response.get('type') == 'okay':
+                        results = [(peer, response)]
+                        break
 
         return results
 
+    @staticmethod
+    def _answers(results):
+        """Drops the peers that answered a request with an error, like a
+        block they don't have or pruned
+
+        Args:
+            results (list): Tuples of the peer and its response (see request)
+
+        Returns:
+            list: The tuples with an okay response
+        """
+
+        return [(peer, response) for peer, response in results
+                if isinstance(response, dict) and response.get('type') == 'okay']
+
     @client
     async def post_block(self, block: blk.Block):
-        """Send the hash to all known peers. Since a block might be big (>1mb)
-        we send its hash instead of all the block to let other know we have that
-        block.
+        """Send the block to all known peers as a compact block. Since a block
+        might be big (>1mb) we send its metadata and the short ids of its
+        transactions instead of the whole block. Peers rebuild the block from
+        their memory pool and request only the transactions they are missing.
 
         Args:
             block (Block): The block.
         """
-        print(f'INFO - Posting block')
+        log.debug('Posting block')
 
         data = self.pack(Node.POST,
-                         {'command': 'post_block', 'hash': block._hash})
+                         {'command': 'post_cmpct_block',
+                          'block': compact.to_json(compact.to_compact(block))})
         await self.broadcast(data)
 
-    @server
+    @server(params={'hash': (str, None)})
     async def _post_block(self, conn, params):
         """Checks if we have that block in out blockchain, if not we will send a
         request for that block
@@ -127,59 +414,187 @@ class Node(Peer):
         Args:
             params (_type_): _description_
         """
+        if self._hold(self._post_block, conn, params):
+            return
+
         block_hash = params.get('hash')
 
         if block_hash is None:
-            print(f'INFO {conn.str_addr} - Didnt receive hash for post_block')
+            log.info('%s - Didnt receive hash for post_block', conn.str_addr)
 
         if self.blockchain.get_block(block_hash) is None:
 
-            # TODO: change port here
-            server_conn = await self.connect((conn.addr[0], 11111))
-            
-            # If we already made connection with that computer
-            if server_conn is None:
-                server_conn = self.find_conn(conn.addr[0], 11111)
+            server_conn = await self._server_conn(conn)
 
             response = await self.get_block(block_hash, mode=Node.SINGLE, conn=server_conn)
+
+            # Ask the best peers if the announcer couldn't send it
+            if not response:
+                response = await self.get_block(block_hash, mode=Node.BEST)
             
             #TODO: choose the most common block
             if response:
-                block = response[0][1]
+                peer, block = response[0]
             else:
-                print(f'WARNING - did not get reqested block. response: {response}')
+                log.warning('did not get reqested block. response: %s', response)
+                return
+
+            if block._hash != block_hash or \
+                    not check_pow(block, self.blockchain.difficulty):
+                await self.misbehaving(peer, 50, 'block with an invalid hash')
                 return
             
-            print(f'INFO {conn.str_addr} - Got block with hash {block._hash}')
-            self.blockchain.add_block(block, update_file=True)
+            log.info('%s - Got block with hash %s', conn.str_addr, block._hash)
+            self._block_received(block)
 
             if not block._hash in self.recent_blocks:
                 self.recent_blocks.append(block._hash)
                 await self.post_block(block)
 
         else:
-            print(f'INFO {conn.str_addr} - Got existing block')
+            log.debug('%s - Got existing block', conn.str_addr)
+
+    @server(params={'block': dict})
+    async def _post_cmpct_block(self, conn, params):
+        """Rebuilds a compact block from the memory pool. Transactions that are
+        not found are requested from the peer that sent the block.
+
+        Args:
+            params (dict): 'block' is the compact block
+        """
+
+        if self._hold(self._post_cmpct_block, conn, params):
+            return
+
+        try:
+            cmpct = compact.from_json(params['block'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            log.info('%s - Got invalid compact block', conn.str_addr)
+            return
+
+        if not self.blockchain.get_block(cmpct.block_hash) is None or \
+                cmpct.block_hash in self.recent_blocks:
+            log.debug('%s - Got existing block', conn.str_addr)
+            return
+
+        block_txns, missing = compact.reconstruct(cmpct, self.known_txns())
+        fetched = {}
+
+        if missing:
+            log.info('%s - Missing %s of %s transactions in block',
+                     conn.str_addr, len(missing), len(cmpct.short_ids))
+
+            server_conn = await self._server_conn(conn)
+            if not server_conn is None:
+                fetched = await self.get_block_txns(cmpct.block_hash, missing,
+                                                    conn=server_conn)
+
+        block = compact.fill(cmpct, block_txns, fetched)
+
+        # Fall back to downloading the whole block
+        if block is None:
+            if fetched:
+                await self.misbehaving(conn, 20, 'invalid compact block transactions')
+
+            log.warning('%s - Could not rebuild compact block', conn.str_addr)
+            await self._post_block(conn, {'hash': cmpct.block_hash})
+            return
+
+        # A short id can match the wrong transaction, so the whole block is
+        # downloaded and checked again before anyone is blamed
+        if not check_pow(block, self.blockchain.difficulty):
+            log.warning('%s - Rebuilt block %s doesnt match its hash',
+                        conn.str_addr, block._hash)
+            await self._post_block(conn, {'hash': cmpct.block_hash})
+            return
+
+        log.info('%s - Got block with hash %s', conn.str_addr, block._hash)
+        self._block_received(block)
+
+        self.recent_blocks.append(block._hash)
+        await self.post_block(block)
+
+    def known_txns(self):
+        """Returns all the transactions this node knows that are not in a
+        block yet
+
+        Returns:
+            list: The transactions
+        """
+
+        txns = list(self.recent_txns)
+
+        if not self.miner is None:
+            txns += self.miner.mempool
+
+        return txns
+
+    async def _server_conn(self, conn):
+        """Returns a pooled outbound connection to the node of an inbound
+        connection, so we can send it requests
+
+        Args:
+            conn (PeerConnection): The inbound connection
+        """
+
+        addr = conn.listen_addr
+
+        # Peers that didn't send hello are expected on the default port
+        if addr is None:
+            addr = (conn.addr[0], PORT)
+
+        return await self.acquire(addr)
 
     @client
     async def post_txn(self, txn: blk.Transaction):
+        """Queues a transaction to be relayed to all known peers. Transactions
+        are not sent right away, they are collected and sent in batches with
+        post_txns (see Peer.relay).
 
-        print('INFO - Posting transaction')
+        Args:
+            txn (Transaction): The transaction.
+        """
 
         if not self.miner is None:
             self.miner.add_txn(txn)
 
-        data = self.pack(Node.POST,
-                         {'command': 'post_txn', 'txn': dict(txn._asdict())})
+        self.relay(dict(txn._asdict()))
 
-        await self.broadcast(data)
+    async def _flush_relay(self, conn, items):
 
-    @server
+        log.debug('%s - Posting %s transactions', conn.str_addr, len(items))
+
+        await conn.send(self.pack(Node.POST,
+                                  {'command': 'post_txns', 'txns': items}))
+
+    @server(params={'txn': dict})
     async def _post_txn(self, conn, params):
 
-        print(f'INFO {conn.str_addr} - Got transaction')
+        log.debug('%s - Got transaction', conn.str_addr)
+
+        await self._receive_txn(params.get('txn'))
+
+    @server(params={'txns': (list, None)})
+    async def _post_txns(self, conn, params):
+        """Receives a batch of transactions that was relayed by another node
+
+        Args:
+            params (dict): 'txns' is the list of transactions
+        """
+
+        txns = params.get('txns')
+
+        if txns is None:
+            log.info('%s - Didnt receive transactions for post_txns', conn.str_addr)
+            return
+
+        log.debug('%s - Got %s transactions', conn.str_addr, len(txns))
+
+        for txn_dict in txns:
+            await self._receive_txn(txn_dict)
+
+    async def _receive_txn(self, txn_dict):
 
-        txn_dict = params.get('txn')
-        
         txn = blk.to_txn(txn_dict)
 
         # TODO: replace transactions with their hash
@@ -206,9 +621,9 @@ class Node(Peer):
         """
 
         if conn is None:
-            print(f'INFO - Requesting block')
+            log.debug('Requesting block')
         else:
-            print(f'INFO {conn.str_addr} - Requesting block')
+            log.debug('%s - Requesting block', conn.str_addr)
 
         if mode is None:
             mode = Node.ALL
@@ -223,11 +638,11 @@ class Node(Peer):
         try:
             response = await self.request(request, mode=mode, conn=conn)
         except TypeError:
-            print('ERROR - mode is Node.SINGLE but no peer object was passed')
+            log.error('mode is Node.SINGLE but no peer object was passed')
             return
         
         response_final = [(r[0], blk.to_block(r[1]['data']['block']))
-                            for r in response]
+                            for r in Node._answers(response)]
         
         return response_final
 
@@ -249,9 +664,9 @@ class Node(Peer):
         """
 
         if conn is None:
-            print(f'INFO - Requesting blocks')
+            log.debug('Requesting blocks')
         else:
-            print(f'INFO {conn.str_addr} - Requesting blocks')
+            log.debug('%s - Requesting blocks', conn.str_addr)
 
         if mode is None:
             mode = Node.ALL
@@ -272,29 +687,94 @@ class Node(Peer):
             response = await self.request(request, mode=mode, conn=conn)
             response_final = [(r[0], [blk.to_block(block)
                                       for block in r[1]['data']['blocks']])
-                              for r in response]
+                              for r in Node._answers(response)]
         except TypeError as e:
-            print(f'ERROR - {e}')
+            log.error('%s', e)
             return
 
         return response_final
 
+    @client
+    async def get_block_txns(self, block_hash, indexes, conn):
+        """Requests some of the transactions of a block from a single peer.
+        Used to complete compact blocks.
+
+        Args:
+            block_hash (str): The block's hash
+            indexes (list): The indexes of the transactions in the block
+            conn (PeerConnection): The peer to send to
+
+        Returns:
+            dict: The transactions by their index. Empty if the peer didn't
+            answer or doesn't have the block
+        """
+
+        log.debug('%s - Requesting %s block transactions',
+                  conn.str_addr, len(indexes))
+
+        response = await self.request({'command': self._get_block_txns.webname,
+                                       'block_hash': block_hash,
+                                       'indexes': indexes},
+                                      mode=Node.SINGLE, conn=conn)
+        try:
+            txns = response[0][1]['data']['txns']
+        except (IndexError, KeyError, TypeError):
+            return {}
+
+        return {int(i): blk.Transaction(*txn) for i, txn in txns.items()}
+
     @client
     async def get_nodes(self):
+        """Requests the addresses of other peers from all the outbound peers
+        and adds them to the address book. Use fill_outbound to connect to
+        them.
+
+        Returns:
+            list: Tuples of the peer and its response
+        """
 
-        print(f'INFO - Requesting nodes')
+        log.debug('Requesting nodes')
 
         response = await self.request({'command': self._get_nodes.webname})
 
-        # TODO: connect to the new nodes
+        new = 0
+        for conn, r in response:
+            try:
+                addrs = r['data']['outbound'] + r['data'].get('known', [])
+            except (KeyError, TypeError):
+                continue
+
+            # A peer could try to fill the address book with its own picks
+            for addr in addrs[:MAX_SHARED]:
+                new += self.addrman.add(addr, source=conn.addr)
+
+        log.info('Learned %s new addresses', new)
+
         return response
 
+    async def _discover(self):
+        await self.get_nodes()
+
     @client
-    async def get_height(self):
+    async def get_height(self, k=None, quorum=False):
+        """Requests the height of the blockchain from all the outbound peers
+
+        Args:
+            k (int, optional): Return after k peers answered. Defaults to all
+            the peers.
+            quorum (bool, optional): Wait for k peers with the same height
+            instead of any k peers. Defaults to False.
+
+        Returns:
+            list: Tuples of the peer and its height
+        """
 
-        print(f'INFO - Requesting height')
+        log.debug('Requesting height')
 
-        responses = await self.request({'command': self._get_height.webname})
+        key = (lambda r: r['data']['height']) if quorum else None
+        responses = await self.request({'command': self._get_height.webname},
+                                       k=k, key=key,
+                                       hedge_after=None if k is None else Node.HEDGE_AFTER)
 
         # Remove all the message wrappers and return only the list of the peers
         # with the height
@@ -309,12 +789,112 @@ class Node(Peer):
         return response_new
 
     @client
-    async def get_hash(self, height):
+    async def get_hash(self, height, k=None):
+        """Requests the hash of the block in the given height
 
-        print(f'INFO - Requesting hash of height {height}')
+        Args:
+            height (int): The height
+            k (int, optional): Return as soon as k peers agree on the hash.
+            Defaults to waiting for all the peers.
+
+        Returns:
+            list: Tuples of the peer and its response. When k is given, only
+            the peers that agree
+        """
 
+        log.debug('Requesting hash of height %s', height)
+
+        key = (lambda r: r['data']['hash']) if not k is None else None
         return await self.request({'command': self._get_hash.webname,
-                                   'height': height})
+                                   'height': height},
+                                  k=k, key=key,
+                                  hedge_after=None if k is None else Node.HEDGE_AFTER)
+
+    @client
+    async def get_txn(self, txid, mode=None, conn=None):
+        """Requests a confirmed transaction by its id
+
+        Args:
+            txid (str): The transaction id
+            mode (int, optional): The request mode. Defaults to Node.BEST.
+            conn (PeerConnection, optional): The peer, for Node.SINGLE.
+
+        Returns:
+            list: Tuples of the peer and its response. The response has the
+            transaction, the hash and height of its block and its index in the
+            block
+        """
+
+        log.debug('Requesting transaction %s', txid)
+
+        return await self.request({'command': self._get_txn.webname,
+                                   'txid': txid},
+                                  mode=Node.BEST if mode is None else mode,
+                                  conn=conn)
+
+    @client
+    async def get_address(self, addr, mode=None, conn=None):
+        """Requests the history and unspent outputs of an address, or of up
+        to MAX_ADDRESSES addresses in a single request. Only peers with a
+        transaction index can answer
+
+        Args:
+            addr (Union[str, List[str]]): The address, or a list of addresses
+            mode (int, optional): The request mode. Defaults to Node.BEST.
+            conn (PeerConnection, optional): The peer, for Node.SINGLE.
+
+        Returns:
+            list: Tuples of the peer and its response. For a list of
+            addresses, the response has the history of every address under
+            'addresses'
+        """
+
+        log.debug('Requesting address %s', addr)
+
+        key = 'addr' if isinstance(addr, str) else 'addrs'
+        return await self.request({'command': self._get_address.webname,
+                                   key: addr},
+                                  mode=Node.BEST if mode is None else mode,
+                                  conn=conn)
+
+    @client
+    async def get_metrics(self, mode=None, conn=None):
+        """Requests the metrics of a peer, like its memory pool size and
+        the time its commands take
+
+        Args:
+            mode (int, optional): The request mode. Defaults to Node.SINGLE.
+            conn (PeerConnection, optional): The peer, for Node.SINGLE.
+
+        Returns:
+            list: Tuples of the peer and its metrics
+        """
+
+        log.debug('Requesting metrics')
+
+        return await self.request({'command': self._get_metrics.webname},
+                                  mode=Node.SINGLE if mode is None else mode,
+                                  conn=conn)
+
+    @client
+    async def profile(self, conn, action='dump'):
+        """Controls the profiler of a node that runs on this machine
+
+        Args:
+            conn (PeerConnection): The connection to the node
+            action (str, optional): 'start' or 'stop' sampling, 'reset' the
+            samples or 'dump' them. Defaults to 'dump'.
+
+        Returns:
+            dict: The response. A dump has the spans, the number of samples and
+            the stacks in the folded format, for flame graph tools
+        """
+
+        log.debug('%s - Requesting profile %s', conn.str_addr, action)
+
+        return await conn.request(self.pack(Node.POST,
+                                            {'command': self._profile.webname,
+                                             'action': action}))
 
     # @client
     # async def get_addr(self, conn):
@@ -324,7 +904,7 @@ class Node(Peer):
     #     return await self.request({'command': self._get_height.webname},
     #                               mode=False, conn=conn)
 
-    @server
+    @server(params={'block_hash': (str, None), 'height': (int, None)})
     async def _get_block(self, params):
 
         block_hash = params.get('block_hash')
@@ -343,9 +923,32 @@ class Node(Peer):
         else:
             block = self.blockchain.last_block()
 
+        if block.txns is None:
+            return self.pack(Node.ERROR, {'message': 'block pruned'})
+
         return self.pack(Node.OKAY, {'block': block.json()})
 
-    @server
+    @server(params={'block_hash': str, 'indexes': (list, None)})
+    async def _get_block_txns(self, params):
+
+        block = self.blockchain.get_block(params.get('block_hash'))
+
+        if block is None:
+            return self.pack(Node.ERROR, {'message': 'block not found'})
+
+        if block.txns is None:
+            return self.pack(Node.ERROR, {'message': 'block pruned'})
+
+        txns = {}
+        for i in params.get('indexes', []):
+            if isinstance(i, int) and 0 <= i < len(block.txns):
+                txns[str(i)] = list(block.txns[i])
+
+        return self.pack(Node.OKAY, {'txns': txns})
+
+    @server(params={'hashes': (list, None),
+                     'start_height': (int, None),
+                     'end_height': (int, None)})
     async def _get_blocks(self, params):
 
         hashes = params.get("hashes")
@@ -357,26 +960,32 @@ class Node(Peer):
 
             for _hash in hashes:
                 block = self.blockchain.get_block(_hash)
-                if not block is None:
+                if not block is None and not block.txns is None:
                     blocks.append(block.json())
 
         else:
+            # Pruned blocks can't be sent
+            first, last = self.blockchain.serveable()
+
             if start_height is None:
-                start_height = 1
+                start_height = first
 
             if end_height is None:
-                end_height = self.blockchain.height()
+                end_height = last
 
+            start_height = max(start_height, first)
             temp_blocks = self.blockchain.chain[start_height - 1:end_height]
             blocks = [block.json() for block in temp_blocks]
 
-        return self.pack(Node.OKAY, {'blocks': blocks})
+        # Tell the client which heights it can ask this node for
+        return self.pack(Node.OKAY, {'blocks': blocks,
+                                     'ranges': [self.blockchain.serveable()]})
 
     @server
     async def _get_nodes(self, params):
         """Returns to the client all the outbound connection addresses they 
-        have. Does not get the inbound connections since they and will not
-        answer requests.
+        have, the listening addresses of inbound peers that sent hello and
+        recently seen addresses from the address book.
 
         Args:
             params (dict): the parameters of this command. Serves no use
@@ -385,12 +994,17 @@ class Node(Peer):
             _type_: The connections packed as a dictionary with okay message
         """
 
-        conns_outbound = [conn.addr for conn in self.outbound]
+        conns_outbound = [conn.listen_addr for conn in self.outbound]
+
+        # Inbound peers that told us where they listen can be reached too
+        known = [conn.listen_addr for conn in self.inbound
+                 if not conn.listen_addr is None]
+        known += self.addrman.recent()
 
         return self.pack(Node.OKAY,
-                         {'outbound': conns_outbound})
+                         {'outbound': conns_outbound, 'known': known})
 
-    @server
+    @server(params={'unconfirmed': (bool, None)})
     async def _get_height(self, params):
 
         unconfirmed = params.get('unconfirmed')
@@ -400,18 +1014,83 @@ class Node(Peer):
 
         return self.pack(Node.OKAY, {'height': self.blockchain.height(unconfirmed=unconfirmed)})
 
-    @server
+    @server(params={'height': (int, None)})
     async def _get_hash(self, params):
 
         height = params.get('height')
 
         if not height is None:
-            _hash = self.blockchain.chain(height - 1)._hash
+            _hash = self.blockchain.chain[height - 1]._hash
         else:
             _hash = self.blockchain.last_block()._hash
 
         return self.pack(Node.OKAY, {'hash': _hash})
 
+    @server(params={'txid': str})
+    async def _get_txn(self, params):
+
+        found = self.blockchain.get_txn(params['txid'])
+
+        if found is None:
+            return self.pack(Node.ERROR, {'message': 'transaction not found'})
+
+        txn, b, t = found
+        return self.pack(Node.OKAY, {'txn': None if txn is None else list(txn),
+                                     'block_hash': self.blockchain.chain[b]._hash,
+                                     'height': b + 1,
+                                     'index': t})
+
+    @server(params={'addr': (str, None), 'addrs': (list, None)})
+    async def _get_address(self, params):
+
+        addr = params.get('addr')
+        addrs = params.get('addrs')
+
+        if addr is None and addrs is None:
+            return self.pack(Node.ERROR, {'message': 'missing parameter addr'})
+
+        if not addrs is None and (len(addrs) > Node.MAX_ADDRESSES or
+                                  not all(isinstance(a, str) for a in addrs)):
+            return self.pack(Node.ERROR, {'message': 'invalid parameter addrs'})
+
+        if self.blockchain.txindex is None:
+            return self.pack(Node.ERROR, {'message': 'no transaction index'})
+
+        if not addr is None:
+            return self.pack(Node.OKAY, self.blockchain.get_address(addr))
+
+        return self.pack(Node.OKAY, {'addresses': {a: self.blockchain.get_address(a)
+                                                   for a in addrs}})
+
+    @server
+    async def _get_metrics(self, params):
+
+        return self.pack(Node.OKAY, {'metrics': self.metrics.snapshot()})
+
+    @server(params={'action': str})
+    async def _profile(self, conn, params):
+
+        # Stacks show the node's internals, so only local tools may see them
+        if not conn.addr[0] in LOCAL_HOSTS:
+            await self.misbehaving(conn, 10, 'profile from a remote address')
+            return self.pack(Node.ERROR, {'message': 'not allowed'})
+
+        if self.profiler is None:
+            return self.pack(Node.ERROR, {'message': 'profiling is disabled'})
+
+        action = params.get('action')
+
+        if action == 'start':
+            self.profiler.start()
+        elif action == 'stop':
+            self.profiler.stop()
+        elif action == 'reset':
+            self.profiler.reset()
+        elif action != 'dump':
+            return self.pack(Node.ERROR, {'message': 'unknown action'})
+
+        return self.pack(Node.OKAY, self.profiler.snapshot())
+
     # @server
     # async def _get_addr(self, params):
 
@@ -420,7 +1099,9 @@ class Node(Peer):
 
 async def main():
     
-    
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s - %(name)s - %(message)s')
+
     wallet = Wallet()
     miner = Miner(wallet.addr)
     node = Node(port=11111, miner=miner)
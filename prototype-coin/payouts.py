@@ -0,0 +1,221 @@
+import asyncio
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from block import Transaction
+from wallet import Draft, NotEnoughFundsError, Wallet, sign_data
+
+MAX_OUTPUTS = 100   # Payouts in a single transaction
+SIGN_CHUNK = 64     # Transactions signed together in a process
+
+
+class PayoutBuilder:
+
+    def __init__(self, wallet: Wallet, fee: int = 0,
+                 max_outputs: int = MAX_OUTPUTS,
+                 processes: Optional[int] = None,
+                 chunk_size: int = SIGN_CHUNK):
+        """Builds transactions for big batches of payouts. The payouts are
+        grouped into transactions with many outputs, the coins of all the
+        transactions are reserved before anything is signed, and the signing
+        runs in a pool of processes. Transactions are returned as soon as
+        their chunk is signed.
+
+        Args:
+            wallet (Wallet): The wallet that pays
+
+            fee (int, optional): The fee of every transaction. Defaults to 0.
+
+            max_outputs (int, optional): Max payouts in a transaction.
+            Defaults to MAX_OUTPUTS.
+
+            processes (Optional[int], optional): Signing processes. 0 signs in
+            the calling thread. Defaults to None (the number of CPUs).
+
+            chunk_size (int, optional): Transactions sent to a process
+            together. Defaults to SIGN_CHUNK.
+        """
+
+        self.wallet = wallet
+        self.fee = fee
+        self.max_outputs = max_outputs
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def plan(self, payouts: List[Tuple[str, int]]) -> List[Draft]:
+        """Groups the payouts into transactions and reserves their coins.
+        Either all the transactions get coins or none do
+
+        Args:
+            payouts (List[Tuple[str, int]]): The payouts as (address, amount)
+
+        Raises:
+            NotEnoughFundsError: The wallet can't pay for all the payouts
+
+        Returns:
+            List[Draft]: The unsigned transactions
+        """
+
+        drafts = []
+
+        try:
+            for i in range(0, len(payouts), self.max_outputs):
+                drafts.append(self.wallet.draft(self.fee,
+                                                payouts[i:i + self.max_outputs]))
+
+        except NotEnoughFundsError:
+            for draft in drafts:
+                self.wallet.release(draft)
+            raise
+
+        return drafts
+
+    def build(self, payouts: List[Tuple[str, int]]) -> Iterator[Transaction]:
+        """Builds and signs the transactions of the payouts
+
+        Args:
+            payouts (List[Tuple[str, int]]): The payouts as (address, amount)
+
+        Raises:
+            NotEnoughFundsError: The wallet can't pay for all the payouts
+
+        Yields:
+            Transaction: The signed transactions, in the order they are ready.
+            If signing fails or the caller stops early, the coins of the
+            transactions that weren't returned go back to the wallet
+        """
+
+        drafts = self.plan(payouts)
+        unfinished = set(drafts)
+        futures = {}
+
+        try:
+            chunks = self._chunks(drafts)
+
+            if self.processes == 0:
+                for chunk, jobs in chunks:
+                    yield from _finish(chunk, sign_chunk(jobs), self.wallet,
+                                       unfinished)
+                return
+
+            futures = {self._get_pool().submit(sign_chunk, jobs): chunk
+                       for chunk, jobs in chunks}
+
+            for future in concurrent.futures.as_completed(futures):
+                yield from _finish(futures[future], future.result(),
+                                   self.wallet, unfinished)
+
+        finally:
+            for future in futures:
+                future.cancel()
+            self._release(drafts, unfinished)
+
+    async def stream(self, payouts: List[Tuple[str, int]]) -> AsyncIterator[Transaction]:
+        """Same as build, without blocking the event loop
+
+        Args:
+            payouts (List[Tuple[str, int]]): The payouts as (address, amount)
+
+        Raises:
+            NotEnoughFundsError: The wallet can't pay for all the payouts
+
+        Yields:
+            Transaction: The signed transactions, in the order they are ready.
+            If signing fails or the caller stops early, the coins of the
+            transactions that weren't returned go back to the wallet
+        """
+
+        loop = asyncio.get_running_loop()
+        pool = None if self.processes == 0 else self._get_pool()
+
+        async def sign(chunk, jobs):
+            return chunk, await loop.run_in_executor(pool, sign_chunk, jobs)
+
+        drafts = self.plan(payouts)
+        unfinished = set(drafts)
+        tasks = []
+
+        try:
+            tasks = [asyncio.ensure_future(sign(chunk, jobs))
+                     for chunk, jobs in self._chunks(drafts)]
+
+            for task in asyncio.as_completed(tasks):
+                chunk, signatures = await task
+                for txn in _finish(chunk, signatures, self.wallet, unfinished):
+                    yield txn
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._release(drafts, unfinished)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _release(self, drafts: List[Draft], unfinished: set):
+        """Gives the coins of the drafts that weren't returned as signed
+        transactions back to the wallet
+        """
+
+        for draft in drafts:
+            if draft in unfinished:
+                self.wallet.release(draft)
+
+        unfinished.clear()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.processes)
+
+        return self._pool
+
+    def _chunks(self, drafts: List[Draft]) -> list:
+        """Splits the drafts into chunks with what signing them needs: the
+        private key of the sender and the data
+        """
+
+        keys = {}
+        chunks = []
+
+        for i in range(0, len(drafts), self.chunk_size):
+            chunk = drafts[i:i + self.chunk_size]
+            jobs = []
+
+            for draft in chunk:
+                priv_k = keys.get(draft.sender)
+                if priv_k is None:
+                    priv_k = keys[draft.sender] = \
+                        self.wallet.keystore.key_of(draft.sender).PrivateKey()
+
+                jobs.append((priv_k, draft.data))
+
+            chunks.append((chunk, jobs))
+
+        return chunks
+
+
+def sign_chunk(jobs: List[Tuple[bytes, str]]) -> List[str]:
+    """Signs a chunk of transactions. Runs in the signing processes
+
+    Args:
+        jobs (List[Tuple[bytes, str]]): The private key and the data of every
+        transaction
+
+    Returns:
+        List[str]: The signatures in hexadecimal format (see Wallet.sign)
+    """
+    return [sign_data(priv_k, data) for priv_k, data in jobs]
+
+
+def _finish(drafts: List[Draft], signatures: List[str], wallet: Wallet,
+            unfinished: set):
+    for draft, signature in zip(drafts, signatures):
+        txn = draft.finish(signature, wallet.public_key(draft.sender))
+        unfinished.discard(draft)
+        yield txn
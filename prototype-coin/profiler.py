@@ -0,0 +1,183 @@
+import collections
+import functools
+import inspect
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from metrics import Registry
+
+
+class Profiler:
+
+    def __init__(self, rate: float = 100, max_depth: int = 64,
+                 metrics: Optional[Registry] = None):
+        """An opt-in profiler for the node. It has two parts:
+
+        Spans time the calls of chosen methods (see instrument). The methods
+        are replaced on the instance only, so objects that are not profiled
+        don't pay anything.
+
+        The sampler is a thread that takes the call stacks of all the other
+        threads rate times a second. The stacks are counted in the folded
+        format (frames joined by ';' and the count), which flame graph tools
+        like flamegraph.pl and speedscope read.
+
+        Args:
+            rate (float, optional): Samples per second. Defaults to 100.
+
+            max_depth (int, optional): Frames kept of every stack, from the
+            innermost. Defaults to 64.
+
+            metrics (Optional[Registry], optional): Where to report the spans.
+            Defaults to a new Registry.
+
+        Attributes:
+            stacks (Counter): Number of samples of every folded stack
+
+            samples (int): Number of times the stacks were sampled
+        """
+
+        self.rate = rate
+        self.max_depth = max_depth
+        self.metrics = Registry() if metrics is None else metrics
+
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Spans
+
+    def span(self, name: str):
+        """Returns a context manager that times its block as the span name"""
+        return self._histogram(name).time()
+
+    def wrap(self, func: Callable, name: str) -> Callable:
+        """Returns func timed as the span name. Coroutine functions are timed
+        until their coroutine finishes, so their spans include the time they
+        waited
+        """
+
+        histogram = self._histogram(name)
+
+        if inspect.iscoroutinefunction(inspect.unwrap(func)):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    def instrument(self, obj, names: Iterable[str], prefix: str):
+        """Replaces methods of obj with timed versions, as the spans
+        prefix.name
+
+        Args:
+            obj: The object
+            names (Iterable[str]): The names of the methods
+            prefix (str): The first part of the span names
+        """
+
+        for name in names:
+            setattr(obj, name, self.wrap(getattr(obj, name), f'{prefix}.{name}'))
+
+    def _histogram(self, name: str):
+        return self.metrics.histogram('span_seconds',
+                                      'Seconds spent in a profiled call',
+                                      span=name)
+
+    # Sampling
+
+    @property
+    def running(self) -> bool:
+        return not self._thread is None
+
+    def start(self):
+        """Starts sampling the stacks, if not already started"""
+
+        if self.running:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='profiler')
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling. The samples are kept until reset"""
+
+        if not self.running:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+
+        interval = 1 / self.rate
+        me = threading.get_ident()
+
+        while not self._stop.wait(interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            stacks = [self._fold(frame, names.get(ident, str(ident)))
+                      for ident, frame in sys._current_frames().items()
+                      if ident != me]
+
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def _fold(self, frame, thread: str) -> str:
+
+        frames = []
+        while not frame is None and len(frames) < self.max_depth:
+            code = frame.f_code
+            module = frame.f_globals.get('__name__', '?')
+            name = getattr(code, 'co_qualname', code.co_name)
+            frames.append(f'{module}.{name}')
+            frame = frame.f_back
+
+        frames.append(thread)
+        # ';' separates the frames and a space the count
+        return ';'.join(reversed(frames)).replace(' ', '_')
+
+    def folded(self) -> str:
+        """Returns the sampled stacks in the folded format, one stack and its
+        count in every line, the most common first
+        """
+
+        with self._lock:
+            stacks = self.stacks.most_common()
+
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Returns the spans and the samples in a json friendly format"""
+
+        return {'running': self.running,
+                'rate': self.rate,
+                'samples': self.samples,
+                'spans': self.metrics.snapshot().get('span_seconds', []),
+                'folded': self.folded()}
@@ -0,0 +1,595 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import pandas as pd
+
+from block import Block, Transaction, to_block
+from metrics import Registry
+
+log = logging.getLogger(__name__)
+
+METADATA_COLUMNS = ['Timestamp', 'Last hash', 'POW', 'Hash', 'Line', 'Length']
+
+# Durability levels of the block writer
+NONE = 0    # Never fsync. A crash may lose blocks the OS didn't write yet
+BATCH = 1   # Fsync the data files after every batch
+BLOCK = 2   # Also fsync the write-ahead log after every block
+
+
+class BlockWriter:
+
+    def __init__(self, path: str,
+                 durability: int = BATCH,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 metrics: Optional[Registry] = None):
+        """Writes confirmed blocks to metadata.csv and txns.csv in batches.
+        Every block is first appended to a write-ahead log (wal.log), which is
+        cheap, and the data files are appended once per batch. Blocks that are
+        in the log but didn't reach the data files before a crash are written
+        by recover().
+
+        After every batch the sizes of the data files are written to a tip
+        file (tip.json), which is replaced atomically. Anything after these
+        sizes was not completely written, so recover() cuts it off before
+        replaying the log.
+
+        In pruning mode prune() removes the first rows of txns.csv. The Line
+        column of the metadata keeps counting from the original first row,
+        and the number of removed rows (first_row) is kept in the tip file.
+
+        All the disk work runs in a single thread (executor), so blocks are
+        written in order and the event loop never waits for the disk.
+
+        Args:
+            path (str): The blockchain directory
+
+            durability (int, optional): When to fsync, one of storage.NONE,
+            storage.BATCH or storage.BLOCK. Defaults to BATCH.
+
+            batch_size (int, optional): Blocks in a batch. Defaults to 100.
+
+            flush_interval (float, optional): Max seconds a block waits for
+            its batch. Defaults to 1.
+
+            metrics (Optional[Registry], optional): Where to report the write
+            times. Defaults to a new Registry.
+        """
+
+        self.path = path
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.metadata_path = os.path.join(path, 'metadata.csv')
+        self.txns_path = os.path.join(path, 'txns.csv')
+        self.wal_path = os.path.join(path, 'wal.log')
+        self.tip_path = os.path.join(path, 'tip.json')
+        self.prune_path = os.path.join(path, 'prune.json')
+
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='blockchain-io')
+
+        self.batch: List[Block] = []
+        self.batches = 0    # Number of batches written, for statistics
+
+        self.metrics = Registry() if metrics is None else metrics
+        self._write_time = self.metrics.histogram(
+            'disk_write_seconds', 'Seconds to write a batch of blocks')
+        self._blocks_written = self.metrics.counter(
+            'disk_blocks_written', 'Blocks written to the data files')
+
+        self.first_row = 0  # Rows that were pruned from the start of txns.csv
+
+        self._rows = None   # Rows in txns.csv, counted once when needed
+        self._wal = None    # Open write-ahead log file
+        self._timer = None
+        self._tip_hash = None
+
+    def append(self, block: Block):
+        """Queues a confirmed block to be written
+
+        Args:
+            block (Block): The block
+        """
+
+        future = self.executor.submit(self._append, block)
+        future.add_done_callback(_report_error)
+
+    def _append(self, block: Block):
+
+        if self._wal is None:
+            self._wal = open(self.wal_path, 'a')
+
+        self._wal.write(json.dumps(_block_dict(block)) + '\n')
+        self._wal.flush()
+
+        if self.durability >= BLOCK:
+            os.fsync(self._wal.fileno())
+
+        self.batch.append(block)
+
+        if len(self.batch) >= self.batch_size:
+            self._write_batch()
+
+        elif self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+
+        try:
+            self.executor.submit(self._write_batch).add_done_callback(_report_error)
+        except RuntimeError:
+            pass    # The executor was closed
+
+    def _write_batch(self):
+        """Appends the batch to the data files and empties the write-ahead
+        log. Runs in the executor
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self.batch:
+            return
+
+        with self._write_time.time():
+            self._write_blocks(self.batch)
+            self._blocks_written.inc(len(self.batch))
+            self.batch = []
+            self.batches += 1
+
+            self._truncate_wal()
+
+    def _write_blocks(self, blocks: List[Block]):
+
+        if self._rows is None:
+            self._rows = self.first_row + _count_rows(self.txns_path)
+
+        metadata = []
+        txns = []
+        for block in blocks:
+            metadata.append([block.timestamp, block.last_hash, block.proof,
+                             block._hash, self._rows + len(txns),
+                             len(block.txns)])
+            txns += block.txns
+
+        # Transactions first, so metadata never points to missing rows
+        _append_csv(self.txns_path,
+                    pd.DataFrame(txns, columns=Transaction._fields),
+                    self.durability >= BATCH)
+        _append_csv(self.metadata_path,
+                    pd.DataFrame(metadata, columns=METADATA_COLUMNS),
+                    self.durability >= BATCH)
+
+        self._rows += len(txns)
+        self._write_tip(blocks[-1]._hash)
+
+    def _write_tip(self, tip_hash: str):
+        """Writes the tip file: the last written block and the size of the
+        data files. The file is written to a temporary file and renamed, so it
+        is always complete
+
+        Args:
+            tip_hash (str): The hash of the last written block
+        """
+
+        self._tip_hash = tip_hash
+        self._save_tip({'hash': tip_hash,
+                        'txn_rows': self._rows,
+                        'first_row': self.first_row,
+                        'metadata_size': _size(self.metadata_path),
+                        'txns_size': _size(self.txns_path)})
+
+    def _save_tip(self, tip: dict):
+        _write_json(self.tip_path, tip, self.durability >= BATCH)
+
+    def _rewrite_wal(self):
+        """Writes the log again with only the queued blocks"""
+
+        self._truncate_wal()
+
+        if self.batch:
+            self._wal = open(self.wal_path, 'a')
+            for block in self.batch:
+                self._wal.write(json.dumps(_block_dict(block)) + '\n')
+            self._wal.flush()
+
+            if self.durability >= BATCH:
+                os.fsync(self._wal.fileno())
+
+    def _truncate_wal(self):
+
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+        with open(self.wal_path, 'w') as f:
+            if self.durability >= BATCH:
+                os.fsync(f.fileno())
+
+    def recover(self) -> int:
+        """Brings the data files back to a consistent state after a crash.
+        Cuts the data files back to the sizes in the tip file, then writes the
+        blocks that are in the write-ahead log but not in the data files. Call
+        before reading the data files, in the executor.
+
+        Returns:
+            int: The number of blocks that were recovered from the log
+        """
+
+        self._recover_files()
+
+        if not os.path.exists(self.wal_path):
+            return 0
+
+        blocks = []
+        with open(self.wal_path) as f:
+            for line in f:
+                try:
+                    blocks.append(to_block(json.loads(line)))
+                except (ValueError, KeyError):
+                    break   # A torn write, the rest of the log is lost
+
+        written = set()
+        if blocks and os.path.exists(self.metadata_path):
+            # Only the last blocks might have been written already
+            hashes = pd.read_csv(self.metadata_path, usecols=['Hash'])['Hash']
+            written = set(hashes.iloc[-len(blocks):])
+
+        blocks = [block for block in blocks if not block._hash in written]
+
+        if blocks:
+            log.info('Recovering %s blocks from the write-ahead log', len(blocks))
+            self._write_blocks(blocks)
+
+        self._truncate_wal()
+        return len(blocks)
+
+    def _recover_files(self):
+        """Truncates torn or unconfirmed tails of the data files. Uses the
+        tip file when there is one, which only costs two truncates. Otherwise
+        (files from older versions) drops partial last lines and metadata rows
+        that point past the end of the transactions.
+        """
+
+        self._recover_prune()
+        tip = self._read_tip()
+
+        if tip is not None:
+            for path, size in ((self.txns_path, tip['txns_size']),
+                               (self.metadata_path, tip['metadata_size'])):
+                if _size(path) > size:
+                    log.info('Truncating %s to the last tip', path)
+                    with open(path, 'r+b') as f:
+                        f.truncate(size)
+
+            self._rows = tip['txn_rows']
+            self.first_row = tip.get('first_row', 0)
+            self._tip_hash = tip.get('hash')
+            return
+
+        if not os.path.exists(self.metadata_path):
+            return
+
+        _truncate_partial_line(self.txns_path)
+        _truncate_partial_line(self.metadata_path)
+
+        self._rows = _count_rows(self.txns_path)
+        # Timestamps are read exactly, the block hashes depend on them
+        metadata = pd.read_csv(self.metadata_path, float_precision='round_trip')
+        valid = metadata['Line'] + metadata['Length'] <= self._rows
+
+        if not valid.all():
+            last = int((~valid).values.argmax())
+            log.info('Dropping %s blocks with missing transactions',
+                     len(metadata) - last)
+            metadata = metadata.iloc[:last]
+            metadata.to_csv(self.metadata_path, index=False)
+
+        if len(metadata):
+            self._write_tip(metadata['Hash'].iloc[-1])
+
+    def prune(self, block_hash: str):
+        """Removes the transactions of the blocks before the given block from
+        txns.csv. The rows that are kept are copied to a new file that
+        replaces txns.csv. Runs in the executor
+
+        Args:
+            block_hash (str): The first block that keeps its transactions
+        """
+
+        # The block might still be in the batch
+        self._write_batch()
+
+        if not os.path.exists(self.metadata_path):
+            return
+
+        metadata = pd.read_csv(self.metadata_path, usecols=['Hash', 'Line'])
+        rows = metadata.index[metadata['Hash'] == block_hash]
+
+        if not len(rows):
+            return
+
+        first_row = int(metadata['Line'][rows[0]])
+        if first_row <= self.first_row:
+            return
+
+        temp_path = f'{self.txns_path}.tmp'
+        with open(self.txns_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            dst.write(src.readline())   # The header
+
+            for row, line in enumerate(src, self.first_row):
+                if row >= first_row:
+                    dst.write(line)
+
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        # Record the new first row before the file is swapped, so recover()
+        # can finish the prune if we crash in between
+        _write_json(self.prune_path, {'first_row': first_row,
+                                      'txns_size': _size(temp_path)}, True)
+
+        os.replace(temp_path, self.txns_path)
+
+        self.first_row = first_row
+        self._write_tip(self._tip_hash)
+        os.remove(self.prune_path)
+
+        log.info('Pruned transactions before row %s', first_row)
+
+    def rewind(self, blocks: List[Block], tip_hash: str):
+        """Removes blocks that were disconnected from the end of the chain.
+        Blocks that are still queued are dropped from the batch and the log,
+        and the written ones are cut from the end of the data files. The tip
+        file is written with the new sizes before the files are cut, so
+        recover() finishes the cut after a crash. Runs in the executor
+
+        Args:
+            blocks (List[Block]): The disconnected blocks, in chain order.
+            They must have their transactions
+
+            tip_hash (str): The hash of the last block that stays
+        """
+
+        hashes = {block._hash for block in blocks}
+        queued = {block._hash for block in self.batch} & hashes
+
+        if queued:
+            self.batch = [block for block in self.batch
+                          if not block._hash in queued]
+            self._rewrite_wal()
+
+        written = [block for block in blocks if not block._hash in queued]
+        if not written or not os.path.exists(self.metadata_path):
+            return
+
+        if self._rows is None:
+            self._rows = self.first_row + _count_rows(self.txns_path)
+
+        rows = sum(len(block.txns) for block in written)
+        metadata_size = _offset_of_last_lines(self.metadata_path, len(written))
+        txns_size = _offset_of_last_lines(self.txns_path, rows)
+
+        self._rows -= rows
+        self._tip_hash = tip_hash
+        self._save_tip({'hash': tip_hash,
+                        'txn_rows': self._rows,
+                        'first_row': self.first_row,
+                        'metadata_size': metadata_size,
+                        'txns_size': txns_size})
+
+        # Metadata first, so it never points to missing rows
+        for path, size in ((self.metadata_path, metadata_size),
+                           (self.txns_path, txns_size)):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+        log.info('Rewound %s blocks to %s', len(written), tip_hash)
+
+    def _recover_prune(self):
+        """Finishes or cancels a prune that was interrupted by a crash
+        """
+
+        if not os.path.exists(self.prune_path):
+            return
+
+        with open(self.prune_path) as f:
+            prune = json.load(f)
+
+        temp_path = f'{self.txns_path}.tmp'
+        tip = self._read_tip()
+
+        if os.path.exists(temp_path) or tip is None:
+            # txns.csv wasn't replaced yet, the old file is still valid
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        else:
+            tip['first_row'] = prune['first_row']
+            tip['txns_size'] = prune['txns_size']
+            self._save_tip(tip)
+
+        os.remove(self.prune_path)
+
+    def _read_tip(self):
+
+        try:
+            with open(self.tip_path) as f:
+                tip = json.load(f)
+            return tip if {'txn_rows', 'metadata_size', 'txns_size'} <= tip.keys() else None
+
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def reset(self):
+        """Forgets the queued blocks and the log. Call after the data files
+        were rewritten from the whole chain, in the executor
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self.batch = []
+        self.first_row = 0
+        self._rows = _count_rows(self.txns_path)
+        self._truncate_wal()
+
+        if os.path.exists(self.metadata_path):
+            tip_hash = pd.read_csv(self.metadata_path, usecols=['Hash'])['Hash']
+            self._write_tip(tip_hash.iloc[-1] if len(tip_hash) else None)
+
+    def flush(self):
+        """Blocks until all the queued blocks are in the data files
+        """
+        self.executor.submit(self._write_batch).result()
+
+    def close(self):
+        """Writes the queued blocks and stops the writer thread
+        """
+
+        self.flush()
+        self.executor.submit(self._close_wal).result()
+        self.executor.shutdown(wait=True)
+
+    def _close_wal(self):
+
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+
+def _block_dict(block: Block) -> dict:
+    return {'timestamp': block.timestamp, 'last_hash': block.last_hash,
+            'proof': block.proof, '_hash': block._hash,
+            'txns': [list(txn) for txn in block.txns]}
+
+
+def _write_json(path: str, data: dict, fsync: bool):
+    """Replaces a json file atomically
+
+    Args:
+        path (str): The file
+        data (dict): The new content
+        fsync (bool): Sync the file to the disk before it replaces the old one
+    """
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+
+    os.replace(temp_path, path)
+
+
+def _size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _offset_of_last_lines(path: str, count: int, chunk: int = 1 << 16) -> int:
+    """Finds where the last count lines of a file start, by reading it
+    backwards from the end
+
+    Returns:
+        int: The offset. The size of the file for 0 lines
+    """
+
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        if count <= 0:
+            return end
+
+        # The newline at the end of the file ends the last line, it doesn't
+        # start one
+        newlines = -1
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk)
+            f.seek(start)
+            data = f.read(pos - start)
+
+            i = len(data)
+            while True:
+                i = data.rfind(b'\n', 0, i)
+                if i == -1:
+                    break
+
+                newlines += 1
+                if newlines == count:
+                    return start + i + 1
+
+            pos = start
+
+    return 0
+
+
+def _truncate_partial_line(path: str):
+    """Removes the last line of a file if it wasn't completely written
+
+    Args:
+        path (str): The file
+    """
+
+    size = _size(path)
+    if size == 0:
+        return
+
+    with open(path, 'r+b') as f:
+        # Read backwards until the last complete line
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            chunk = f.read(end - start)
+
+            if end == size and chunk.endswith(b'\n'):
+                return
+
+            i = chunk.rfind(b'\n')
+            if i != -1:
+                f.truncate(start + i + 1)
+                return
+
+            end = start
+
+        f.truncate(0)
+
+
+def _count_rows(path: str) -> int:
+
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb') as f:
+        # Every transaction is one line, except the header
+        return max(0, sum(1 for _ in f) - 1)
+
+
+def _append_csv(path: str, df: pd.DataFrame, fsync: bool):
+
+    header = not os.path.exists(path) or os.path.getsize(path) == 0
+
+    with open(path, 'a', newline='') as f:
+        df.to_csv(f, header=header, index=False)
+        f.flush()
+
+        if fsync:
+            os.fsync(f.fileno())
+
+
+def _report_error(future):
+
+    error = future.exception()
+    if not error is None:
+        log.error('Failed to write block to disk: %s', error)
@@ -0,0 +1,479 @@
+"""Microbenchmarks of the blockchain, the block tree, the miner, the wallet
+and the command dispatch of the peers.
+
+Generates synthetic chains and fork trees, times the main operations and
+writes the results as json, so runs of different versions can be compared:
+
+    python benchmark.py --out new.json --compare old.json
+
+Every result has a value and whether lower or higher is better. --compare
+prints the change of every result and exits with 1 if one of them got worse
+by more than --threshold.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import blockchain
+import treenode as tree
+import validation
+from block import Constants, Transaction, create_block
+from miner import Miner
+from networking import Peer, server
+from treenode import TreeNode
+from wallet import Wallet
+
+WORDS = 'simple shallow utility impulse humor purse occur image egg joke \
+they boost feel mean relax oval ozone weekend eternal element retreat apart \
+able absent'
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hides the prints of the measured code, they take longer than most of
+    the operations
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(func, ops, repeat):
+    """Times func, which runs ops operations, repeat times
+
+    Returns:
+        dict: The seconds per operation of the best, median and worst run
+    """
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - start) / ops)
+
+    return {'value': min(runs), 'median': statistics.median(runs),
+            'max': max(runs), 'ops': ops, 'unit': 's/op', 'better': 'lower'}
+
+
+# Synthetic data
+
+def random_hash():
+    return '%064x' % random.getrandbits(256)
+
+
+def make_txn(outputs=2):
+    """A transaction with the shape of a real one. It isn't signed"""
+
+    sender = random_hash()[:34]
+    recv = tuple((random_hash()[:34], random.randint(1, 100))
+                 for _ in range(outputs))
+    spent = [(random.randint(0, 1000), random.randint(0, 10), 0)]
+
+    return Transaction('0.1', sender, recv + (('FEES', 1), ), spent,
+                       (random_hash(), random_hash()))
+
+
+def make_blocks(last, count, txns):
+    """Returns count blocks that continue last, with txns transactions each"""
+
+    blocks = []
+    for _ in range(count):
+        last = create_block(last, [make_txn() for _ in range(txns)],
+                            random.randint(0, 1 << 32))
+        blocks.append(last)
+
+    return blocks
+
+
+def make_forks(last, width, depth, txns):
+    """Returns width competing branches of depth blocks that all continue
+    last, interleaved the way they would arrive from the network
+    """
+
+    branches = [make_blocks(last, depth, txns) for _ in range(width)]
+    return [branch[i] for i in range(depth) for branch in branches]
+
+
+def make_tree(size, fork_rate):
+    """Builds a random block tree. Every node continues the deepest leaf, or
+    with a chance of fork_rate a random earlier node
+
+    Returns:
+        Tuple[TreeNode, list]: The root and all the nodes
+    """
+
+    root = TreeNode(0)
+    nodes = [root]
+    tip = root
+
+    for i in range(1, size):
+        parent = random.choice(nodes) if random.random() < fork_rate else tip
+        node = TreeNode(i)
+        parent.add_child(node)
+        nodes.append(node)
+
+        if parent is tip:
+            tip = node
+
+    return root, nodes
+
+
+def new_blockchain(data_dir, **kwargs):
+    with quiet():
+        return blockchain.Blockchain(data_dir=data_dir, **kwargs)
+
+
+# Benchmarks
+
+def bench_add_block(args, data_dir):
+
+    results = {}
+    blocks = make_blocks(Constants.GENESIS, args.blocks, args.txns)
+
+    def add(update_file):
+        def run():
+            shutil.rmtree(data_dir, ignore_errors=True)
+            bc = new_blockchain(data_dir)
+            with quiet():
+                for block in blocks:
+                    bc.add_block(block, update_file=update_file)
+                bc.close()
+        return run
+
+    results['add_block'] = timed(add(False), len(blocks), args.repeat)
+    results['add_block_write'] = timed(add(True), len(blocks), args.repeat)
+
+    def add_forks():
+        bc = new_blockchain(data_dir)
+        with quiet():
+            bc.add_blocks(blocks[:-args.depth], update_file=False)
+            bc.add_blocks(forks, update_file=False)
+            bc.close()
+
+    # Forks from the end of the chain, so the block tree is wide
+    forks = make_forks(blocks[-args.depth - 1], args.width, args.depth,
+                       args.txns)
+    total = len(blocks) - args.depth + len(forks)
+    results['add_block_forks'] = timed(add_forks, total, args.repeat)
+
+    return results
+
+
+def bench_get_block(args, data_dir):
+
+    bc = new_blockchain(data_dir)
+    blocks = make_blocks(bc.chain[-1], args.blocks, args.txns)
+    with quiet():
+        bc.add_blocks(blocks, update_file=False)
+
+    hashes = [random.choice(blocks)._hash for _ in range(args.lookups)]
+    missing = [random_hash() for _ in range(args.lookups)]
+
+    def get(hashes):
+        def run():
+            for _hash in hashes:
+                bc.get_block(_hash)
+        return run
+
+    results = {'get_block': timed(get(hashes), len(hashes), args.repeat),
+               'get_block_missing': timed(get(missing), len(missing),
+                                          args.repeat)}
+    with quiet():
+        bc.close()
+
+    return results
+
+
+def bench_save_load(args, data_dir):
+
+    # The synthetic blocks have no proof of work
+    bc = new_blockchain(data_dir, difficulty=0)
+    with quiet():
+        bc.add_blocks(make_blocks(bc.chain[-1], args.blocks, args.txns),
+                      is_confirmed=True, update_file=False)
+
+    def save():
+        with quiet():
+            bc.save()
+
+    def load():
+        loaded = new_blockchain(data_dir, difficulty=0)
+        with quiet():
+            loaded.load()
+            loaded.close()
+
+    results = {'save': timed(save, len(bc.chain), args.repeat),
+               'load': timed(load, len(bc.chain), args.repeat)}
+    with quiet():
+        bc.close()
+
+    return results
+
+
+def bench_headers(args, data_dir):
+    """Checks the headers of a chain as arrays (validation.check_headers),
+    and one header at a time for comparison
+    """
+
+    blocks = make_blocks(Constants.GENESIS, args.headers, 0)
+    hashes = [block._hash for block in blocks]
+    last_hashes = [block.last_hash for block in blocks]
+
+    # The synthetic blocks have no proof of work
+    difficulty = 0
+    target = '0' * difficulty
+
+    def batched():
+        valid = validation.check_headers(hashes, last_hashes,
+                                         Constants.GENESIS._hash, difficulty)
+        assert valid == len(blocks)
+
+    def one_by_one():
+        prev_hash = Constants.GENESIS._hash
+        for _hash, last_hash in zip(hashes, last_hashes):
+            assert last_hash == prev_hash and _hash.startswith(target)
+            prev_hash = _hash
+
+    return {'check_headers': timed(batched, len(blocks), args.repeat),
+            'check_headers_loop': timed(one_by_one, len(blocks), args.repeat)}
+
+
+def bench_treenode(args, data_dir):
+
+    root, nodes = make_tree(args.tree_size, args.fork_rate)
+    targets = [random.choice(nodes).data for _ in range(args.lookups)]
+
+    def find():
+        for data in targets:
+            tree.find(data, root)
+
+    def max_level():
+        root.max_level()
+
+    def end_children():
+        tree.get_end_children(root)
+
+    def longest():
+        tree.longest_path(root)
+
+    def strip():
+        # Stripping changes the tree, so strip a new one every time
+        tree.strip_short(make_tree(args.tree_size, args.fork_rate)[0], 2)
+
+    # find and max_level recurse once for every node
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, args.tree_size * 4 + 1000))
+
+    try:
+        return {'tree_find': timed(find, len(targets), args.repeat),
+                'tree_max_level': timed(max_level, 1, args.repeat),
+                'tree_get_end_children': timed(end_children, 1, args.repeat),
+                'tree_longest_path': timed(longest, 1, args.repeat),
+                'tree_build_and_strip': timed(strip, 1, args.repeat)}
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def bench_hash_rate(args, data_dir):
+
+    found = threading.Event()   # Never set, every search runs to the end
+    hashes = 0
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < args.hash_seconds:
+        data = create_block(Constants.GENESIS, [make_txn()], None)
+        hashes += Miner._find_hash(data, args.difficulty, 0, found, skip=1)[2]
+
+    elapsed = time.perf_counter() - start
+    return {'find_hash': {'value': hashes / elapsed, 'hashes': hashes,
+                          'unit': 'hashes/s', 'better': 'higher'}}
+
+
+def bench_wallet_send(args, data_dir):
+
+    wallet = Wallet(WORDS)
+    receiver = wallet.new_address()
+
+    # Coins of 100, enough for every run. Every send spends one and sends the
+    # change to a new address, which isn't a coin until it is confirmed
+    coins = max(args.coins, args.sends * args.repeat)
+    wallet.debug_generate_outputs(100 * coins, coins)
+
+    def send():
+        for _ in range(args.sends):
+            wallet.send(1, (receiver, 5))
+
+    return {'wallet_send': timed(send, args.sends, args.repeat)}
+
+
+class EchoPeer(Peer):
+
+    @server(params={'value': int})
+    async def _echo(self, conn, params):
+        return self.pack(Peer.OKAY, {'value': params['value']})
+
+
+class NullConnection:
+    """Stands for a connection in the dispatch benchmark. Sent data is
+    dropped
+    """
+
+    str_addr = 'benchmark'
+
+    async def send(self, data, raw=False):
+        pass
+
+
+def bench_dispatch(args, data_dir):
+
+    message = json.dumps({'type': 'post',
+                          'data': {'command': 'echo', 'id': 1, 'value': 5}})
+
+    async def dispatch():
+        peer = EchoPeer(rate_limit=float('inf'), rate_burst=float('inf'),
+                        max_pending=args.messages)
+        conn = NullConnection()
+
+        for _ in range(args.messages):
+            await peer._handler(message, conn)
+
+        # The commands run in the worker pool, wait for all of them
+        while peer.workers.pending:
+            await asyncio.sleep(0)
+
+    def create():
+        for _ in range(args.lookups):
+            EchoPeer()
+
+    return {'dispatch': timed(lambda: asyncio.run(dispatch()), args.messages,
+                              args.repeat),
+            'peer_init': timed(create, args.lookups, args.repeat)}
+
+
+BENCHMARKS = {'add_block': bench_add_block,
+              'get_block': bench_get_block,
+              'save_load': bench_save_load,
+              'headers': bench_headers,
+              'treenode': bench_treenode,
+              'hash_rate': bench_hash_rate,
+              'wallet_send': bench_wallet_send,
+              'dispatch': bench_dispatch}
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, old, threshold):
+    """Prints the change of every result from an older run
+
+    Returns:
+        list: The names of the results that got worse by more than threshold
+    """
+
+    worse = []
+
+    for name, result in results.items():
+        before = old.get(name)
+        if before is None or not before.get('value'):
+            print(f'{name:24} {"new":>10}')
+            continue
+
+        change = (result['value'] - before['value']) / before['value']
+        if result['better'] == 'higher':
+            change = -change
+
+        # Positive changes are worse
+        flag = ''
+        if change > threshold:
+            flag = 'WORSE'
+            worse.append(name)
+        elif change < -threshold:
+            flag = 'better'
+
+        print(f'{name:24} {change * 100:+9.1f}% {flag}')
+
+    return worse
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+                        help='Benchmarks to run. Defaults to all')
+    parser.add_argument('--blocks', type=int, default=500, help='Chain length')
+    parser.add_argument('--txns', type=int, default=5, help='Transactions in a block')
+    parser.add_argument('--headers', type=int, default=100000, help='Headers in the header check benchmark')
+    parser.add_argument('--width', type=int, default=3, help='Competing branches in the fork benchmark')
+    parser.add_argument('--depth', type=int, default=2, help='Blocks in every branch')
+    parser.add_argument('--lookups', type=int, default=500, help='Lookups in the get_block and find benchmarks')
+    parser.add_argument('--tree-size', type=int, default=2000, help='Nodes in the block tree')
+    parser.add_argument('--fork-rate', type=float, default=0.1, help='Chance of a node to fork the tree')
+    parser.add_argument('--difficulty', type=int, default=4, help='Difficulty of the hash rate benchmark')
+    parser.add_argument('--hash-seconds', type=float, default=3, help='Duration of the hash rate benchmark')
+    parser.add_argument('--sends', type=int, default=200, help='Transactions in the wallet benchmark')
+    parser.add_argument('--coins', type=int, default=1000, help='Coins of the wallet')
+    parser.add_argument('--messages', type=int, default=5000, help='Messages in the dispatch benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every benchmark, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='File to write the results to. Defaults to stdout')
+    parser.add_argument('--compare', help='Results of an older run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Change that counts as worse, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    results = {}
+    data_dir = tempfile.mkdtemp(prefix='benchmark-')
+
+    try:
+        for name in args.only or BENCHMARKS:
+            print(f'INFO - Running {name}', file=sys.stderr)
+            shutil.rmtree(data_dir, ignore_errors=True)
+            results.update(BENCHMARKS[name](args, data_dir))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {'version': version(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'time': time.time(),
+              'params': {key: value for key, value in vars(args).items()
+                         if not key in ('out', 'compare', 'threshold')},
+              'results': results}
+
+    if args.out is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if not args.compare is None:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+
+        if compare(results, old, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
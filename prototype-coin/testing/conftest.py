@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The tests import the modules of the project by their names, like the
+# scripts next to them that are run from the project directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
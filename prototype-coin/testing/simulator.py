@@ -0,0 +1,455 @@
+"""Runs a local network of nodes and measures how it propagates load.
+
+Starts N nodes on localhost, in this process or as subprocesses, connects them
+in a topology and has every node create synthetic transactions and blocks at
+random (Poisson) times. Every node records when it first saw every item, and
+the records are merged into a report:
+
+- The propagation latency percentiles of transactions and blocks, for every
+  node that received them and until the last node received them
+- Messages and bytes per second that the nodes received
+- Fork rates: blocks that didn't end up in the best chain, and blocks that
+  were made on a parent that already had a child
+
+    python simulator.py --nodes 8 --topology random --degree 3 \\
+        --txn-rate 50 --block-rate 0.5 --duration 30 --out report.json
+
+Blocks are not mined, so --block-rate sets the block rate of the whole
+network directly.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import block as blk
+from benchmark import make_txn
+from block import create_block, txn_hash
+from blockchain import Blockchain
+from networking.peer import IP
+from node import Node
+from treenode import longest_path
+
+TOPOLOGIES = ('line', 'ring', 'star', 'mesh', 'random')
+
+
+class SimNode(Node):
+
+    def __init__(self, index: int, **kwargs):
+        """A node that records when it first saw every transaction and block,
+        and can create synthetic load
+
+        Args:
+            index (int): The number of the node in the simulation
+
+        Attributes:
+            events (list): Items as [kind, id, time, made here]. kind is 'txn'
+            or 'block', time is the wall clock time
+
+            parents (dict): The parent hash of every block this node made
+
+            messages (int): Messages received from all the peers
+        """
+
+        super().__init__(**kwargs)
+
+        self.index = index
+        self.events = []
+        self.parents = {}
+        self.messages = 0
+        self.bytes = 0
+
+        self._seen = set()
+
+    def _record(self, kind, item_id, made=False):
+        if not item_id in self._seen:
+            self._seen.add(item_id)
+            self.events.append([kind, item_id, time.time(), made])
+
+    async def _handler(self, data, connection):
+        self.messages += 1
+        self.bytes += len(data)
+        await super()._handler(data, connection)
+
+    async def _receive_txn(self, txn_dict):
+        try:
+            self._record('txn', txn_hash(blk.to_txn(txn_dict)))
+        except (KeyError, TypeError):
+            pass
+
+        await super()._receive_txn(txn_dict)
+
+    def _block_received(self, block):
+        self._record('block', block._hash)
+        super()._block_received(block)
+
+    def tip(self):
+        """Returns the last block of the best branch"""
+
+        if self.blockchain.unconfirmed is None:
+            return self.blockchain.chain[-1]
+
+        return longest_path(self.blockchain.unconfirmed)[-1].data
+
+    def best_chain(self):
+        """Returns the hashes of the best branch, confirmed blocks first"""
+
+        hashes = [block._hash for block in self.blockchain.chain]
+        if not self.blockchain.unconfirmed is None:
+            hashes += [node.data._hash
+                       for node in longest_path(self.blockchain.unconfirmed)]
+
+        return hashes
+
+    async def make_txns(self, rate: float, until: float):
+
+        while rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.time() >= until:
+                return
+
+            txn = make_txn()
+            self._record('txn', txn_hash(txn), made=True)
+            self.recent_txns.append(txn)
+            await self.post_txn(txn)
+
+    async def make_blocks(self, rate: float, until: float, max_txns: int):
+
+        while rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.time() >= until:
+                return
+
+            parent = self.tip()
+            in_chain = set()
+            for block in self.blockchain.chain[-10:]:
+                in_chain.update(txn_hash(txn) for txn in block.txns or [])
+
+            txns = [txn for txn in self.recent_txns[-max_txns * 2:]
+                    if not txn_hash(txn) in in_chain][:max_txns]
+
+            block = create_block(parent, txns, random.getrandbits(32))
+            self.parents[block._hash] = parent._hash
+            self._record('block', block._hash, made=True)
+            self.recent_blocks.append(block._hash)
+            await self.handle_block(block)
+
+    def report(self) -> dict:
+        return {'index': self.index, 'events': self.events,
+                'parents': self.parents, 'messages': self.messages,
+                'bytes': self.bytes, 'best_chain': self.best_chain()}
+
+
+def topology(name: str, n: int, degree: int = 3):
+    """Returns the neighbours of every node. Connections go both ways, since
+    nodes relay only to their outbound peers
+
+    Args:
+        name (str): One of TOPOLOGIES
+        n (int): Number of nodes
+        degree (int, optional): Peers of every node in the random topology.
+        Defaults to 3.
+
+    Returns:
+        List[Set[int]]: The neighbours of every node
+    """
+
+    edges = set()
+
+    if name == 'line' or name == 'ring':
+        edges = {(i, i + 1) for i in range(n - 1)}
+        if name == 'ring' and n > 2:
+            edges.add((n - 1, 0))
+
+    elif name == 'star':
+        edges = {(0, i) for i in range(1, n)}
+
+    elif name == 'mesh':
+        edges = {(i, j) for i in range(n) for j in range(i + 1, n)}
+
+    elif name == 'random':
+        # A ring keeps the network connected, the rest are random
+        edges = {(i, (i + 1) % n) for i in range(n)} if n > 2 else {(0, 1)}
+        for i in range(n):
+            others = [j for j in range(n) if j != i]
+            for j in random.sample(others, min(max(degree - 2, 0), len(others))):
+                edges.add((i, j))
+
+    else:
+        raise ValueError(f'unknown topology {name}')
+
+    neighbours = [set() for _ in range(n)]
+    for i, j in edges:
+        if i != j:
+            neighbours[i].add(j)
+            neighbours[j].add(i)
+
+    return neighbours
+
+
+async def sleep_until(moment: float):
+    await asyncio.sleep(max(0, moment - time.time()))
+
+
+async def run_node(index: int, config: dict) -> dict:
+    """Runs one node of the simulation from start to end
+
+    Args:
+        index (int): The number of the node
+        config (dict): The simulation (see make_config)
+
+    Returns:
+        dict: The node's records (see SimNode.report)
+    """
+
+    n = len(config['ports'])
+    start = config['start_at']
+    end = start + config['duration']
+
+    # Blocks are not mined, so they have no proof of work
+    blockchain = Blockchain(data_dir=os.path.join(config['data_dir'], str(index)),
+                            difficulty=0)
+    node = SimNode(index, port=config['ports'][index], blockchain=blockchain,
+                   target_outbound=0)
+
+    # Start the server, and connect when all the servers are up
+    server = asyncio.create_task(node.start())
+    await sleep_until(start - config['warmup'] / 2)
+
+    for peer in config['neighbours'][index]:
+        await node.connect((IP, config['ports'][peer]), persistent=True)
+
+    await sleep_until(start)
+
+    # Every node makes its share of the network's load
+    await asyncio.gather(
+        node.make_txns(config['txn_rate'] / n, end),
+        node.make_blocks(config['block_rate'] / n, end, config['max_txns']))
+
+    await sleep_until(end + config['drain'])
+
+    report = node.report()
+    node.shutdown()
+    await server
+
+    return report
+
+
+def make_config(args) -> dict:
+
+    neighbours = topology(args.topology, args.nodes, args.degree)
+
+    return {'ports': [args.base_port + i for i in range(args.nodes)],
+            'neighbours': [sorted(peers) for peers in neighbours],
+            'data_dir': args.data_dir,
+            'start_at': time.time() + args.warmup,
+            'warmup': args.warmup,
+            'duration': args.duration,
+            'drain': args.drain,
+            'txn_rate': args.txn_rate,
+            'block_rate': args.block_rate,
+            'max_txns': args.max_txns}
+
+
+async def run_inprocess(config: dict, verbose: bool) -> list:
+
+    output = contextlib.nullcontext() if verbose else \
+        contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with output:
+        return await asyncio.gather(*[run_node(i, config)
+                                      for i in range(len(config['ports']))])
+
+
+def run_subprocesses(config: dict, verbose: bool) -> list:
+
+    config_path = os.path.join(config['data_dir'], 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    output = None if verbose else subprocess.DEVNULL
+    children = []
+    for i in range(len(config['ports'])):
+        log_path = os.path.join(config['data_dir'], f'node{i}.json')
+        children.append((log_path, subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--child', str(i),
+             '--config', config_path, '--out', log_path] +
+            (['--verbose'] if verbose else []),
+            stdout=output, stderr=output)))
+
+    reports = []
+    for log_path, child in children:
+        child.wait()
+        try:
+            with open(log_path) as f:
+                reports.append(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            print(f'WARNING - Node {log_path} did not write its report',
+                  file=sys.stderr)
+
+    return reports
+
+
+def percentiles(values: list) -> dict:
+
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    def at(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {'count': len(values), 'p50': at(50), 'p90': at(90),
+            'p99': at(99), 'max': values[-1]}
+
+
+def propagation(reports: list, kind: str) -> dict:
+    """Latencies of an item kind, from when it was made to when every other
+    node saw it
+    """
+
+    made = {}
+    seen = {}
+    for report in reports:
+        for event_kind, item_id, moment, is_origin in report['events']:
+            if event_kind != kind:
+                continue
+
+            if is_origin:
+                made[item_id] = moment
+            else:
+                seen.setdefault(item_id, []).append(moment)
+
+    others = len(reports) - 1
+    latencies = []
+    full = []
+    delivered = 0
+
+    for item_id, moment in made.items():
+        times = [t - moment for t in seen.get(item_id, [])]
+        latencies += times
+        delivered += len(times)
+
+        if len(times) == others:
+            full.append(max(times, default=0))
+
+    return {'made': len(made),
+            'coverage': delivered / (len(made) * others) if made and others else 1,
+            'latency': percentiles(latencies),
+            'full_latency': percentiles(full)}
+
+
+def summarize(reports: list, config: dict) -> dict:
+
+    txns = propagation(reports, 'txn')
+    blocks = propagation(reports, 'block')
+
+    # The best chain is the longest chain a node has
+    best = max((report['best_chain'] for report in reports), key=len, default=[])
+    best_set = set(best)
+
+    parents = {}
+    for report in reports:
+        parents.update(report['parents'])
+
+    stale = sum(1 for block_hash in parents if not block_hash in best_set)
+    children = {}
+    for parent in parents.values():
+        children[parent] = children.get(parent, 0) + 1
+
+    blocks['stale_rate'] = stale / len(parents) if parents else 0
+    blocks['fork_rate'] = sum(count - 1 for count in children.values()) / \
+        len(parents) if parents else 0
+    blocks['tip_agreement'] = sum(1 for report in reports
+                                  if report['best_chain'][-1:] == best[-1:]) / \
+        len(reports) if reports else 0
+
+    seconds = config['duration'] + config['drain']
+    messages = sum(report['messages'] for report in reports)
+    received = sum(report['bytes'] for report in reports)
+
+    return {'nodes': len(config['ports']),
+            'reports': len(reports),
+            'neighbours': config['neighbours'],
+            'txns': txns,
+            'blocks': blocks,
+            'messages': {'total': messages,
+                         'per_sec': messages / seconds,
+                         'bytes_per_sec': received / seconds}}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring')
+    parser.add_argument('--degree', type=int, default=3, help='Peers of every node in the random topology')
+    parser.add_argument('--subprocesses', action='store_true', help='Run every node in its own process')
+    parser.add_argument('--txn-rate', type=float, default=20, help='Transactions per second of the whole network')
+    parser.add_argument('--block-rate', type=float, default=0.2, help='Blocks per second of the whole network')
+    parser.add_argument('--max-txns', type=int, default=100, help='Max transactions in a block')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds to start and connect the nodes')
+    parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for propagation after the load')
+    parser.add_argument('--base-port', type=int, default=12000)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--out', help='File to write the report to. Defaults to stdout')
+    parser.add_argument('--verbose', action='store_true', help="Show the nodes' output")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(levelname)s - %(name)s - %(message)s')
+
+    if not args.child is None:
+        # A node of a simulation that runs in subprocesses
+        with open(args.config) as f:
+            config = json.load(f)
+
+        report = asyncio.run(run_node(args.child, config))
+        with open(args.out, 'w') as f:
+            json.dump(report, f)
+        return
+
+    if not args.seed is None:
+        random.seed(args.seed)
+
+    args.data_dir = tempfile.mkdtemp(prefix='simulator-')
+
+    try:
+        config = make_config(args)
+
+        if args.subprocesses:
+            reports = run_subprocesses(config, args.verbose)
+        else:
+            reports = asyncio.run(run_inprocess(config, args.verbose))
+
+        summary = summarize(reports, config)
+
+    finally:
+        shutil.rmtree(args.data_dir, ignore_errors=True)
+
+    summary['params'] = {key: value for key, value in vars(args).items()
+                         if not key in ('child', 'config', 'out', 'data_dir')}
+
+    if args.out is None:
+        print(json.dumps(summary, indent=4))
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+from networking.addrman import AddressBook
+
+PEER = ('10.0.0.1', 11111)
+
+
+def addr(i):
+    return (f'10.1.{i // 256}.{i % 256}', 11111)
+
+
+def test_source_cannot_fill_the_book():
+
+    book = AddressBook(max_size=80)
+    for i in range(10):
+        book.add(addr(i))
+        book.good(addr(i))
+
+    added = sum(book.add(addr(i), source=PEER) for i in range(100, 200))
+
+    assert added == book.max_per_source == 10
+    assert all(addr(i) in book for i in range(10))
+
+
+def test_gossip_does_not_refresh_known_addresses():
+
+    book = AddressBook()
+    book.add(addr(1))
+    book.addrs[addr(1)].last_seen = 5
+
+    assert not book.add(addr(1), source=PEER)
+    assert book.addrs[addr(1)].last_seen == 5
+
+
+def test_eviction_keeps_peers_that_worked():
+
+    book = AddressBook(max_size=16)
+    book.add(addr(0))
+    book.good(addr(0))
+
+    for i in range(1, 100):
+        book.add(addr(i), source=('10.0.0.2', i))
+
+    assert len(book) == 16
+    assert addr(0) in book
+
+
+def test_load_respects_max_size(tmp_path):
+
+    path = str(tmp_path / 'peers.csv')
+    book = AddressBook(path, max_size=100)
+    for i in range(100):
+        book.add(addr(i))
+    book.good(addr(99))
+    book.save()
+
+    small = AddressBook(path, max_size=10)
+    assert small.load()
+
+    assert len(small) == 10
+    assert addr(99) in small
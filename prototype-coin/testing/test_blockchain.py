@@ -23,17 +23,23 @@ def generate_txns(amount, wallet=None):
 
         txns = []
 
+        # One wallet with a new address for every transaction, deriving an
+        # address is much cheaper than creating a wallet
+        wallet = Wallet()
+
         for _ in range(amount):
             
-            wallet = Wallet()
-            wallet.debug_generate_outputs(60, random.randint(1, 5))
+            sender = wallet.new_address()
+            fee = random.randint(1, 10)
+            wallet.debug_generate_outputs(60 + fee, random.randint(1, 5),
+                                          addr=sender)
             
             addr_len = random.randint(1, 8)
             addrs = []
             for i in range(addr_len):
                 addrs.append((generate_invalid_address(), 60 / addr_len))
                 
-            txns.append(wallet.send(random.randint(1, 10), addrs))
+            txns.append(wallet.send(fee, addrs, sender=sender))
             
         return txns
     
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from coins import CoinPool
+
+
+def pool(*amounts):
+    coins = CoinPool()
+    for i, amount in enumerate(amounts):
+        coins.add((i, 0, 0), amount)
+    return coins
+
+
+def amounts(selected):
+    return sorted(amount for amount, _ in selected)
+
+
+def test_balance_and_sorting():
+    coins = pool(5, 1, 3)
+    assert coins.balance == 9
+    assert [amount for *_, amount in coins] == [1, 3, 5]
+
+    assert not coins.add((0, 0, 0), 7)
+    assert coins.remove((1, 0, 0)) == 1
+    assert coins.remove((1, 0, 0)) is None
+    assert coins.balance == 8
+
+
+def test_not_enough_funds():
+    assert pool(1, 2).select(4) is None
+    assert pool(1, 2).select(0) == []
+
+
+def test_single_coin_in_tolerance():
+    assert amounts(pool(1, 10, 12, 50).select(11, tolerance=1)) == [12]
+
+
+def test_exact_match_without_change():
+    # 4 + 6 pays 10 exactly, a single bigger coin would need change
+    assert amounts(pool(1, 4, 6, 20).select(10)) == [4, 6]
+
+
+def test_smallest_coin_above_target():
+    assert amounts(pool(1, 2, 15, 30).select(10)) == [15]
+
+
+def test_largest_coins_first():
+    # No exact sum and no single coin is enough
+    assert amounts(pool(3, 3, 3, 7).select(11)) == [3, 3, 7]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_selection_covers_target(seed):
+    random.seed(seed)
+    coins = pool(*[random.randint(1, 100) for _ in range(50)])
+    target = random.randint(1, coins.balance)
+
+    selected = coins.select(target, tolerance=2)
+
+    outpoints = [outpoint for _, outpoint in selected]
+    assert len(set(outpoints)) == len(outpoints)
+    assert all(coins.coins[outpoint] == amount for amount, outpoint in selected)
+    assert sum(amount for amount, _ in selected) >= target
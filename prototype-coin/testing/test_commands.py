@@ -0,0 +1,55 @@
+from networking import Peer, client, server
+from networking.commands import collect_commands, compile_schema
+
+
+def test_no_schema_checks_nothing():
+    assert compile_schema(None) is None
+    assert compile_schema({}) is None
+
+
+def test_schema_rejects_bad_parameters():
+
+    validate = compile_schema({'txid': str, 'height': (int, None),
+                               'addrs': (list, tuple)})
+
+    assert validate({'txid': 'ab', 'addrs': []}) is None
+    assert validate({'txid': 'ab', 'height': 3, 'addrs': ()}) is None
+
+    assert validate({'addrs': []}) == 'missing parameter txid'
+    assert validate({'txid': None, 'addrs': []}) == 'missing parameter txid'
+    assert validate({'txid': 1, 'addrs': []}) == 'invalid parameter txid'
+    assert validate({'txid': 'ab', 'height': '3', 'addrs': []}) == \
+        'invalid parameter height'
+    assert validate({'txid': 'ab', 'addrs': 'abc'}) == 'invalid parameter addrs'
+
+
+class Base(Peer):
+
+    @server(params={'n': int})
+    async def _count(self, params):
+        pass
+
+    @client
+    async def count(self):
+        pass
+
+
+class Child(Base):
+
+    @server
+    async def _count(self, params):
+        pass
+
+
+def test_subclasses_override_commands():
+
+    base = collect_commands(Base)['count']
+    child = collect_commands(Child)['count']
+
+    assert (base.server, base.client) == ('_count', 'count')
+    assert base.validate({}) == 'missing parameter n'
+
+    # The override has no schema, the client is inherited
+    assert (child.server, child.client, child.validate) == \
+        ('_count', 'count', None)
+    assert Child.COMMANDS['count'] == child
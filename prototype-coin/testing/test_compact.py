@@ -0,0 +1,60 @@
+import json
+import random
+
+import pytest
+
+import compact
+from benchmark import make_txn
+from block import Constants, Transaction, create_block, txn_hash
+from validation import check_pow
+
+
+@pytest.fixture
+def block():
+    random.seed(5)
+    txns = [make_txn() for _ in range(10)]
+    txns.append(Transaction('0.1', 'mine', ['miner', 10], None, None))
+    return create_block(Constants.GENESIS, txns, 7)
+
+
+def received(block):
+    """The compact block of block, after it was sent as json"""
+    cmpct_dict = json.loads(json.dumps(compact.to_json(compact.to_compact(block))))
+    return compact.from_json(cmpct_dict)
+
+
+def test_reconstruct_from_mempool(block):
+    cmpct = received(block)
+
+    # The memory pool has other transactions too, in another order
+    mempool = [make_txn() for _ in range(20)] + block.txns[:-1]
+    random.shuffle(mempool)
+
+    block_txns, missing = compact.reconstruct(cmpct, mempool)
+    assert missing == []
+
+    rebuilt = compact.fill(cmpct, block_txns, {})
+    assert [txn_hash(txn) for txn in rebuilt.txns] == \
+        [txn_hash(txn) for txn in block.txns]
+    assert rebuilt._hash == block._hash
+    assert check_pow(rebuilt, 0)
+
+
+def test_reconstruct_missing_txns(block):
+    cmpct = received(block)
+
+    block_txns, missing = compact.reconstruct(cmpct, block.txns[3:-1])
+    assert missing == [0, 1, 2]
+    assert compact.fill(cmpct, block_txns, {}) is None
+
+    fetched = {i: block.txns[i] for i in missing}
+    rebuilt = compact.fill(cmpct, block_txns, fetched)
+    assert check_pow(rebuilt, 0)
+
+
+def test_fill_rejects_wrong_txns(block):
+    cmpct = received(block)
+    block_txns, missing = compact.reconstruct(cmpct, block.txns[1:-1])
+
+    assert compact.fill(cmpct, block_txns, {0: make_txn()}) is None
+    assert compact.fill(cmpct, block_txns, {len(block.txns): block.txns[0]}) is None
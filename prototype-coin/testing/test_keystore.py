@@ -0,0 +1,65 @@
+import pytest
+from mnemonic import Mnemonic
+
+from keystore import CHANGE, RECEIVE, Keystore
+
+
+@pytest.fixture(scope='module')
+def words():
+    return Mnemonic('english').generate(strength=128)
+
+
+def counts(keystore):
+    chains = [chain for chain, _ in keystore.index.values()]
+    return chains.count(RECEIVE), chains.count(CHANGE)
+
+
+def test_derives_the_gap_limit_in_advance(words):
+
+    keystore = Keystore.from_words(words, gap_limit=3)
+
+    assert counts(keystore) == (3, 3)
+    assert keystore.used == {RECEIVE: -1, CHANGE: -1}
+    assert keystore.used_addresses() == []
+
+
+def test_using_an_address_extends_the_gap(words):
+
+    keystore = Keystore.from_words(words, gap_limit=3)
+
+    # The last watched address moves the window
+    assert keystore.mark_used(keystore.address(RECEIVE, 2))
+    assert keystore.used[RECEIVE] == 2
+    assert counts(keystore) == (6, 3)
+
+    # Using an older one changes nothing
+    assert keystore.mark_used(keystore.address(RECEIVE, 0))
+    assert counts(keystore) == (6, 3)
+
+    assert not keystore.mark_used('not an address')
+
+
+def test_new_address_takes_the_next_unused(words):
+
+    keystore = Keystore.from_words(words, gap_limit=3)
+
+    change = keystore.new_address(CHANGE)
+    assert keystore.index[change] == (CHANGE, 0)
+    assert keystore.index[keystore.new_address(CHANGE)] == (CHANGE, 1)
+    assert counts(keystore) == (3, 5)
+    assert keystore.used_addresses() == [change, keystore.address(CHANGE, 1)]
+
+
+def test_same_words_derive_the_same_keys(words):
+
+    first = Keystore.from_words(words, gap_limit=3)
+    second = Keystore.from_words(words, gap_limit=3)
+
+    assert first.xpriv == second.xpriv
+    assert list(first.addresses()) == list(second.addresses())
+
+    addr = first.address(RECEIVE, 1)
+    assert first.key_of(addr).PrivateKey() == second.key_of(addr).PrivateKey()
+
+    other = Keystore.from_words(Mnemonic('english').generate(strength=128))
+    assert not addr in other
@@ -0,0 +1,67 @@
+import pytest
+
+from networking import limiter
+from networking.limiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock that only moves when told to"""
+
+    now = [100.0]
+    monkeypatch.setattr(limiter.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_take_allows_bursts_up_to_the_capacity(clock):
+
+    bucket = TokenBucket(rate=2, capacity=4)
+
+    assert all(bucket.take() for _ in range(4))
+    assert not bucket.take()
+
+    clock[0] += 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+    # A refused request costs nothing
+    clock[0] += 1
+    assert not bucket.take(3)
+    assert bucket.take(2)
+
+
+def test_take_refills_only_to_the_capacity(clock):
+
+    bucket = TokenBucket(rate=2, capacity=4)
+    bucket.take(4)
+
+    clock[0] += 60
+    assert bucket.take(4)
+    assert not bucket.take()
+
+
+def test_reserve_returns_the_wait(clock):
+
+    bucket = TokenBucket(rate=2, capacity=4)
+
+    assert bucket.reserve(4) == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1)
+
+    # The debt is paid back before anything is allowed again
+    clock[0] += 0.5
+    assert not bucket.take()
+    clock[0] += 0.5
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_rate_limiter_keeps_a_bucket_per_peer(clock):
+
+    limits = RateLimiter(rate=1, capacity=2)
+
+    assert limits.allow('a', 2)
+    assert not limits.allow('a')
+    assert limits.allow('b')
+
+    limits.forget('a')
+    assert limits.reserve('a', 2) == 0
@@ -0,0 +1,87 @@
+import asyncio
+
+from metrics import Counter, Histogram, MetricsServer, Registry
+
+
+def test_metrics_are_created_once():
+
+    registry = Registry()
+    counter = registry.counter('messages', 'Received messages', peer='a')
+
+    assert registry.counter('messages', peer='a') is counter
+    assert registry.counter('messages', peer='b') is not counter
+
+
+def test_histogram_buckets():
+
+    histogram = Histogram([1, 5])
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.mean() == 3.625
+    assert histogram.snapshot() == {'buckets': {'1': 2, '5': 1, 'inf': 1},
+                                    'count': 4, 'sum': 14.5}
+
+
+def test_snapshot_includes_collectors_and_registries():
+
+    registry = Registry()
+    registry.counter('messages').inc(3)
+    registry.gauge('mempool', func=lambda: 7)
+    registry.collector(lambda: [('bytes', {'peer': 'a'}, Counter(10))])
+
+    other = Registry()
+    other.gauge('height').set(4)
+    registry.include(other)
+    registry.include(registry)
+
+    assert registry.snapshot() == {
+        'messages': [{'labels': {}, 'value': 3}],
+        'mempool': [{'labels': {}, 'value': 7}],
+        'bytes': [{'labels': {'peer': 'a'}, 'value': 10}],
+        'height': [{'labels': {}, 'value': 4}]}
+
+
+def test_text_format():
+
+    registry = Registry()
+    registry.counter('messages', 'Received messages', type='get').inc()
+    registry.histogram('latency', 'Command seconds', buckets=[1]).observe(2)
+
+    assert registry.text().splitlines() == [
+        '# HELP messages Received messages',
+        '# TYPE messages counter',
+        'messages{type="get"} 1',
+        '# HELP latency Command seconds',
+        '# TYPE latency histogram',
+        'latency_bucket{le="1"} 0',
+        'latency_bucket{le="+Inf"} 1',
+        'latency_sum 2',
+        'latency_count 1']
+
+
+def test_server_answers_with_the_metrics():
+
+    async def run():
+        registry = Registry()
+        registry.counter('messages').inc(2)
+
+        server = MetricsServer(registry, 0)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+        finally:
+            await server.close()
+
+        return response.decode()
+
+    response = asyncio.run(run())
+
+    assert response.startswith('HTTP/1.0 200 OK')
+    assert response.endswith('\r\n\r\n# TYPE messages counter\nmessages 2\n')
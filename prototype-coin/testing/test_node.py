@@ -0,0 +1,62 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+import blockchain
+from benchmark import make_blocks
+from block import ClsEncoder
+from node import Node
+
+
+class FakeConnection:
+    """Answers every request with the same response"""
+
+    def __init__(self, response, port=1):
+        self.addr = ('127.0.0.1', port)
+        self.str_addr = f'127.0.0.1:{port}'
+        self.listen_addr = self.addr
+        self.response = response
+        self.requests = []
+
+    async def request(self, data, timeout=3):
+        self.requests.append(data)
+        return self.response
+
+
+@pytest.fixture
+def node(tmp_path):
+    bc = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0)
+    node = Node(port=None, blockchain=bc)
+    node.synced.set()
+    yield node
+    bc.close()
+
+
+def test_post_block_asks_best_peers_after_an_error(node, monkeypatch):
+    random.seed(7)
+    block = make_blocks(node.blockchain.chain[0], 1, 2)[0]
+
+    announcer = FakeConnection({'type': 'error',
+                                'data': {'message': 'block not found'}})
+    best = FakeConnection({'type': 'okay', 'data': {
+        'block': json.loads(json.dumps(block, cls=ClsEncoder))}}, port=2)
+
+    async def server_conn(conn):
+        return announcer
+
+    posted = []
+
+    async def post_block(block):
+        posted.append(block._hash)
+
+    monkeypatch.setattr(node, '_server_conn', server_conn)
+    monkeypatch.setattr(node, 'best_peers', lambda n: [best])
+    monkeypatch.setattr(node, 'post_block', post_block)
+
+    asyncio.run(node._post_block(announcer, {'hash': block._hash}))
+
+    assert announcer.requests and best.requests
+    assert not node.blockchain.get_block(block._hash) is None
+    assert posted == [block._hash]
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from payouts import PayoutBuilder
+from utxo import spent_outpoints
+from wallet import NotEnoughFundsError, Wallet
+
+
+@pytest.fixture
+def wallet():
+    wallet = Wallet()
+    wallet.debug_generate_outputs(1000, 50)
+    return wallet
+
+
+def payouts(wallet, n=30):
+    return [(wallet.new_address(), 1) for _ in range(n)]
+
+
+def spent(txns, coins):
+    return sum(coins[outpoint] for txn in txns
+               for outpoint in spent_outpoints(txn))
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_build_releases_coins_when_stopped_early(wallet, processes):
+
+    coins = dict(wallet.utxos.coins)
+    builder = PayoutBuilder(wallet, max_outputs=2, processes=processes,
+                            chunk_size=3)
+
+    try:
+        txns = builder.build(payouts(wallet))
+        first = next(txns)
+        txns.close()
+
+        # Only the coins of the returned transaction stay reserved
+        assert wallet.get_balance() == 1000 - spent([first], coins)
+
+        txns = list(builder.build(payouts(wallet)))
+        assert len(txns) == 15
+        assert wallet.get_balance() == \
+            1000 - spent([first], coins) - spent(txns, coins)
+
+    finally:
+        builder.close()
+
+
+def test_stream_releases_coins_when_stopped_early(wallet):
+
+    coins = dict(wallet.utxos.coins)
+    builder = PayoutBuilder(wallet, max_outputs=2, processes=0, chunk_size=3)
+
+    async def first():
+        txns = builder.stream(payouts(wallet))
+        txn = await txns.__anext__()
+        await txns.aclose()
+        return txn
+
+    txn = asyncio.run(first())
+
+    assert wallet.get_balance() == 1000 - spent([txn], coins)
+
+
+def test_plan_reserves_nothing_without_enough_funds(wallet):
+
+    builder = PayoutBuilder(wallet, max_outputs=2, processes=0)
+
+    with pytest.raises(NotEnoughFundsError):
+        builder.plan([(wallet.new_address(), 100) for _ in range(30)])
+
+    assert wallet.get_balance() == 1000
@@ -0,0 +1,182 @@
+import asyncio
+import json
+
+from networking import Peer, server
+from networking.scoring import PeerScore
+
+
+class FakeConnection:
+    """Records what the peer sends instead of sending it"""
+
+    def __init__(self, port=1):
+        self.addr = ('127.0.0.1', port)
+        self.str_addr = f'127.0.0.1:{port}'
+        self.listen_addr = None
+        self.score = PeerScore()
+        self.sent = []
+
+    async def send(self, data, raw=False):
+        self.sent.append(data)
+
+
+class FakeScore:
+
+    def __init__(self, cost):
+        self._cost = cost
+
+    def cost(self):
+        return self._cost
+
+
+class AnsweringConnection:
+    """Answers every request with the same response after a delay. None
+    stands for a peer that fails"""
+
+    def __init__(self, response, delay=0, cost=0):
+        self.response = response
+        self.delay = delay
+        self.score = FakeScore(cost)
+        self.asked = 0
+
+    async def request(self, data, timeout=3):
+        self.asked += 1
+        await asyncio.sleep(self.delay)
+        return self.response
+
+
+class SlowPeer(Peer):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = asyncio.Event()
+
+    @server
+    async def _wait(self, params):
+        await self.release.wait()
+        return self.pack(Peer.OKAY, {})
+
+    @server(params={'height': int, 'hash': (str, None)})
+    async def _echo(self, params):
+        return self.pack(Peer.OKAY, params)
+
+
+def get(command, request_id, **params):
+    return json.dumps({'type': 'get', 'data': {'command': command,
+                                               'id': request_id, **params}})
+
+
+def test_full_pool_sheds_with_error():
+
+    async def run():
+        peer = SlowPeer(workers=1, max_pending=2)
+        conn = FakeConnection()
+
+        # Every handler returns right away, the commands wait in the pool
+        for request_id in range(1, 4):
+            await asyncio.wait_for(peer._handler(get('wait', request_id), conn), 1)
+
+        assert peer.workers.shed == 1
+        assert conn.sent == [{'type': 'error',
+                              'data': {'message': 'overloaded'}, 'id': 3}]
+
+        peer.release.set()
+        await asyncio.sleep(0.01)
+        assert sorted(reply['id'] for reply in conn.sent) == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+def answer(height):
+    return {'type': 'okay', 'data': {'height': height}}
+
+
+def height(response):
+    return response['data']['height']
+
+
+def fanout(conns, **kwargs):
+
+    async def run():
+        return await Peer().fanout({'type': 'get', 'data': {}}, conns=conns,
+                                   **kwargs)
+
+    return [response for conn, response in asyncio.run(run())]
+
+
+def test_fanout_returns_the_first_k_answers():
+
+    conns = [AnsweringConnection(answer(i), delay=i / 100) for i in range(4)]
+
+    assert fanout(conns, k=2) == [answer(0), answer(1)]
+    assert len(fanout(conns)) == 4
+
+
+def test_fanout_waits_for_a_quorum():
+
+    conns = [AnsweringConnection(answer(5), delay=0.01),
+             AnsweringConnection(answer(6)),
+             AnsweringConnection(answer(5), delay=0.02),
+             AnsweringConnection(answer(6), delay=0.05)]
+
+    assert fanout(conns, k=2, key=height) == [answer(5), answer(5)]
+
+
+def test_fanout_returns_the_biggest_group_without_a_quorum():
+
+    conns = [AnsweringConnection(answer(5)),
+             AnsweringConnection(answer(6)),
+             AnsweringConnection(answer(6)),
+             AnsweringConnection({'type': 'okay', 'data': {}})]
+
+    assert fanout(conns, k=3, key=height, timeout=0.1) == [answer(6), answer(6)]
+
+
+def test_fanout_skips_a_failing_peer():
+
+    failing = AnsweringConnection(None, cost=0)
+    conns = [failing, AnsweringConnection(answer(1), cost=1)]
+
+    assert fanout(conns) == [answer(1)]
+
+
+def test_hedged_fanout_asks_another_peer_when_one_fails():
+
+    failing = AnsweringConnection(None, cost=0)
+    spare = AnsweringConnection(answer(2), cost=2)
+    conns = [spare, AnsweringConnection(answer(1), cost=1), failing]
+
+    assert fanout(conns, k=2, hedge_after=1) == [answer(1), answer(2)]
+    assert failing.asked == spare.asked == 1
+
+
+def test_hedged_fanout_asks_another_peer_when_one_is_slow():
+
+    slow = AnsweringConnection(answer(1), delay=1, cost=0)
+    spare = AnsweringConnection(answer(2), cost=1)
+
+    assert fanout([slow, spare], k=1, hedge_after=0.01) == [answer(2)]
+
+
+def test_invalid_parameters_are_answered_with_an_error():
+
+    async def run():
+        peer = SlowPeer()
+        conn = FakeConnection()
+
+        for request_id, params in enumerate([{'hash': 'ab'},
+                                             {'height': '1'},
+                                             {'height': 1, 'hash': 2},
+                                             {'height': 1}], 1):
+            await peer._handler(get('echo', request_id, **params), conn)
+        await asyncio.sleep(0.01)
+
+        return conn
+
+    conn = asyncio.run(run())
+
+    assert conn.sent[:3] == [
+        {'type': 'error', 'data': {'message': 'missing parameter height'}, 'id': 1},
+        {'type': 'error', 'data': {'message': 'invalid parameter height'}, 'id': 2},
+        {'type': 'error', 'data': {'message': 'invalid parameter hash'}, 'id': 3}]
+    assert conn.sent[3] == {'type': 'okay', 'data': {'height': 1}, 'id': 4}
+    assert conn.score.misbehaviour == 15
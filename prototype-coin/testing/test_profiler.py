@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+from profiler import Profiler
+
+
+class Work:
+
+    def add(self, a, b):
+        return a + b
+
+    async def wait(self):
+        await asyncio.sleep(0.01)
+        return 'done'
+
+
+def spans(profiler):
+    return {span['labels']['span']: span['value']['count']
+            for span in profiler.snapshot()['spans']}
+
+
+def test_instrument_times_the_instance_only():
+
+    profiler = Profiler()
+    work = Work()
+    profiler.instrument(work, ['add', 'wait'], 'work')
+
+    assert work.add(1, 2) == 3
+    assert asyncio.run(work.wait()) == 'done'
+    Work().add(1, 2)
+
+    assert spans(profiler) == {'work.add': 1, 'work.wait': 1}
+
+    # The coroutine is timed until it finished, not until it was created
+    wait = profiler.metrics.histogram('span_seconds', span='work.wait')
+    assert wait.sum >= 0.01
+
+
+def test_span_counts_failed_calls():
+
+    profiler = Profiler()
+
+    try:
+        with profiler.span('fails'):
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert spans(profiler) == {'fails': 1}
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_folds_the_stacks_of_other_threads():
+
+    profiler = Profiler(rate=200)
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop, ), name='busy worker')
+    thread.start()
+
+    profiler.start()
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stop.set()
+    thread.join()
+
+    assert not profiler.running
+    assert profiler.samples > 0
+
+    folded = profiler.folded().splitlines()
+    assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in folded)
+    assert any(line.startswith('busy_worker;') and
+               'test_profiler.busy' in line for line in folded)
+    assert not any('Profiler._run' in line for line in folded)
+
+    profiler.reset()
+    assert profiler.samples == 0 and profiler.folded() == ''
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+import blockchain
+from benchmark import make_blocks
+from node import Node
+from utxo import UTXOSet
+
+
+@pytest.fixture
+def chain(tmp_path):
+    """A blockchain with 12 blocks, the last two unconfirmed. The synthetic
+    blocks have no proof of work"""
+
+    random.seed(1)
+    bc = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0)
+    main = make_blocks(bc.chain[0], 12, 3)
+    for block in main:
+        assert bc.add_block(block)
+
+    yield bc, main
+    bc.close()
+
+
+def hashes(bc):
+    return [block._hash for block in bc.chain]
+
+
+def test_fork_overtakes_chain(chain):
+    bc, main = chain
+
+    # Forks after the 5th block. With one block less it only ties
+    fork = make_blocks(main[4], 8, 2)
+    for block in fork[:-1]:
+        bc.add_block(block)
+    assert hashes(bc)[6] == main[5]._hash
+
+    bc.add_block(fork[-1])
+
+    best = [bc.chain[0]] + main[:5] + fork
+    assert hashes(bc) == [block._hash for block in best[:len(bc.chain)]]
+
+    # The blocks that lost are kept, so they can win back
+    assert main[5]._hash in bc.side
+
+
+def test_utxos_match_rebuild(chain):
+    bc, main = chain
+
+    for block in make_blocks(main[4], 9, 2):
+        bc.add_block(block)
+
+    rebuilt = UTXOSet()
+    for index, block in enumerate(bc.chain):
+        rebuilt.apply_block(index, block)
+
+    assert bc.utxos.utxos == rebuilt.utxos
+    assert bc.utxos.height == rebuilt.height
+
+
+def test_disconnected_txns_go_back_to_mempool(chain):
+    bc, main = chain
+    node = Node(port=None, blockchain=bc)
+
+    for block in make_blocks(main[4], 9, 2):
+        node._block_received(block)
+
+    # The blocks that lost are all the blocks after the fork point
+    lost = [txn for block in main[5:] for txn in block.txns]
+    assert len(node.recent_txns) == len(lost)
+    assert all(txn in node.recent_txns for txn in lost)
+    assert bc.take_disconnected_txns() == []
+
+
+def test_reload_after_rewind(chain, tmp_path):
+    bc, main = chain
+
+    for block in make_blocks(main[4], 9, 2):
+        bc.add_block(block)
+
+    expected = hashes(bc)
+    bc.io.submit(lambda: None).result()
+
+    loaded = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0)
+    loaded.load()
+    try:
+        assert hashes(loaded) == expected
+        assert loaded.utxos.utxos == bc.utxos.utxos
+    finally:
+        loaded.close()
+
+
+def test_reorg_deeper_than_max_reorg_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(blockchain, 'MAX_REORG', 3)
+
+    random.seed(2)
+    bc = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0)
+    main = make_blocks(bc.chain[0], 12, 1)
+    for block in main:
+        bc.add_block(block)
+
+    expected = hashes(bc)
+
+    # Forks 8 confirmed blocks deep, more than the undo data kept
+    for block in make_blocks(main[1], 14, 1):
+        bc.add_block(block)
+
+    try:
+        assert hashes(bc) == expected
+        assert bc.take_disconnected_txns() == []
+    finally:
+        bc.close()
@@ -0,0 +1,110 @@
+import os
+import random
+
+import pytest
+
+import blockchain
+import storage
+from benchmark import make_blocks
+from block import Constants
+
+
+@pytest.fixture
+def blocks():
+    """Blocks that continue the genesis block. The synthetic blocks have no
+    proof of work"""
+
+    random.seed(3)
+    return make_blocks(Constants.GENESIS, 12, 3)
+
+
+def write(path, blocks, batch_size=100):
+    writer = storage.BlockWriter(str(path), batch_size=batch_size)
+    for block in blocks:
+        writer.append(block)
+    writer.close()
+
+
+def load(path, **kwargs):
+    bc = blockchain.Blockchain(data_dir=str(path), difficulty=0, **kwargs)
+    bc.load()
+    bc.close()
+    return bc
+
+
+def hashes(chain):
+    return [block._hash for block in chain]
+
+
+@pytest.mark.parametrize('tip', [True, False])
+def test_truncated_last_row(tmp_path, blocks, tip):
+    write(tmp_path, blocks)
+
+    # Files written by older versions have no tip file
+    if not tip:
+        os.remove(tmp_path / 'tip.json')
+
+    # A crash in the middle of the next batch
+    for name in ('txns.csv', 'metadata.csv'):
+        with open(tmp_path / name, 'a') as f:
+            f.write('0.1,1a2b3c')
+
+    bc = load(tmp_path)
+
+    assert hashes(bc.chain) == hashes([Constants.GENESIS] + blocks)
+    for name in ('txns.csv', 'metadata.csv'):
+        with open(tmp_path / name, 'rb') as f:
+            assert f.read().endswith(b'\n')
+
+
+def test_wal_replay_after_crash_before_tip(tmp_path, blocks):
+    writer = storage.BlockWriter(str(tmp_path), batch_size=5)
+    for block in blocks[:5]:
+        writer.append(block)
+    writer.flush()
+
+    # The next batch reaches the data files, but the process dies before
+    # the tip file is replaced and the log is emptied
+    def crash(tip_hash):
+        raise SystemExit
+
+    writer._write_tip = crash
+    for block in blocks[5:10]:
+        writer.append(block)
+    writer.executor.shutdown(wait=True)
+    writer._close_wal()
+
+    # The rows of the batch are in the data files, past the tip
+    tip = writer._read_tip()
+    assert os.path.getsize(tmp_path / 'metadata.csv') > tip['metadata_size']
+
+    bc = load(tmp_path)
+
+    assert hashes(bc.chain) == hashes([Constants.GENESIS] + blocks[:10])
+    assert os.path.getsize(tmp_path / 'wal.log') == 0
+
+    # Written once, not once before the crash and again from the log
+    with open(tmp_path / 'metadata.csv') as f:
+        assert len(f.readlines()) == 1 + 10
+
+
+def test_pruned_chain_reloads_headers_only(tmp_path):
+    random.seed(4)
+    bc = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0,
+                               prune_blocks=15)
+    bc.add_blocks(make_blocks(bc.chain[0], 40, 3), is_confirmed=True)
+    bc.prune(force=True)
+    bc.close()
+
+    assert bc.first_body > 0
+
+    loaded = load(tmp_path, prune_blocks=15)
+
+    assert hashes(loaded.chain) == hashes(bc.chain)
+    assert loaded.first_body == bc.first_body
+    # The genesis block is always known
+    assert all(block.txns is None
+               for block in loaded.chain[1:loaded.first_body])
+    assert all(not block.txns is None
+               for block in loaded.chain[loaded.first_body:])
+    assert loaded.utxos.utxos == bc.utxos.utxos
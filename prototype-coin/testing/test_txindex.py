@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from benchmark import make_blocks
+from block import Constants, txn_hash
+from txindex import SENT, TxIndex
+
+
+@pytest.fixture
+def chain():
+    random.seed(5)
+    return [Constants.GENESIS] + make_blocks(Constants.GENESIS, 6, 3)
+
+
+def build(path, chain):
+    index = TxIndex(str(path))
+    for i, block in enumerate(chain):
+        index.connect_block(i, block)
+    index.write(index.take_pending())
+    return index
+
+
+def reload(path, chain):
+    index = TxIndex(str(path))
+    index.load(chain)
+    return index
+
+
+def test_reload_finds_every_transaction(tmp_path, chain):
+
+    index = build(tmp_path, chain)
+    loaded = reload(tmp_path, chain)
+
+    assert loaded.txns == index.txns
+    assert loaded.addrs == index.addrs
+    assert (loaded.height, loaded.tip_hash) == (len(chain), chain[-1]._hash)
+
+    txn = chain[3].txns[1]
+    assert loaded.find(txn_hash(txn)) == (3, 1)
+    assert loaded.txids(txn[1]) == [txn_hash(txn)]
+    assert loaded.outpoints(txn[1]) == []
+
+
+def test_disconnect_and_reload(tmp_path, chain):
+
+    index = build(tmp_path, chain)
+    for i in range(len(chain) - 1, 4, -1):
+        index.disconnect_block(i, chain[i])
+    index.write(index.take_pending())
+
+    # Another branch replaces the disconnected blocks
+    fork = make_blocks(chain[4], 2, 3)
+    for i, block in enumerate(fork, 5):
+        index.connect_block(i, block)
+    index.write(index.take_pending())
+
+    new_chain = chain[:5] + fork
+    loaded = reload(tmp_path, new_chain)
+
+    assert loaded.txns == index.txns == build(tmp_path / 'new', new_chain).txns
+    assert loaded.addrs == index.addrs
+
+    for txn in chain[5].txns + chain[6].txns:
+        assert loaded.find(txn_hash(txn)) is None
+        assert loaded.txids(txn[1]) == []
+
+    txn = fork[1].txns[0]
+    assert loaded.find(txn_hash(txn)) == (6, 0)
+    assert loaded.addrs[txn[1]] == [(txn_hash(txn), 6, 0, SENT)]
+
+
+def test_reload_skips_rows_of_a_torn_write(tmp_path, chain):
+
+    index = build(tmp_path, chain[:5])
+
+    # The rows were written, but the tip wasn't
+    tip = open(index.tip_path).read()
+    for i, block in enumerate(chain[5:], 5):
+        index.connect_block(i, block)
+    index.write(index.take_pending())
+    open(index.tip_path, 'w').write(tip)
+
+    loaded = reload(tmp_path, chain[:5])
+
+    assert loaded.txns == build(tmp_path / 'new', chain[:5]).txns
+    assert loaded.height == 5
+
+
+def test_reload_rebuilds_an_index_of_another_chain(tmp_path, chain):
+
+    build(tmp_path, chain)
+
+    other = [Constants.GENESIS] + make_blocks(Constants.GENESIS, 3, 2)
+    loaded = reload(tmp_path, other)
+
+    assert loaded.txns == build(tmp_path / 'new', other).txns
+    assert loaded.height == len(other)
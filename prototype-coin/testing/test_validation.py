@@ -0,0 +1,124 @@
+import hashlib
+import random
+
+import pytest
+
+import blockchain
+from benchmark import make_blocks
+from block import Block, Constants, Transaction, block_hash, create_block
+from validation import check_checkpoints, check_headers, check_pow
+
+GENESIS = Constants.GENESIS._hash
+
+
+def headers(count, difficulty=2):
+    """Hashes with the proof of work and the hashes they continue"""
+
+    hashes = ['0' * difficulty +
+              hashlib.sha256(str(i).encode()).hexdigest()[difficulty:]
+              for i in range(count)]
+    return hashes, [GENESIS] + hashes[:-1]
+
+
+def test_valid_headers():
+    hashes, last_hashes = headers(20)
+    assert check_headers(hashes, last_hashes, GENESIS, 2, batch=7) == 20
+    assert check_headers([], [], GENESIS, 2) == 0
+
+
+def test_broken_link_in_batch():
+    hashes, last_hashes = headers(20)
+    last_hashes[10] = hashes[5]
+    assert check_headers(hashes, last_hashes, GENESIS, 2, batch=16) == 10
+
+
+@pytest.mark.parametrize('broken', [7, 8])
+def test_broken_link_across_batches(broken):
+    # With batches of 8 the first block of the second batch continues the
+    # last block of the first one
+    hashes, last_hashes = headers(20)
+    last_hashes[broken] = GENESIS
+    assert check_headers(hashes, last_hashes, GENESIS, 2, batch=8) == broken
+
+
+def test_wrong_first_parent():
+    hashes, last_hashes = headers(5)
+    assert check_headers(hashes, last_hashes, hashes[0], 2) == 0
+
+
+def test_too_little_work():
+    hashes, last_hashes = headers(20)
+    hashes[12] = '0f' + hashes[12][2:]
+    last_hashes[13] = hashes[12]
+    assert check_headers(hashes, last_hashes, GENESIS, 2) == 12
+    assert check_headers(hashes, last_hashes, GENESIS, 1) == 20
+
+
+@pytest.mark.parametrize('bad', ['', '000', '0' * 63, '0' * 65,
+                                 '00' + 'G' * 62, ' ' * 64, None])
+def test_malformed_hash(bad):
+    hashes, last_hashes = headers(10)
+    hashes[4] = bad
+    last_hashes[5] = bad
+    assert check_headers(hashes, last_hashes, GENESIS, 2) == 4
+    assert check_headers(hashes, last_hashes, GENESIS, 0) == 4
+
+
+def test_checkpoints():
+    hashes, _ = headers(20)
+    assert check_checkpoints(hashes, 1, {5: hashes[4], 10: hashes[9]}) == 20
+    assert check_checkpoints(hashes, 1, {5: hashes[4], 10: 'bad'}) == 9
+    assert check_checkpoints(hashes, 11, {5: 'bad', 100: 'bad'}) == 20
+
+
+@pytest.fixture
+def blocks():
+    """Blocks without proof of work, the 8th with transactions that don't
+    spend anything"""
+
+    random.seed(8)
+    blocks = make_blocks(Constants.GENESIS, 7, 2)
+    bad = create_block(blocks[-1], [Transaction('0.1', 'x', [['a', 1]], [],
+                                                None)], 0)
+    return blocks + [bad] + make_blocks(bad, 4, 2)
+
+
+def verify(path, blocks, **kwargs):
+    bc = blockchain.Blockchain(data_dir=str(path), difficulty=0, **kwargs)
+    try:
+        return bc.verify_blocks(blocks, 1)
+    finally:
+        bc.close()
+
+
+def test_checkpoint_mismatch(tmp_path, blocks):
+    assert verify(tmp_path, blocks, checkpoints={3: blocks[2]._hash}) == 7
+    assert verify(tmp_path, blocks[:7], checkpoints={3: 'bad'}) == 2
+
+
+def test_txns_above_assume_valid_height(tmp_path, blocks):
+    # The 8th block is above the last checkpoint
+    assert verify(tmp_path, blocks, checkpoints={7: blocks[6]._hash}) == 7
+
+
+def test_txns_below_assume_valid_height(tmp_path, blocks):
+    checkpoints = {10: blocks[9]._hash}
+    assert verify(tmp_path, blocks, checkpoints=checkpoints) == len(blocks)
+    assert verify(tmp_path, blocks, checkpoints=checkpoints,
+                  assume_valid=False) == 7
+
+
+def test_body_is_checked_below_assume_valid_height(tmp_path, blocks):
+    # The hash is trusted, but the transactions have to be the ones it
+    # was computed from
+    blocks[3].txns = blocks[4].txns
+    checkpoints = {10: blocks[9]._hash}
+    assert verify(tmp_path, blocks, checkpoints=checkpoints) == 3
+
+
+def test_default_hash_is_the_miners():
+    block = Block(GENESIS, [Transaction('0.1', 'mine', ['a', 10], None, None)], 3)
+
+    assert check_pow(Constants.GENESIS, 0)
+    assert check_pow(block, 0)
+    assert block._hash == block_hash(block.timestamp, GENESIS, block.txns, 3)
@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+import blockchain
+from benchmark import make_blocks, random_hash
+from block import Transaction, create_block
+from wallet import Wallet
+
+
+@pytest.fixture(scope='module')
+def words():
+    return Wallet().words
+
+
+@pytest.fixture
+def chain(tmp_path):
+    random.seed(4)
+    bc = blockchain.Blockchain(data_dir=str(tmp_path), difficulty=0)
+    yield bc
+    bc.close()
+
+
+def pay(addr, amount, sender=None, spent=()):
+    """An unsigned transaction that pays amount to addr"""
+
+    sender = random_hash()[:34] if sender is None else sender
+    return Transaction('0.1', sender, ((addr, amount), ('FEES', 1)),
+                       [list(outpoint) for outpoint in spent],
+                       (random_hash(), random_hash()))
+
+
+def extend(last, *txns):
+    return create_block(last, list(txns), random.randint(0, 1 << 32))
+
+
+def test_balance_follows_a_reorg(chain, words):
+
+    wallet = Wallet(words)
+    chain.subscribe(wallet)
+
+    # Gets 50 and spends it, 20 to someone else and 29 back
+    b1 = extend(chain.chain[0], pay(wallet.addr, 50))
+    b2 = extend(b1, Transaction('0.1', wallet.addr,
+                                (('someone', 20), (wallet.addr, 29), ('FEES', 1)),
+                                [[1, 0, 0]], (random_hash(), random_hash())))
+    main = [b1, b2] + make_blocks(b2, 3, 2)
+    for block in main:
+        assert chain.add_block(block)
+
+    assert chain.chain[2]._hash == b2._hash
+    assert wallet.get_balance() == 29
+
+    # A longer branch after b1 drops the spend and pays 7 instead
+    fork = [extend(b1, pay(wallet.addr, 7))]
+    fork += make_blocks(fork[0], 4, 2)
+    for block in fork:
+        chain.add_block(block)
+
+    assert chain.chain[2]._hash == fork[0]._hash
+    assert wallet.get_balance() == 57
+    assert sorted(wallet.coin_addrs) == [(1, 0, 0), (2, 0, 0)]
+    assert (wallet.sync_height, wallet.sync_hash) == \
+        (chain.height(), chain.last_block()._hash)
+
+    # A wallet that scans the chain from scratch agrees
+    rescanned = Wallet(words)
+    rescanned.update_utxo(chain)
+    assert rescanned.get_balance() == 57
+
+
+def test_saved_wallet_syncs_across_a_reorg(chain, words, tmp_path):
+
+    path = str(tmp_path / 'wallet.csv')
+    wallet = Wallet(words, state_path=path)
+    chain.subscribe(wallet)
+
+    b1 = extend(chain.chain[0], pay(wallet.addr, 50))
+    b2 = extend(b1, pay(wallet.addr, 5))
+    main = [b1, b2] + make_blocks(b2, 4, 2)
+    for block in main:
+        chain.add_block(block)
+
+    assert wallet.get_balance() == 55
+    wallet.save_state()
+    chain.unsubscribe(wallet)
+
+    # New blocks while the wallet is closed only need a scan of those
+    more = make_blocks(main[-1], 2, 2)
+    more.append(extend(more[-1], pay(wallet.addr, 3)))
+    more += make_blocks(more[-1], 3, 2)
+    for block in more:
+        chain.add_block(block)
+
+    restored = Wallet(words, state_path=path)
+    assert restored.get_balance() == 55
+    chain.subscribe(restored)
+    assert restored.get_balance() == 58
+
+    # The chain changed under a saved state, so it scans again
+    restored.save_state()
+    chain.unsubscribe(restored)
+    fork = make_blocks(b1, len(chain.chain) + 2, 2)
+    for block in fork:
+        chain.add_block(block)
+
+    restored = Wallet(words, state_path=path)
+    chain.subscribe(restored)
+    assert restored.get_balance() == 50
@@ -0,0 +1,50 @@
+import json
+import random
+
+import pytest
+
+from benchmark import make_txn
+from networking import wire
+
+FEATURE_SETS = [(), (wire.BINARY, ), wire.FEATURES]
+
+
+def message(txns):
+    random.seed(6)
+    return {'type': 'post',
+            'data': {'command': 'post_txns', 'id': 4,
+                     'txns': [dict(make_txn()._asdict()) for _ in range(txns)]}}
+
+
+@pytest.mark.parametrize('features', FEATURE_SETS)
+@pytest.mark.parametrize('txns', [0, 1, 50])
+def test_round_trip(features, txns):
+    data = message(txns)
+    frame = wire.encode(data, features)
+
+    assert isinstance(frame, bytes if wire.BINARY in features else str)
+    # Tuples come back as lists, like in json messages
+    assert wire.decode(frame) == json.loads(json.dumps(data))
+
+
+def test_big_frames_are_compressed():
+    data = message(50)
+
+    plain = wire.encode(data, (wire.BINARY, ))
+    compressed = wire.encode(data, wire.FEATURES)
+
+    assert len(compressed) < len(plain)
+    assert wire.decode(compressed) == wire.decode(plain)
+
+
+@pytest.mark.parametrize('frame', [
+    'not json',
+    b'PC',
+    b'XX\x01\x00\x00\x00\x00\x02{}',
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, 0, 5) + b'{}',
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, wire.COMPRESSED, 2) + b'{}',
+    wire.HEADER.pack(wire.MAGIC, wire.VERSION, 0, wire.MAX_SIZE + 1),
+])
+def test_invalid_frames(frame):
+    with pytest.raises(wire.DecodeError):
+        wire.decode(frame)
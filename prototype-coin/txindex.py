@@ -0,0 +1,261 @@
+import csv
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from block import Block, txn_hash
+from utxo import Outpoint, receivers
+
+log = logging.getLogger(__name__)
+
+TXN_FIELDS = ['txid', 'block', 'txn']
+ADDR_FIELDS = ['addr', 'txid', 'block', 'txn', 'output']
+
+# The output column of address rows where the address is the sender
+SENT = -1
+
+
+class TxIndex:
+
+    def __init__(self, path: str):
+        """Indexes of the confirmed chain: the location of every transaction by
+        its id, and the transactions and outputs of every address. Built
+        incrementally when blocks are connected to the chain, and appended to
+        csv files in the index directory (txindex.csv and addrindex.csv).
+        After every write the indexed height and tip hash are written to
+        index.json, so rows of a torn write are ignored by load.
+
+        Args:
+            path (str): The index directory
+
+        Attributes:
+            txns (Dict[str, Tuple[int, int]]): The block index and transaction
+            index of every transaction id
+
+            addrs (Dict[str, List[tuple]]): The rows of every address, in chain
+            order: (txid, block, txn, output). output is SENT for the
+            transactions the address sent
+
+            height (int): Number of blocks in the index
+        """
+
+        self.path = path
+        self.txns_path = os.path.join(path, 'txindex.csv')
+        self.addrs_path = os.path.join(path, 'addrindex.csv')
+        self.tip_path = os.path.join(path, 'index.json')
+
+        self.txns: Dict[str, Tuple[int, int]] = {}
+        self.addrs: Dict[str, List[tuple]] = {}
+        self.height = 0
+        self.tip_hash = None
+
+        self._pending_txns = []
+        self._pending_addrs = []
+        self._rewrite = False   # The files have blocks that were disconnected
+
+    def find(self, txid: str) -> Optional[Tuple[int, int]]:
+        """Finds a transaction
+
+        Args:
+            txid (str): The transaction id
+
+        Returns:
+            Optional[Tuple[int, int]]: The index of the block in the chain and
+            of the transaction in the block. None if not found
+        """
+        return self.txns.get(txid)
+
+    def txids(self, addr: str) -> List[str]:
+        """Returns the ids of the transactions an address sent or received,
+        in chain order
+        """
+
+        txids = []
+        for txid, *_ in self.addrs.get(addr, []):
+            if not txids or txids[-1] != txid:
+                txids.append(txid)
+
+        return txids
+
+    def outpoints(self, addr: str) -> List[Outpoint]:
+        """Returns all the outputs an address received, spent or not, in
+        chain order
+        """
+        return [(b, t, o) for _, b, t, o in self.addrs.get(addr, [])
+                if o != SENT]
+
+    def connect_block(self, index: int, block: Block):
+        """Adds a block that was connected to the chain
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+        """
+
+        for t, txn in enumerate(block.txns):
+            txid = txn_hash(txn)
+            self.txns[txid] = (index, t)
+            self._pending_txns.append((txid, index, t))
+
+            rows = [(txn[1], txid, index, t, SENT)]
+            rows += [(addr, txid, index, t, o)
+                     for o, (addr, _) in enumerate(receivers(txn))]
+
+            for row in rows:
+                if isinstance(row[0], str):
+                    self.addrs.setdefault(row[0], []).append(row[1:])
+                    self._pending_addrs.append(row)
+
+        self.height = index + 1
+        self.tip_hash = block._hash
+
+    def disconnect_block(self, index: int, block: Block):
+        """Removes the last block of the index, when it is disconnected from
+        the chain. The files are rewritten on the next write
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+        """
+
+        for txn in block.txns:
+            self.txns.pop(txn_hash(txn), None)
+
+            for addr in [txn[1]] + [addr for addr, _ in receivers(txn)]:
+                rows = self.addrs.get(addr, [])
+                while rows and rows[-1][1] >= index:
+                    rows.pop()
+
+                if not rows:
+                    self.addrs.pop(addr, None)
+
+        self.height = index
+        self.tip_hash = block.last_hash
+        self._rewrite = True
+
+    def take_pending(self) -> tuple:
+        """Returns the rows that weren't written yet and forgets them. Call
+        from the thread that connects blocks, and give the result to write
+
+        Returns:
+            tuple: The pending rows
+        """
+
+        if self._rewrite:
+            # Rewrite the files from a copy of the whole index
+            txns = [(txid, b, t) for txid, (b, t) in self.txns.items()]
+            addrs = [(addr, *row) for addr, rows in self.addrs.items()
+                     for row in rows]
+        else:
+            txns, addrs = self._pending_txns, self._pending_addrs
+
+        pending = (txns, addrs, self._rewrite, self.height, self.tip_hash)
+
+        self._pending_txns = []
+        self._pending_addrs = []
+        self._rewrite = False
+
+        return pending
+
+    def write(self, pending: tuple):
+        """Appends rows to the index files, or rewrites them. Can run in
+        another thread
+
+        Args:
+            pending (tuple): What take_pending returned
+        """
+
+        txns, addrs, rewrite, height, tip_hash = pending
+
+        if not txns and not addrs and not rewrite:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        for path, fields, rows in ((self.txns_path, TXN_FIELDS, txns),
+                                   (self.addrs_path, ADDR_FIELDS, addrs)):
+
+            mode = 'w' if rewrite else 'a'
+            header = rewrite or not os.path.exists(path) or \
+                os.path.getsize(path) == 0
+
+            with open(path, mode, newline='') as f:
+                writer = csv.writer(f)
+                if header:
+                    writer.writerow(fields)
+                writer.writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+
+        temp_path = f'{self.tip_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'height': height, 'hash': tip_hash}, f)
+        os.replace(temp_path, self.tip_path)
+
+    def load(self, chain: List[Block]):
+        """Reads the index files and indexes the blocks of the chain that
+        aren't in them yet. If the index doesn't match the chain it is built
+        again
+
+        Args:
+            chain (List[Block]): The loaded confirmed chain
+        """
+
+        self.__init__(self.path)
+
+        try:
+            with open(self.tip_path) as f:
+                tip = json.load(f)
+            height = tip['height']
+
+            if not 0 < height <= len(chain) or \
+                    chain[height - 1]._hash != tip['hash']:
+                raise ValueError
+
+            # Rows after the height are from a torn write
+            with open(self.txns_path, newline='') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        index = int(row['block'])
+                        if index < height:
+                            self.txns[row['txid']] = (index, int(row['txn']))
+                            continue
+                    except (TypeError, ValueError):
+                        pass
+
+                    self._rewrite = True
+
+            with open(self.addrs_path, newline='') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        index = int(row['block'])
+                        if index < height:
+                            self.addrs.setdefault(row['addr'], []).append(
+                                (row['txid'], index, int(row['txn']),
+                                 int(row['output'])))
+                            continue
+                    except (TypeError, ValueError):
+                        pass
+
+                    self._rewrite = True
+
+            self.height = height
+            self.tip_hash = tip['hash']
+
+        except (FileNotFoundError, KeyError, ValueError):
+            if os.path.exists(self.tip_path):
+                log.warning('The transaction index does not match the chain, '
+                            'rebuilding it')
+
+            self.__init__(self.path)
+            self._rewrite = True
+
+        for index in range(self.height, len(chain)):
+            if chain[index].txns is None:
+                # Pruned before it was indexed, nothing to index
+                self.height = index + 1
+                self.tip_hash = chain[index]._hash
+                continue
+
+            self.connect_block(index, chain[index])
@@ -0,0 +1,222 @@
+import ast
+import csv
+import os
+from typing import Dict, List, Optional, Tuple
+
+from block import Block
+
+# (block index in the chain, transaction index in the block, output index)
+Outpoint = Tuple[int, int, int]
+
+# Receivers that aren't spendable outputs
+NOT_OUTPUTS = ('FEES', )
+
+FIELDS = ['block', 'txn', 'output', 'addr', 'amount']
+
+
+class UTXOSet:
+
+    def __init__(self):
+        """The unspent transaction outputs of the confirmed chain. Outputs are
+        identified by their outpoint: the index of the block in the chain (the
+        genesis block is 0), the index of the transaction in the block and the
+        index of the receiver in the transaction.
+
+        Attributes:
+            utxos (Dict[Outpoint, Tuple[str, int]]): The address and amount
+            of every unspent output
+
+            height (int): Number of blocks that were applied, so the next
+            block to apply has this index
+        """
+
+        self.utxos: Dict[Outpoint, Tuple[str, int]] = {}
+        self.height = 0
+
+    def __len__(self):
+        return len(self.utxos)
+
+    def __contains__(self, outpoint: Outpoint):
+        return outpoint in self.utxos
+
+    def get(self, outpoint: Outpoint) -> Optional[Tuple[str, int]]:
+        return self.utxos.get(outpoint)
+
+    def apply_block(self, index: int, block: Block) -> List[tuple]:
+        """Spends the inputs of the block's transactions and adds their
+        outputs
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+
+        Returns:
+            List[tuple]: The spent outputs as (outpoint, (addr, amount)). Can
+            be given to undo_block
+        """
+
+        spent = []
+        for t, txn in enumerate(block.txns):
+
+            for outpoint in spent_outpoints(txn):
+                value = self.utxos.pop(outpoint, None)
+                if not value is None:
+                    spent.append((outpoint, value))
+
+            for o, (addr, amount) in enumerate(receivers(txn)):
+                if not addr in NOT_OUTPUTS:
+                    self.utxos[(index, t, o)] = (addr, amount)
+
+        self.height = index + 1
+        return spent
+
+    def undo_block(self, index: int, block: Block, spent: List[tuple]):
+        """Reverts apply_block
+
+        Args:
+            index (int): The index of the block in the chain
+            block (Block): The block
+            spent (List[tuple]): What apply_block returned for this block
+        """
+
+        for t, txn in enumerate(block.txns):
+            for o in range(len(receivers(txn))):
+                self.utxos.pop((index, t, o), None)
+
+        self.utxos.update(spent)
+        self.height = index
+
+    def save(self, path: str, tip_hash: str):
+        """Writes the set to a csv file. The height and the hash of the last
+        applied block are written to the first line. The file is replaced
+        atomically
+
+        Args:
+            path (str): The file
+            tip_hash (str): The hash of the last applied block
+        """
+
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', newline='') as f:
+            f.write(f'{self.height},{tip_hash}\n')
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            for (b, t, o), (addr, amount) in self.utxos.items():
+                writer.writerow([b, t, o, addr, amount])
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path: str) -> Tuple[Optional['UTXOSet'], Optional[str]]:
+        """Reads a set that was written by save
+
+        Args:
+            path (str): The file
+
+        Returns:
+            Tuple[Optional[UTXOSet], Optional[str]]: The set and the hash of
+            its last block. None if there's no valid file
+        """
+
+        try:
+            with open(path, newline='') as f:
+                utxo_set = UTXOSet()
+                height, tip_hash = f.readline().strip().split(',')
+                utxo_set.height = int(height)
+
+                for row in csv.DictReader(f):
+                    outpoint = (int(row['block']), int(row['txn']),
+                                int(row['output']))
+                    utxo_set.utxos[outpoint] = (row['addr'],
+                                                _number(row['amount']))
+
+        except (FileNotFoundError, IndexError, KeyError, ValueError):
+            return None, None
+
+        return utxo_set, tip_hash
+
+    def copy(self) -> 'UTXOSet':
+        utxo_set = UTXOSet()
+        utxo_set.utxos = self.utxos.copy()
+        utxo_set.height = self.height
+        return utxo_set
+
+
+def receivers(txn) -> List[Tuple[str, int]]:
+    """Returns the receivers of a transaction as (addr, amount) pairs. A
+    transaction with a single receiver may store it without the outer tuple,
+    like the block reward
+
+    Args:
+        txn (Transaction): The transaction
+
+    Returns:
+        List[Tuple[str, int]]: The receivers
+    """
+
+    recv = parse_field(txn[2])
+
+    if not recv:
+        return []
+
+    if isinstance(recv[0], str):
+        recv = [recv]
+
+    pairs = []
+    for pair in recv:
+        try:
+            addr, amount = pair
+            pairs.append((addr, amount))
+        except (ValueError, TypeError):
+            continue    # Not a receiver, the transaction is invalid
+
+    return pairs
+
+
+def spent_outpoints(txn) -> List[Outpoint]:
+
+    outputs = parse_field(txn[3])
+
+    if not outputs:
+        return []
+
+    outpoints = []
+    for output in outputs:
+        try:
+            outpoints.append(tuple(int(i) for i in output[:3]))
+        except (ValueError, TypeError):
+            continue    # Not an outpoint, the transaction is invalid
+
+    return outpoints
+
+
+def parse_field(value):
+    """Transaction fields that were read from a csv file are strings of
+    python literals. Returns them as values
+
+    Args:
+        value: The field
+
+    Returns:
+        The parsed field. Values that aren't literals are returned as they are
+    """
+
+    if isinstance(value, str):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+    # Empty fields are read as nan
+    if isinstance(value, float) and value != value:
+        return None
+
+    return value
+
+
+def _number(value: str):
+    number = float(value)
+    return int(number) if number.is_integer() else number
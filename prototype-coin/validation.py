@@ -0,0 +1,159 @@
+import re
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from block import Block, block_hash
+from compact import is_reward
+
+HEADER_BATCH = 4096  # Headers checked together
+
+HASH_FORMAT = re.compile('[0-9a-f]{64}')    # A sha256 hexdigest
+
+
+def is_hash(value) -> bool:
+    return isinstance(value, str) and not HASH_FORMAT.fullmatch(value) is None
+
+
+def _hash_format(hashes: np.ndarray) -> np.ndarray:
+    """Finds which hashes are sha256 hexdigests. The batch is checked as a
+    single string first, which is much faster when all of them are. Only
+    lowercase hex without spaces comes back the same from bytes.fromhex
+    """
+
+    try:
+        if set(map(len, hashes)) == {64}:
+            joined = ''.join(hashes)
+            if bytes.fromhex(joined).hex() == joined:
+                return np.ones(len(hashes), dtype=bool)
+    except (TypeError, ValueError):
+        pass    # Not all of them are strings, or not hex
+
+    return np.frompyfunc(is_hash, 1, 1)(hashes).astype(bool)
+
+
+def check_headers(hashes: Sequence[str], last_hashes: Sequence[str],
+                  prev_hash: str, difficulty: int,
+                  batch: int = HEADER_BATCH) -> int:
+    """Checks that headers continue each other and have the proof of work.
+    The headers are compared as arrays, a batch at a time, instead of one
+    block at a time. Every hash has to be a sha256 hexdigest, since shorter
+    strings would compare below the proof of work bound
+
+    Args:
+        hashes (Sequence[str]): The hashes of the blocks, in chain order
+        last_hashes (Sequence[str]): The hashes the blocks continue
+        prev_hash (str): The hash the first block should continue
+        difficulty (int): Leading zeros every hash needs
+        batch (int, optional): Headers checked together. Defaults to
+        HEADER_BATCH.
+
+    Returns:
+        int: The number of headers from the start that are valid. Equals the
+        number of headers if all of them are
+    """
+
+    # Object arrays compare the str objects themselves, converting to fixed
+    # size strings costs more than the checks
+    hashes = np.asarray(hashes, dtype=object)
+    last_hashes = np.asarray(last_hashes, dtype=object)
+
+    # Hex hashes with enough leading zeros are exactly the ones below it
+    bound = '0' * (difficulty - 1) + '1' if difficulty > 0 else None
+
+    for start in range(0, len(hashes), batch):
+        batch_hashes = hashes[start:start + batch]
+
+        parents = np.empty_like(batch_hashes)
+        parents[0] = prev_hash
+        parents[1:] = batch_hashes[:-1]
+
+        valid = last_hashes[start:start + batch] == parents
+        well_formed = _hash_format(batch_hashes)
+        valid &= well_formed
+        if not bound is None:
+            work = np.zeros_like(valid)
+            work[well_formed] = batch_hashes[well_formed] < bound
+            valid &= work
+
+        if not valid.all():
+            return start + int(np.argmin(valid))
+
+        prev_hash = batch_hashes[-1]
+
+    return len(hashes)
+
+
+def check_checkpoints(hashes: Sequence[str], first_height: int,
+                      checkpoints: Dict[int, str]) -> int:
+    """Checks that blocks at the heights of the checkpoints have their hashes
+
+    Args:
+        hashes (Sequence[str]): The hashes of the blocks, in chain order
+        first_height (int): The height of the first block
+        checkpoints (Dict[int, str]): Block hashes by their height
+
+    Returns:
+        int: The number of blocks from the start before the first block that
+        doesn't match its checkpoint, or the number of blocks
+    """
+
+    for height in sorted(checkpoints):
+        index = height - first_height
+        if 0 <= index < len(hashes) and hashes[index] != checkpoints[height]:
+            return index
+
+    return len(hashes)
+
+
+def check_txns(block: Block) -> Optional[str]:
+    """Checks the transactions of a block that is above the checkpoints. There
+    is a single block reward, and every other transaction spends outputs and
+    has a proof (public key and signature)
+
+    Args:
+        block (Block): The block
+
+    Returns:
+        Optional[str]: Why the block is invalid, None if it is valid
+    """
+
+    rewards = 0
+    for txn in block.txns:
+        if is_reward(txn):
+            rewards += 1
+            continue
+
+        if not txn[3]:
+            return 'transaction without inputs'
+
+        if txn[4] is None or len(txn[4]) != 2:
+            return 'transaction without proof'
+
+    if rewards > 1:
+        return 'more than one block reward'
+
+    return None
+
+
+def check_pow(block: Block, difficulty: int) -> bool:
+    """Computes the hash of a block again from its body, the way the miner
+    found it (see block.block_hash), and checks that it is the block's hash
+    and has the proof of work. Pruned blocks have no body, so only their
+    header can be checked (see check_headers)
+
+    Args:
+        block (Block): The block, with its transactions
+        difficulty (int): Leading zeros the hash needs
+
+    Returns:
+        bool: Whether the hash is valid
+    """
+
+    try:
+        _hash = block_hash(block.timestamp, block.last_hash, block.txns,
+                           block.proof)
+    except (TypeError, ValueError):
+        return False
+
+    return _hash == block._hash and _hash.startswith('0' * difficulty)